@@ -0,0 +1,151 @@
+# Admission control for concurrent server sessions, see Server.process_admitted()
+import contextlib
+import logging
+import multiprocessing
+import time
+
+# Shared state layout (int64 values):
+#   Running sessions     (1)
+#   Next ticket          (1)
+#   Running per config   (one for each config with a limit)
+#   Waiting sessions     (MAX_WAITING x [ticket, priority, config index + 1]),
+#                        where a ticket of 0 marks a free slot
+MAX_WAITING  = 1024
+RUNNING      = 0
+NEXT_TICKET  = 1
+CONFIGS      = 2
+
+class AdmissionControl:
+    """
+    Limits the number of sessions that are processed at the same time, in total
+    (maxSessions) and for each config (configLimits, e.g. {'bartfire': 1}).
+    Sessions over the limits wait in a queue ordered by the priority of their
+    config (configPriorities, higher first) and then by arrival.  While waiting,
+    the client is sent its position in the queue as MRD_MESSAGE_TEXT messages.
+
+    The state is kept in shared memory and a multiprocessing.Condition, so that
+    it is shared by threads as well as processes started by the server.
+    """
+
+    def __init__(self, maxSessions=0, configLimits=None, configPriorities=None):
+        self.maxSessions      = maxSessions
+        self.configLimits     = dict(configLimits or {})
+        self.configPriorities = dict(configPriorities or {})
+        self.configNames      = sorted(self.configLimits)
+        self.configIndex      = {name: i for i, name in enumerate(self.configNames)}
+        self.enabled          = (maxSessions > 0) or (len(self.configLimits) > 0)
+
+        if self.enabled:
+            self.waitingOffset = CONFIGS + len(self.configIndex)
+            self.state         = multiprocessing.RawArray('q', self.waitingOffset + 3*MAX_WAITING)
+            self.condition     = multiprocessing.Condition()
+
+    def limit_sessions(self, maxSessions):
+        """Lower the limit of sessions processed at the same time, e.g. to 1 when they are handled one at a time"""
+        if (self.maxSessions == 0) or (maxSessions < self.maxSessions):
+            self.maxSessions = maxSessions
+
+    @contextlib.contextmanager
+    def session(self, connection, config):
+        """Context manager that waits for the session to be admitted and frees its slot at exit"""
+        if not self.enabled:
+            yield
+            return
+
+        self.acquire(connection, config)
+        try:
+            yield
+        finally:
+            self.release(config)
+
+    def acquire(self, connection, config):
+        config   = config if isinstance(config, str) else ''
+        priority = self.configPriorities.get(config, 0)
+        index    = self.configIndex.get(config, -1)
+
+        with self.condition:
+            slot = self.add_waiting(priority, index)
+            if slot is None:
+                raise RuntimeError("Too many sessions are waiting to be processed")
+
+        tic          = time.perf_counter()
+        lastPosition = None
+        try:
+            while True:
+                with self.condition:
+                    position = self.get_position(slot)
+                    if position == 0:
+                        self.remove_waiting(slot)
+                        self.state[RUNNING] += 1
+                        if index >= 0:
+                            self.state[CONFIGS+index] += 1
+
+                        # Positions of the remaining sessions have changed
+                        self.condition.notify_all()
+                        break
+
+                    if position == lastPosition:
+                        self.condition.wait(1.0)
+                        continue
+
+                # Sent without holding the lock, as the client may be slow to read
+                lastPosition = position
+                logging.info("Session for config '%s' is waiting at position %d in the queue", config, position)
+                connection.send_text("Server is busy -- waiting to start processing (position %d in queue)" % position)
+
+        except:
+            with self.condition:
+                self.remove_waiting(slot)
+                self.condition.notify_all()
+            raise
+
+        if lastPosition is not None:
+            logging.info("Session for config '%s' started after waiting %.1f s", config, time.perf_counter()-tic)
+
+    def release(self, config):
+        index = self.configIndex.get(config if isinstance(config, str) else '', -1)
+        with self.condition:
+            self.state[RUNNING] -= 1
+            if index >= 0:
+                self.state[CONFIGS+index] -= 1
+            self.condition.notify_all()
+
+    # ----- Shared state, accessed with the condition held -----------------------
+    def add_waiting(self, priority, index):
+        self.state[NEXT_TICKET] += 1
+        for slot in range(MAX_WAITING):
+            offset = self.waitingOffset + 3*slot
+            if self.state[offset] == 0:
+                self.state[offset:offset+3] = [self.state[NEXT_TICKET], priority, index+1]
+                return slot
+        return None
+
+    def remove_waiting(self, slot):
+        self.state[self.waitingOffset + 3*slot] = 0
+
+    def can_start(self, index):
+        if (self.maxSessions > 0) and (self.state[RUNNING] >= self.maxSessions):
+            return False
+        if (index >= 0) and (self.state[CONFIGS+index] >= self.configLimits[self.configNames[index]]):
+            return False
+        return True
+
+    def get_position(self, slot):
+        """Position of slot in the queue (1 for the next session to start), or 0 if it can start now"""
+        offset = self.waitingOffset + 3*slot
+        key    = (-self.state[offset+1], self.state[offset])
+
+        ahead = 0
+        eligibleAhead = False
+        for other in range(MAX_WAITING):
+            otherOffset = self.waitingOffset + 3*other
+            if (other == slot) or (self.state[otherOffset] == 0):
+                continue
+            if (-self.state[otherOffset+1], self.state[otherOffset]) < key:
+                ahead += 1
+                eligibleAhead = eligibleAhead or self.can_start(self.state[otherOffset+2]-1)
+
+        # Sessions behind one that is held by its config's limit can start first
+        if self.can_start(self.state[offset+2]-1) and not eligibleAhead:
+            return 0
+        return ahead + 1
@@ -9,7 +9,6 @@ import base64
 import re
 import mrdhelper
 import constants
-from time import perf_counter
 
 # Folder for debug output files
 debugFolder = "/tmp/share/debug"
@@ -100,6 +99,7 @@ def process(connection, config, mrdHeader):
     finally:
         connection.send_close()
 
+@mrdhelper.timed_stage
 def process_image(imgGroup, connection, config, mrdHeader):
     if len(imgGroup) == 0:
         return []
@@ -108,9 +108,6 @@ def process_image(imgGroup, connection, config, mrdHeader):
     logging.info(f'     process_image called with {len(imgGroup)} images')
     logging.info(f'-----------------------------------------------')
 
-    # Start timer
-    tic = perf_counter()
-
     # Create folder, if necessary
     if not os.path.exists(debugFolder):
         os.makedirs(debugFolder)
@@ -133,14 +130,6 @@ def process_image(imgGroup, connection, config, mrdHeader):
     # Process each group of venc directions separately
     unique_venc_dir = np.unique([ismrmrd.Meta.deserialize(img.attribute_string)['FlowDirDisplay'] for img in imgGroup])
 
-    # Measure processing time
-    toc = perf_counter()
-    strProcessTime = "Total processing time: %.2f ms" % ((toc-tic)*1000.0)
-    logging.info(strProcessTime)
-
-    # Send this as a text message back to the client
-    connection.send_logging(constants.MRD_LOGGING_INFO, strProcessTime)
-
     # Start the phase images at series 10.  When interpreted by FIRE, images
     # with the same image_series_index are kept in the same series, but the
     # absolute series number isn't used and can be arbitrary
@@ -149,72 +138,76 @@ def process_image(imgGroup, connection, config, mrdHeader):
     for venc_dir in unique_venc_dir:
         # data array has dimensions [row col sli phs], i.e. [y x sli phs]
         # info lists has dimensions [sli phs]
-        data = np.zeros((imgGroup[0].data.shape[2], imgGroup[0].data.shape[3], max(slice)+1, max(phase)+1), imgGroup[0].data.dtype)
-        head = [[None]*(max(phase)+1) for _ in range(max(slice)+1)]
-        meta = [[None]*(max(phase)+1) for _ in range(max(slice)+1)]
-
-        for img, sli, phs in zip(imgGroup, slice, phase):
-            if ismrmrd.Meta.deserialize(img.attribute_string)['FlowDirDisplay'] == venc_dir:
-                # print("sli phs", sli, phs)
-                data[:,:,sli,phs] = img.data
-                head[sli][phs]    = img.getHead()
-                meta[sli][phs]    = ismrmrd.Meta.deserialize(img.attribute_string)
+        with mrdhelper.stage('sort'):
+            data = np.zeros((imgGroup[0].data.shape[2], imgGroup[0].data.shape[3], max(slice)+1, max(phase)+1), imgGroup[0].data.dtype)
+            head = [[None]*(max(phase)+1) for _ in range(max(slice)+1)]
+            meta = [[None]*(max(phase)+1) for _ in range(max(slice)+1)]
+
+            for img, sli, phs in zip(imgGroup, slice, phase):
+                if ismrmrd.Meta.deserialize(img.attribute_string)['FlowDirDisplay'] == venc_dir:
+                    # print("sli phs", sli, phs)
+                    data[:,:,sli,phs] = img.data
+                    head[sli][phs]    = img.getHead()
+                    meta[sli][phs]    = ismrmrd.Meta.deserialize(img.attribute_string)
 
         logging.debug("Phase data with venc encoding %s is size %s" % (venc_dir, data.shape,))
         np.save(debugFolder + "/" + "data_" + venc_dir + ".npy", data)
 
         # Mask out data with high mean temporal diff
-        threshold = 250
-        data_meandiff = np.mean(np.abs(np.diff(data,3)),3)
-        data_masked = data
-        data_masked[(data_meandiff > threshold)] = 2048
-        np.save(debugFolder + "/" + "data_masked_" + venc_dir + ".npy", data_masked)
+        with mrdhelper.stage('mask'):
+            threshold = 250
+            data_meandiff = np.mean(np.abs(np.diff(data,3)),3)
+            data_masked = data
+            data_masked[(data_meandiff > threshold)] = 2048
+            np.save(debugFolder + "/" + "data_masked_" + venc_dir + ".npy", data_masked)
 
         # Determine max value (12 or 16 bit)
-        BitsStored = 12
-        if (mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored") is not None):
-            BitsStored = mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored")
-        maxVal = 2**BitsStored - 1
+        with mrdhelper.stage('quantize'):
+            BitsStored = 12
+            if (mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored") is not None):
+                BitsStored = mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored")
+            maxVal = 2**BitsStored - 1
 
-        # Normalize and convert to int16
-        data_masked = (data_masked.astype(np.float64) - 2048)*maxVal/2048
-        data_masked = np.around(data_masked).astype(np.int16)
+            # Normalize and convert to int16
+            data_masked = (data_masked.astype(np.float64) - 2048)*maxVal/2048
+            data_masked = np.around(data_masked).astype(np.int16)
 
         # Re-slice back into 2D images
-        for sli in range(data_masked.shape[2]):
-            for phs in range(data_masked.shape[3]):
-                # Create new MRD instance for the processed image
-                # data has shape [y x sli phs]
-                # from_array() should be called with 'transpose=False' to avoid warnings, and when called
-                # with this option, can take input as: [cha z y x], [z y x], or [y x]
-                tmpImg = ismrmrd.Image.from_array(data_masked[...,sli,phs], transpose=False)
-
-                # Set the header information
-                tmpHead = head[sli][phs]
-                tmpHead.data_type          = tmpImg.getHead().data_type
-                tmpHead.image_index        = phs + sli*data_masked.shape[3]
-                tmpHead.image_series_index = last_series
-                tmpImg.setHead(tmpHead)
-
-                # Set ISMRMRD Meta Attributes
-                tmpMeta = meta[sli][phs]
-                tmpMeta['DataRole']               = 'Image'
-                tmpMeta['ImageProcessingHistory'] = ['FIRE', 'PYTHON']
-                tmpMeta['WindowCenter']           = str((maxVal+1)/2)
-                tmpMeta['WindowWidth']            = str((maxVal+1))
-                tmpMeta['Keep_image_geometry']    = 1
-
-                # Add image orientation directions to MetaAttributes if not already present
-                if tmpMeta.get('ImageRowDir') is None:
-                    tmpMeta['ImageRowDir'] = ["{:.18f}".format(tmpHead.read_dir[0]), "{:.18f}".format(tmpHead.read_dir[1]), "{:.18f}".format(tmpHead.read_dir[2])]
-
-                if tmpMeta.get('ImageColumnDir') is None:
-                    tmpMeta['ImageColumnDir'] = ["{:.18f}".format(tmpHead.phase_dir[0]), "{:.18f}".format(tmpHead.phase_dir[1]), "{:.18f}".format(tmpHead.phase_dir[2])]
-
-                xml = tmpMeta.serialize()
-                logging.debug("Image MetaAttributes: %s", xml)
-                tmpImg.attribute_string = xml
-                imagesOut.append(tmpImg)
+        with mrdhelper.stage('meta'):
+            for sli in range(data_masked.shape[2]):
+                for phs in range(data_masked.shape[3]):
+                    # Create new MRD instance for the processed image
+                    # data has shape [y x sli phs]
+                    # from_array() should be called with 'transpose=False' to avoid warnings, and when called
+                    # with this option, can take input as: [cha z y x], [z y x], or [y x]
+                    tmpImg = ismrmrd.Image.from_array(data_masked[...,sli,phs], transpose=False)
+
+                    # Set the header information
+                    tmpHead = head[sli][phs]
+                    tmpHead.data_type          = tmpImg.getHead().data_type
+                    tmpHead.image_index        = phs + sli*data_masked.shape[3]
+                    tmpHead.image_series_index = last_series
+                    tmpImg.setHead(tmpHead)
+
+                    # Set ISMRMRD Meta Attributes
+                    tmpMeta = meta[sli][phs]
+                    tmpMeta['DataRole']               = 'Image'
+                    tmpMeta['ImageProcessingHistory'] = ['FIRE', 'PYTHON']
+                    tmpMeta['WindowCenter']           = str((maxVal+1)/2)
+                    tmpMeta['WindowWidth']            = str((maxVal+1))
+                    tmpMeta['Keep_image_geometry']    = 1
+
+                    # Add image orientation directions to MetaAttributes if not already present
+                    if tmpMeta.get('ImageRowDir') is None:
+                        tmpMeta['ImageRowDir'] = ["{:.18f}".format(tmpHead.read_dir[0]), "{:.18f}".format(tmpHead.read_dir[1]), "{:.18f}".format(tmpHead.read_dir[2])]
+
+                    if tmpMeta.get('ImageColumnDir') is None:
+                        tmpMeta['ImageColumnDir'] = ["{:.18f}".format(tmpHead.phase_dir[0]), "{:.18f}".format(tmpHead.phase_dir[1]), "{:.18f}".format(tmpHead.phase_dir[2])]
+
+                    xml = tmpMeta.serialize()
+                    logging.debug("Image MetaAttributes: %s", xml)
+                    tmpImg.attribute_string = xml
+                    imagesOut.append(tmpImg)
 
         last_series += 1
     return imagesOut
@@ -0,0 +1,473 @@
+import constants
+from connection import Connection
+from lazyimage import LazyImage
+
+import asyncio
+import concurrent.futures
+import ctypes
+import inspect
+import ismrmrd
+import ismrmrd.hdf5
+import logging
+import numpy as np
+import time
+
+class AsyncConnection(Connection):
+    """
+    asyncio counterpart to Connection, reading from an asyncio StreamReader and
+    writing to a StreamWriter.  Messages are received with "async for item in
+    connection" or "await connection.next()" and all send_* methods are awaitable.
+    Message framing, counters and savedata handling are shared with Connection.
+
+    Recon modules written for the blocking Connection API can be run in a worker
+    thread using the wrapper returned by blocking().
+
+    Saved data is always written by a SaveDataWriter thread, so that HDF5 writes
+    don't block the event loop.  In 'sync' mode, the close is acknowledged once
+    all data has been written, as with Connection.  Other blocking savedata
+    work (creating the file, waiting for the writer) runs on a thread of the
+    connection's own, so that it never waits for the threads running config
+    modules, which hold theirs until they have read the close message.
+    """
+
+    def __init__(self, reader, writer, savedata, savedataFile = "", savedataFolder = "", savedataGroup = "dataset", sendBufferSize = 0):
+        super().__init__(writer.get_extra_info('socket'), savedata, savedataFile, savedataFolder, savedataGroup, sendBufferSize)
+        self.reader           = reader
+        self.writer           = writer
+        self.readLock         = asyncio.Lock()
+        self.writeLock        = asyncio.Lock()
+        self.blockingExecutor = None    # See run_blocking()
+
+    def blocking(self):
+        """Return a synchronous view of this connection that can be used from another thread"""
+        return BlockingConnection(self, asyncio.get_running_loop())
+
+    def __iter__(self):
+        raise TypeError("AsyncConnection must be iterated with 'async for' or wrapped with blocking()")
+
+    async def __aiter__(self):
+        while not self.is_exhausted:
+            yield await self.next()
+
+    async def __anext__(self):
+        return await self.next()
+
+    async def read(self, nbytes):
+        if self.inflatedBuffer is not None:
+            return self.read_inflated(nbytes)
+
+        # Return a short read if the stream ends early, matching Connection.read()
+        tic = time.perf_counter()
+        try:
+            data = await self.reader.readexactly(nbytes)
+        except asyncio.IncompleteReadError as e:
+            data = e.partial
+        self.recvTime  += time.perf_counter() - tic
+        self.recvBytes += len(data)
+        return data
+
+    async def read_into(self, array):
+        buffer = array.reshape(-1).view(np.uint8)
+        if self.inflatedBuffer is not None:
+            buffer[:] = np.frombuffer(self.read_inflated_view(buffer.size), dtype=np.uint8)
+            return
+
+        tic = time.perf_counter()
+        try:
+            buffer[:] = np.frombuffer(await self.reader.readexactly(buffer.size), dtype=np.uint8)
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionResetError("Connection closed after %d of %d bytes were received" % (len(e.partial), buffer.size))
+        finally:
+            self.recvTime += time.perf_counter() - tic
+        self.recvBytes += buffer.size
+
+    async def flush(self, force=True):
+        buffers = self.take_send_buffer(force)
+        if buffers is None:
+            return
+
+        tic = time.perf_counter()
+        try:
+            self.writer.writelines(buffers)
+            await self.writer.drain()
+        finally:
+            self.sendTime += time.perf_counter() - tic
+
+    async def next(self):
+        async with self.readLock:
+            start = self.stats_snapshot()
+            if self.pendingAcquisitionHeader is not None:
+                item = await self.read_acquisition()
+                self.record_received(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, start)
+                return item
+
+            id = await self.read_mrd_message_identifier()
+
+            if (self.is_exhausted == True):
+                return
+
+            handler = self.handlers.get(id)
+            if handler is None:
+                Connection.unknown_message_identifier(id)
+            item = await handler()
+            self.record_received(self.get_recorded_id(id), start)
+            return item
+
+    async def shutdown_close(self):
+        try:
+            await self.flush()
+        except:
+            logging.warning("Failed to send %d buffered bytes before closing", self.sendBufferBytes)
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except:
+            pass
+        self.close_shared_memory()
+        if self.savedataWriter is not None:
+            await self.run_blocking(self.stop_savedata_writer)
+        if self.blockingExecutor is not None:
+            self.blockingExecutor.shutdown(wait=False)
+            self.blockingExecutor = None
+        logging.info("Socket closed")
+
+    async def read_mrd_message_identifier(self):
+        if self.peekedIdentifier is not None:
+            identifier_bytes      = self.peekedIdentifier
+            self.peekedIdentifier = None
+        else:
+            try:
+                identifier_bytes = await self.read(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER)
+            except ConnectionResetError:
+                logging.error("Connection closed unexpectedly")
+                self.is_exhausted = True
+                return
+
+        if (len(identifier_bytes) < constants.SIZEOF_MRD_MESSAGE_IDENTIFIER):
+            self.is_exhausted = True
+            return
+
+        return constants.MrdMessageIdentifier.unpack(identifier_bytes)[0]
+
+    async def peek_mrd_message_identifier(self):
+        if self.pendingAcquisitionHeader is not None:
+            return constants.MRD_MESSAGE_ISMRMRD_ACQUISITION
+
+        # StreamReader has no peek, so the identifier is read and held for the
+        # next call to read_mrd_message_identifier(), as in Connection
+        if self.peekedIdentifier is None:
+            try:
+                self.peekedIdentifier = await self.read(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER)
+            except ConnectionResetError:
+                logging.error("Connection closed unexpectedly")
+                self.is_exhausted = True
+                return
+
+        if (len(self.peekedIdentifier) < constants.SIZEOF_MRD_MESSAGE_IDENTIFIER):
+            self.is_exhausted = True
+            return
+
+        return constants.MrdMessageIdentifier.unpack(self.peekedIdentifier)[0]
+
+    async def read_mrd_message_length(self):
+        length_bytes = await self.read(constants.SIZEOF_MRD_MESSAGE_LENGTH)
+        return constants.MrdMessageLength.unpack(length_bytes)[0]
+
+    async def read_string(self):
+        length = await self.read_mrd_message_length()
+        contents = await self.read(length)
+        return contents.split(b'\x00',1)[0].decode('utf-8')  # Strip off null teminator
+
+    # ----- Sending ------------------------------------------------------------
+    # Messages are serialized by the same write_* methods as Connection
+    async def send_config_file(self, filename):
+        async with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_config_file(filename)
+            await self.flush()
+            self.record_sent(constants.MRD_MESSAGE_CONFIG_FILE, start)
+
+    async def send_config_text(self, contents):
+        async with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_config_text(contents)
+            await self.flush()
+            self.record_sent(constants.MRD_MESSAGE_CONFIG_TEXT, start)
+
+    async def send_metadata(self, contents):
+        async with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_metadata(contents)
+            await self.flush()
+            self.record_sent(constants.MRD_MESSAGE_METADATA_XML_TEXT, start)
+
+    async def send_close(self):
+        async with self.writeLock:
+            if self.sendStatsOnClose:
+                start = self.stats_snapshot()
+                self.write_text(self.format_stats())
+                await self.flush()
+                self.record_sent(constants.MRD_MESSAGE_TEXT, start)
+
+            for level, text in self.get_close_reports():
+                start = self.stats_snapshot()
+                self.write_text("%s %s" % (level, text))
+                await self.flush()
+                self.record_sent(constants.MRD_MESSAGE_TEXT, start)
+
+            start = self.stats_snapshot()
+            self.write_close()
+            await self.flush()
+            self.record_sent(constants.MRD_MESSAGE_CLOSE, start)
+            logging.log(self.get_stats_log_level(), self.format_stats())
+            self.log_message_summary()
+
+    async def send_text(self, contents):
+        async with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_text(contents)
+            await self.flush()
+            self.record_sent(constants.MRD_MESSAGE_TEXT, start)
+
+    async def send_logging(self, level, contents):
+        try:
+            formatted_contents = "%s %s" % (level, contents)
+        except:
+            logging.warning("Unsupported logging level: " + level)
+            formatted_contents = contents
+
+        await self.send_text(formatted_contents)
+
+    async def send_acquisition(self, acquisition):
+        async with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_acquisition(acquisition)
+            await self.flush(force=False)
+            self.record_sent(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, start)
+
+    async def send_image(self, images):
+        async with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_image(images)
+            await self.flush(force=False)
+            self.record_sent(constants.MRD_MESSAGE_ISMRMRD_IMAGE, start, len(images) if isinstance(images, list) else 1)
+
+    async def send_waveform(self, waveform):
+        async with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_waveform(waveform)
+            await self.flush(force=False)
+            self.record_sent(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM, start)
+
+    # ----- Receiving ----------------------------------------------------------
+    # See Connection for a description of each message type
+    async def read_config_file(self):
+        logging.info("<-- Received MRD_MESSAGE_CONFIG_FILE (1)")
+        config_file_bytes = await self.read(constants.SIZEOF_MRD_MESSAGE_CONFIGURATION_FILE)
+        config_file = constants.MrdMessageConfigurationFile.unpack(config_file_bytes)[0]
+        config_file = config_file.split(b'\x00',1)[0].decode('utf-8')  # Strip off null terminators in fixed 1024 size
+
+        logging.debug("    " + config_file)
+        if (config_file == "savedataonly") and (self.dset is None):
+            # Saving is enabled by this config, so the file is created here
+            await self.run_blocking(self.save_config_file, config_file)
+        else:
+            self.save_config_file(config_file)
+        return config_file
+
+    async def read_config_text(self):
+        logging.info("<-- Received MRD_MESSAGE_CONFIG_TEXT (2)")
+        config = await self.read_string()
+
+        logging.debug("    " + config)
+        await self.wait_for_save_room()
+        self.save_config_text(config)
+        return config
+
+    async def read_metadata(self):
+        logging.info("<-- Received MRD_MESSAGE_METADATA_XML_TEXT (3)")
+        metadata = await self.read_string()
+        await self.wait_for_save_room()
+        self.save_metadata(metadata)
+        return metadata
+
+    async def read_close(self):
+        # Waiting for the SaveDataWriter in 'sync' and 'durable' modes blocks,
+        # so it is done outside of the event loop
+        if (self.savedataWriter is not None) and (self.savedataMode != 'async'):
+            return await self.run_blocking(Connection.read_close, self)
+        await self.wait_for_save_room()
+        return Connection.read_close(self)
+
+    def uses_savedata_writer(self):
+        return True
+
+    async def create_save_file_async(self):
+        # Creating the HDF5 file blocks, so it is done outside of the event loop
+        if (self.savedata is True) and (self.dset is None):
+            await self.run_blocking(self.create_save_file)
+
+    async def wait_for_save_room(self, nbytes=0):
+        # SaveDataWriter.put() blocks while the writer's queue is full, which
+        # would stop the event loop for all sessions, so that is waited for in
+        # a thread before data is saved.  Only this connection's reads queue
+        # data, so the room can't be taken by anyone else in the meantime
+        if (self.savedataWriter is not None) and not self.savedataWriter.has_room(nbytes):
+            await self.run_blocking(self.savedataWriter.wait_for_room, nbytes)
+
+    async def run_blocking(self, func, *args):
+        # The connection's blocking calls are awaited one at a time, so one thread is enough
+        if self.blockingExecutor is None:
+            self.blockingExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='savedata')
+        return await asyncio.get_running_loop().run_in_executor(self.blockingExecutor, func, *args)
+
+    async def read_text(self):
+        logging.info("<-- Received MRD_MESSAGE_TEXT (5)")
+        text = await self.read_string()
+        logging.info("    %s", text)
+        return text
+
+    async def read_acquisition(self):
+        self.recvAcqs += 1
+        if self.messageLog.should_log('receivedAcquisitions'):
+            logging.info("<-- Received MRD_MESSAGE_ISMRMRD_ACQUISITION (1008) (total: %d)", self.recvAcqs)
+
+        if self.pendingAcquisitionHeader is not None:
+            header_bytes = self.pendingAcquisitionHeader
+            self.pendingAcquisitionHeader = None
+        else:
+            header_bytes = await self.read(ctypes.sizeof(ismrmrd.AcquisitionHeader))
+        acq = ismrmrd.Acquisition(header_bytes)
+
+        if acq.traj.size > 0:
+            await self.read_into(acq.traj)
+        if acq.data.size > 0:
+            await self.read_into(acq.data)
+
+        await self.wait_for_save_room(acq.data.nbytes + acq.traj.nbytes)
+        self.save_acquisition(acq)
+        return acq
+
+    async def read_acquisition_batch(self, max_n, stop_flag=None):
+        # See Connection.read_acquisition_batch()
+        async with self.readLock:
+            start   = self.stats_snapshot()
+            headers = np.zeros((max_n,), dtype=ismrmrd.hdf5.acquisition_header_dtype)
+            data    = None
+            traj    = None
+            n       = 0
+            while n < max_n:
+                if self.pendingAcquisitionHeader is not None:
+                    headers[n:n+1] = np.frombuffer(self.pendingAcquisitionHeader, dtype=headers.dtype)
+                    self.pendingAcquisitionHeader = None
+                else:
+                    if await self.peek_mrd_message_identifier() != constants.MRD_MESSAGE_ISMRMRD_ACQUISITION:
+                        break
+                    await self.read_mrd_message_identifier()
+                    await self.read_into(headers[n:n+1])
+
+                n, data, traj, done = self.add_to_acquisition_batch(headers, data, traj, n, stop_flag)
+                if done:
+                    break
+
+                if traj[n-1].size > 0:
+                    await self.read_into(traj[n-1])
+                if data[n-1].size > 0:
+                    await self.read_into(data[n-1])
+
+                if (stop_flag is not None) and (headers[n-1]['flags'] & (1 << (stop_flag - 1))):
+                    break
+
+            if n > 0:
+                self.record_received(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, start, n)
+                await self.wait_for_save_room(data[:n].nbytes + traj[:n].nbytes)
+            return self.finish_acquisition_batch(headers, data, traj, n)
+
+    async def read_image(self):
+        self.recvImages += 1
+        verbose = self.messageLog.should_log('receivedImages')
+        if verbose:
+            logging.info("<-- Received MRD_MESSAGE_ISMRMRD_IMAGE (1022) (total: %d)", self.recvImages)
+
+        header_bytes = await self.read(ctypes.sizeof(ismrmrd.ImageHeader))
+
+        attribute_length_bytes = await self.read(ctypes.sizeof(ctypes.c_uint64))
+        attribute_length = ctypes.c_uint64.from_buffer_copy(attribute_length_bytes)
+        attribute_bytes = await self.read(attribute_length.value)
+
+        if self.lazyImages:
+            image = LazyImage(header_bytes, attribute_bytes.split(b'\x00',1)[0])  # Strip off null teminator
+        else:
+            image = ismrmrd.Image(header_bytes, attribute_bytes.split(b'\x00',1)[0].decode('utf-8'))  # Strip off null teminator
+
+        if verbose:
+            logging.info("    Image is size %d x %d x %d with %d channels of type %s", image.getHead().matrix_size[0], image.getHead().matrix_size[1], image.getHead().matrix_size[2], image.channels, image.data.dtype)
+        if image.data.size > 0:
+            await self.read_into(image.data)
+
+        await self.wait_for_save_room(image.data.nbytes)
+        return self.save_image(image)
+
+    async def read_waveform(self):
+        self.recvWaveforms += 1
+        if self.messageLog.should_log('receivedWaveforms'):
+            logging.info("<-- Received MRD_MESSAGE_ISMRMRD_WAVEFORM (1026) (total: %d)", self.recvWaveforms)
+
+        header_bytes = await self.read(ctypes.sizeof(ismrmrd.WaveformHeader))
+        waveform = ismrmrd.Waveform(header_bytes)
+
+        if waveform.data.size > 0:
+            await self.read_into(waveform.data)
+
+        await self.wait_for_save_room(waveform.data.nbytes)
+        self.save_waveform(waveform)
+        return waveform
+
+    async def read_compressed(self):
+        header_bytes = await self.read(constants.SIZEOF_MRD_MESSAGE_COMPRESSED_HEADER)
+        id, codec, length, compressedLength = Connection.parse_compressed_header(header_bytes)
+        self.inflate(codec, length, await self.read(compressedLength))
+
+        try:
+            return await self.handlers[id]()
+        finally:
+            self.inflatedBuffer = None
+
+    async def read_shared_memory(self):
+        header_bytes = await self.read(constants.SIZEOF_MRD_MESSAGE_SHARED_MEMORY_HEADER)
+        id, position, length = self.map_shared_memory(header_bytes)
+
+        try:
+            return await self.handlers[id]()
+        finally:
+            self.unmap_shared_memory(position, length)
+
+class BlockingConnection:
+    """
+    Synchronous wrapper around an AsyncConnection for use from a thread other
+    than the one running the event loop.  Coroutine methods (next, send_image,
+    etc.) are scheduled on the loop and waited on, so existing recon modules can
+    iterate and send as they would with a Connection.
+    """
+
+    def __init__(self, connection, loop):
+        object.__setattr__(self, 'connection', connection)
+        object.__setattr__(self, 'loop',       loop)
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if inspect.iscoroutinefunction(attr):
+            def call(*args, **kwargs):
+                return asyncio.run_coroutine_threadsafe(attr(*args, **kwargs), self.loop).result()
+            return call
+        return attr
+
+    def __setattr__(self, name, value):
+        setattr(self.connection, name, value)
+
+    def __iter__(self):
+        while not self.connection.is_exhausted:
+            yield self.next()
+
+    def __next__(self):
+        return self.next()
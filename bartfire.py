@@ -6,6 +6,7 @@ import numpy as np
 import ctypes
 import constants
 import mrdhelper
+import kspacebuffer
 import tempfile
 from bart import bart
 
@@ -36,7 +37,7 @@ def process(connection, config, metadata):
         logging.info("Improperly formatted metadata: \n%s", metadata)
 
     # Continuously parse incoming data parsed from MRD messages
-    acqGroup = []
+    acqGroup = kspacebuffer.KSpaceBuffer(metadata, config)
     try:
         for item in connection:
             # ----------------------------------------------------------
@@ -47,7 +48,8 @@ def process(connection, config, metadata):
                 if (not item.is_flag_set(ismrmrd.ACQ_IS_NOISE_MEASUREMENT) and
                     not item.is_flag_set(ismrmrd.ACQ_IS_PARALLEL_CALIBRATION) and
                     not item.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA)):
-                    acqGroup.append(item)
+                    with mrdhelper.stage('sort'):
+                        acqGroup.add(item)
 
                 # When this criteria is met, run process_raw() on the accumulated
                 # data, which returns images that are sent back to the client.
@@ -55,7 +57,7 @@ def process(connection, config, metadata):
                     logging.info("Processing a group of k-space data")
                     image = process_raw(acqGroup, config, metadata)
                     connection.send_image(image)
-                    acqGroup = []
+                    acqGroup.clear()
 
             # ----------------------------------------------------------
             # Image and waveform data messages are not supported
@@ -82,7 +84,7 @@ def process(connection, config, metadata):
             logging.info("Processing a group of k-space data (untriggered)")
             image = process_raw(acqGroup, config, metadata)
             connection.send_image(image)
-            acqGroup = []
+            acqGroup.clear()
 
     except Exception as e:
         logging.error(traceback.format_exc())
@@ -91,6 +93,7 @@ def process(connection, config, metadata):
     finally:
         connection.send_close()
 
+@mrdhelper.timed_stage
 def process_raw(group, config, metadata):
     if len(group) == 0:
         return []
@@ -100,112 +103,103 @@ def process_raw(group, config, metadata):
         os.makedirs(debugFolder)
         logging.debug("Created folder " + debugFolder + " for debug output files")
 
-    # Format data into single [cha PE RO phs] array
-    lin = [acquisition.idx.kspace_encode_step_1 for acquisition in group]
-    phs = [acquisition.idx.phase                for acquisition in group]
+    # Readouts were formatted into a single [cha PE RO phs] array as they were
+    # received (see KSpaceBuffer), which may be memory mapped for large scans
+    # (timed as the 'sort' stage)
+    with mrdhelper.stage('format'):
+        data    = group.data
+        rawHead = group.heads
 
-    # Use the zero-padded matrix size
-    data = np.zeros((group[0].data.shape[0], 
-                     metadata.encoding[0].encodedSpace.matrixSize.y, 
-                     metadata.encoding[0].encodedSpace.matrixSize.x, 
-                     max(phs)+1), 
-                    group[0].data.dtype)
+        # Flip matrix in RO/PE to be consistent with ICE
+        data = np.flip(data, (1, 2))
 
-    rawHead = [None]*(max(phs)+1)
-
-    for acq, lin, phs in zip(group, lin, phs):
-        if (lin < data.shape[1]) and (phs < data.shape[3]):
-            # TODO: Account for asymmetric echo in a better way
-            data[:,lin,-acq.data.shape[1]:,phs] = acq.data
-
-            # center line of k-space is encoded in user[5]
-            if (rawHead[phs] is None) or (np.abs(acq.getHead().idx.kspace_encode_step_1 - acq.getHead().idx.user[5]) < np.abs(rawHead[phs].idx.kspace_encode_step_1 - rawHead[phs].idx.user[5])):
-                rawHead[phs] = acq.getHead()
-
-    # Flip matrix in RO/PE to be consistent with ICE
-    data = np.flip(data, (1, 2))
-
-    # Format as [row col phs cha] for BART
-    data = data.transpose((1, 2, 3, 0))
+        # Format as [row col phs cha] for BART
+        data = data.transpose((1, 2, 3, 0))
 
     logging.debug("Raw data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "raw.npy", data)
 
     # Fourier Transform with BART
     logging.info("Calling BART FFT")
-    data = bart(1, 'fft -u -i 3', data)
+    with mrdhelper.stage('fft'):
+        data = bart(1, 'fft -u -i 3', data)
 
-    # Re-format as [cha row col phs]
-    data = data.transpose((3, 0, 1, 2))
+        # Re-format as [cha row col phs]
+        data = data.transpose((3, 0, 1, 2))
 
     # Sum of squares coil combination
     # Data will be [PE RO phs]
-    data = np.abs(data)
-    data = np.square(data)
-    data = np.sum(data, axis=0)
-    data = np.sqrt(data)
+    with mrdhelper.stage('coil-combine'):
+        data = np.abs(data)
+        data = np.square(data)
+        data = np.sum(data, axis=0)
+        data = np.sqrt(data)
 
     logging.debug("Image data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "img.npy", data)
 
     # Determine max value (12 or 16 bit)
-    BitsStored = 12
-    if (mrdhelper.get_userParameterLong_value(metadata, "BitsStored") is not None):
-        BitsStored = mrdhelper.get_userParameterLong_value(metadata, "BitsStored")
-    maxVal = 2**BitsStored - 1
-
-    # Normalize and convert to int16
-    data *= maxVal/data.max()
-    data = np.around(data)
-    data = data.astype(np.int16)
-
-    # Remove readout oversampling
-    if metadata.encoding[0].reconSpace.matrixSize.x != 0:
-        offset = int((data.shape[1] - metadata.encoding[0].reconSpace.matrixSize.x)/2)
-        data = data[:,offset:offset+metadata.encoding[0].reconSpace.matrixSize.x]
-
-    # Remove phase oversampling
-    if metadata.encoding[0].reconSpace.matrixSize.y != 0:
-        offset = int((data.shape[0] - metadata.encoding[0].reconSpace.matrixSize.y)/2)
-        data = data[offset:offset+metadata.encoding[0].reconSpace.matrixSize.y,:]
-
-    logging.debug("Image without oversampling is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "imgCrop.npy", data)
+    with mrdhelper.stage('quantize'):
+        BitsStored = 12
+        if (mrdhelper.get_userParameterLong_value(metadata, "BitsStored") is not None):
+            BitsStored = mrdhelper.get_userParameterLong_value(metadata, "BitsStored")
+        maxVal = 2**BitsStored - 1
+
+        # Normalize and convert to int16
+        data *= maxVal/data.max()
+        data = np.around(data)
+        data = data.astype(np.int16)
+
+    # Remove readout and phase oversampling
+    with mrdhelper.stage('crop'):
+        # Remove readout oversampling
+        if metadata.encoding[0].reconSpace.matrixSize.x != 0:
+            offset = int((data.shape[1] - metadata.encoding[0].reconSpace.matrixSize.x)/2)
+            data = data[:,offset:offset+metadata.encoding[0].reconSpace.matrixSize.x]
+
+        # Remove phase oversampling
+        if metadata.encoding[0].reconSpace.matrixSize.y != 0:
+            offset = int((data.shape[0] - metadata.encoding[0].reconSpace.matrixSize.y)/2)
+            data = data[offset:offset+metadata.encoding[0].reconSpace.matrixSize.y,:]
+
+        logging.debug("Image without oversampling is size %s" % (data.shape,))
+        np.save(debugFolder + "/" + "imgCrop.npy", data)
 
     # Format as ISMRMRD image data
-    imagesOut = []
-    for phs in range(data.shape[2]):
-        # Create new MRD instance for the processed image
-        # data has shape [PE RO phs], i.e. [y x].
-        # from_array() should be called with 'transpose=False' to avoid warnings, and when called
-        # with this option, can take input as: [cha z y x], [z y x], or [y x]
-        tmpImg = ismrmrd.Image.from_array(data[...,phs], transpose=False)
-
-        # Set the header information
-        tmpImg.setHead(mrdhelper.update_img_header_from_raw(tmpImg.getHead(), rawHead[phs]))
-        tmpImg.field_of_view = (ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.x), 
-                                ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.y), 
-                                ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.z))
-        tmpImg.image_index = phs
-
-        # Set ISMRMRD Meta Attributes
-        tmpMeta = ismrmrd.Meta()
-        tmpMeta['DataRole']               = 'Image'
-        tmpMeta['ImageProcessingHistory'] = ['PYTHON', 'BART']
-        tmpMeta['WindowCenter']           = str((maxVal+1)/2)
-        tmpMeta['WindowWidth']            = str((maxVal+1))
-        tmpMeta['Keep_image_geometry']    = 1
-
-        # Add image orientation directions to MetaAttributes if not already present
-        if tmpMeta.get('ImageRowDir') is None:
-            tmpMeta['ImageRowDir'] = ["{:.18f}".format(tmpImg.getHead().read_dir[0]), "{:.18f}".format(tmpImg.getHead().read_dir[1]), "{:.18f}".format(tmpImg.getHead().read_dir[2])]
-
-        if tmpMeta.get('ImageColumnDir') is None:
-            tmpMeta['ImageColumnDir'] = ["{:.18f}".format(tmpImg.getHead().phase_dir[0]), "{:.18f}".format(tmpImg.getHead().phase_dir[1]), "{:.18f}".format(tmpImg.getHead().phase_dir[2])]
-
-        xml = tmpMeta.serialize()
-        logging.debug("Image MetaAttributes: %s", xml)
-        tmpImg.attribute_string = xml
-        imagesOut.append(tmpImg)
+    with mrdhelper.stage('meta'):
+        imagesOut = []
+        for phs in range(data.shape[2]):
+            # Create new MRD instance for the processed image
+            # data has shape [PE RO phs], i.e. [y x].
+            # from_array() should be called with 'transpose=False' to avoid warnings, and when called
+            # with this option, can take input as: [cha z y x], [z y x], or [y x]
+            tmpImg = ismrmrd.Image.from_array(data[...,phs], transpose=False)
+
+            # Set the header information
+            tmpImg.setHead(mrdhelper.update_img_header_from_raw(tmpImg.getHead(), rawHead[phs]))
+            tmpImg.field_of_view = (ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.x), 
+                                    ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.y), 
+                                    ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.z))
+            tmpImg.image_index = phs
+
+            # Set ISMRMRD Meta Attributes
+            tmpMeta = ismrmrd.Meta()
+            tmpMeta['DataRole']               = 'Image'
+            tmpMeta['ImageProcessingHistory'] = ['PYTHON', 'BART']
+            tmpMeta['WindowCenter']           = str((maxVal+1)/2)
+            tmpMeta['WindowWidth']            = str((maxVal+1))
+            tmpMeta['Keep_image_geometry']    = 1
+
+            # Add image orientation directions to MetaAttributes if not already present
+            if tmpMeta.get('ImageRowDir') is None:
+                tmpMeta['ImageRowDir'] = ["{:.18f}".format(tmpImg.getHead().read_dir[0]), "{:.18f}".format(tmpImg.getHead().read_dir[1]), "{:.18f}".format(tmpImg.getHead().read_dir[2])]
+
+            if tmpMeta.get('ImageColumnDir') is None:
+                tmpMeta['ImageColumnDir'] = ["{:.18f}".format(tmpImg.getHead().phase_dir[0]), "{:.18f}".format(tmpImg.getHead().phase_dir[1]), "{:.18f}".format(tmpImg.getHead().phase_dir[2])]
+
+            xml = tmpMeta.serialize()
+            logging.debug("Image MetaAttributes: %s", xml)
+            tmpImg.attribute_string = xml
+            imagesOut.append(tmpImg)
 
     return imagesOut
@@ -0,0 +1,480 @@
+#!/usr/bin/python3
+
+# Micro-benchmarks for the MRD streaming classes, run over local socket pairs
+# so that no server is needed.  Each benchmark is a sub-command:
+#   python benchmark.py duplex --help
+#   python benchmark.py check --help
+#   python benchmark.py compression --help
+#   python benchmark.py savedata --help
+#   python benchmark.py sessions --help
+
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import ismrmrd
+import numpy as np
+
+import compression
+from connection import Connection
+from savedatalayout import SaveDataLayout
+
+def make_acquisition(channels, samples):
+    data = (np.random.randn(channels, samples) + 1j*np.random.randn(channels, samples)).astype(np.complex64)
+    return ismrmrd.Acquisition.from_array(data)
+
+def make_image(size):
+    image = ismrmrd.Image.from_array(np.random.randint(0, 4096, (size, size)).astype(np.int16), transpose=False)
+    image.attribute_string = ismrmrd.Meta({'DataRole': 'Image'}).serialize()
+    return image
+
+# ----- duplex -----------------------------------------------------------------
+# Simulates a server that receives k-space data while sending images back over
+# the same connection.  On the "server" Connection, one thread iterates over
+# incoming acquisitions while another sends image batches.  With a single lock
+# for reading and sending (as Connection used to have), a reader blocked waiting
+# for data stalls the sender, and vice versa.
+def run_duplex(args, sharedLock):
+    sockServer, sockClient = socket.socketpair()
+    server = Connection(sockServer, False)
+    client = Connection(sockClient, False)
+
+    if sharedLock:
+        server.readLock = server.writeLock
+
+    acq    = make_acquisition(args.channels, args.samples)
+    images = [make_image(args.image_size) for i in range(args.batch)]
+
+    def client_send():
+        # Acquisitions arrive in bursts, as they would from a scanner
+        for i in range(args.acquisitions):
+            client.send_acquisition(acq)
+            if (args.interval > 0) and ((i+1) % args.burst == 0):
+                time.sleep(args.interval/1000)
+        client.send_close()
+
+    def client_receive():
+        for item in client:
+            if item is None:
+                break
+
+    def server_send():
+        for i in range(args.image_batches):
+            server.send_image(images)
+        server.send_close()
+
+    def server_receive():
+        for item in server:
+            if item is None:
+                break
+
+    threads = [threading.Thread(target=target) for target in (client_send, client_receive, server_send, server_receive)]
+
+    tic = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    toc = time.perf_counter()
+
+    sockServer.close()
+    sockClient.close()
+
+    nbytes = args.acquisitions*(acq.data.nbytes) + args.image_batches*sum([image.data.nbytes for image in images])
+    return toc-tic, nbytes
+
+def benchmark_duplex(args):
+    logging.info("Sending %d acquisitions (%d x %d) in bursts of %d every %.1f ms and %d batches of %d images (%d x %d) in opposite directions",
+                 args.acquisitions, args.channels, args.samples, args.burst, args.interval, args.image_batches, args.batch, args.image_size, args.image_size)
+
+    for sharedLock in (True, False):
+        times = []
+        for i in range(args.repeats):
+            elapsed, nbytes = run_duplex(args, sharedLock)
+            times.append(elapsed)
+
+        elapsed = min(times)
+        logging.info("%-22s %8.1f ms  %8.1f MB/s", "Shared read/send lock:" if sharedLock else "Separate locks:", elapsed*1000, nbytes/elapsed/1e6)
+
+# ----- check ------------------------------------------------------------------
+# Regression check for the duplex send and receive paths, which exits with an
+# error if any message is received differently from how it was sent.  Like the
+# duplex benchmark, both directions are busy at the same time.  Each message is
+# compared to the bytes written by ismrmrd's own serialize_into(), so the check
+# covers the vectored sendmsg() writes (including partial writes and more than
+# IOV_MAX buffers) and the recv_into() reads into preallocated arrays.
+def serialized(item):
+    chunks = []
+    item.serialize_into(lambda data: chunks.append(bytes(data)))
+    return b''.join(chunks)
+
+def make_check_messages(rng, count):
+    # Sizes vary so that messages straddle the boundaries of partial writes
+    messages = []
+    for i in range(count):
+        kind = i % 4
+        if kind < 2:
+            channels, samples = rng.integers(1, 9), rng.integers(1, 513)
+            data = (rng.standard_normal((channels, samples)) + 1j*rng.standard_normal((channels, samples))).astype(np.complex64)
+            traj = rng.standard_normal((samples, 2)).astype(np.float32) if kind == 1 else None
+            acq  = ismrmrd.Acquisition.from_array(data, traj)
+            acq.scan_counter = i
+            messages.append(acq)
+        elif kind == 2:
+            dtype = (np.int16, np.float32, np.complex64)[i % 3]
+            image = ismrmrd.Image.from_array((rng.standard_normal((rng.integers(1, 257), rng.integers(1, 257)))*1000).astype(dtype), transpose=False)
+            image.image_index = i
+            image.attribute_string = ismrmrd.Meta({'DataRole': 'Image', 'ImageIndex': str(i)}).serialize()
+            messages.append(image)
+        else:
+            waveform = ismrmrd.Waveform.from_array(rng.integers(0, 2**32, (rng.integers(1, 5), rng.integers(1, 1025)), dtype=np.uint32))
+            waveform.scan_counter = i
+            messages.append(waveform)
+
+    # A list of images is sent in a single vectored write, which has more
+    # buffers than sendmsg() accepts at once (IOV_MAX is usually 1024)
+    batch = []
+    for i in range(512):
+        image = ismrmrd.Image.from_array(rng.integers(0, 4096, (4, 4), dtype=np.int16), transpose=False)
+        image.image_index = count + i
+        image.attribute_string = ismrmrd.Meta({'DataRole': 'Image'}).serialize()
+        batch.append(image)
+    messages.append(batch)
+    return messages
+
+def run_check(args, sendBufferSize):
+    # With a timeout, the sockets are non-blocking internally so that sendmsg()
+    # and recv_into() return after partial transfers, as they can over TCP.  It
+    # also stops a check that loses data from waiting forever
+    sockServer, sockClient = socket.socketpair()
+    sockServer.settimeout(args.timeout)
+    sockClient.settimeout(args.timeout)
+    server = Connection(sockServer, False, sendBufferSize=sendBufferSize)
+    client = Connection(sockClient, False, sendBufferSize=sendBufferSize)
+
+    rng = np.random.default_rng(args.seed)
+    toServer = make_check_messages(rng, args.messages)
+    toClient = make_check_messages(rng, args.messages)
+    received = {'server': [], 'client': []}
+
+    def flatten(messages):
+        return [image for item in messages for image in (item if isinstance(item, list) else [item])]
+
+    def send(connection, messages):
+        for item in messages:
+            if isinstance(item, ismrmrd.Acquisition):
+                connection.send_acquisition(item)
+            elif isinstance(item, (ismrmrd.Image, list)):
+                connection.send_image(item)
+            else:
+                connection.send_waveform(item)
+        connection.send_close()
+
+    def receive(connection, name):
+        for item in connection:
+            if item is None:
+                break
+            received[name].append(item)
+
+    threads = [threading.Thread(target=send,    args=(client, toServer)),
+               threading.Thread(target=send,    args=(server, toClient)),
+               threading.Thread(target=receive, args=(server, 'server')),
+               threading.Thread(target=receive, args=(client, 'client'))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    sockServer.close()
+    sockClient.close()
+
+    failures = 0
+    for name, sent in (('server', flatten(toServer)), ('client', flatten(toClient))):
+        if len(received[name]) != len(sent):
+            logging.error("sendBufferSize %d: %s received %d of %d messages", sendBufferSize, name, len(received[name]), len(sent))
+            failures += 1
+        for i, (a, b) in enumerate(zip(sent, received[name])):
+            if (type(a) is not type(b)) or (serialized(a) != serialized(b)):
+                logging.error("sendBufferSize %d: message %d received by the %s differs from the one sent (%s)", sendBufferSize, i, name, type(a).__name__)
+                failures += 1
+    return failures
+
+def check(args):
+    failures = 0
+    for sendBufferSize in args.send_buffer_sizes:
+        n = run_check(args, sendBufferSize)
+        logging.info("sendBufferSize %-8d %s", sendBufferSize, "OK" if n == 0 else "%d failures" % n)
+        failures += n
+
+    if failures > 0:
+        sys.exit(1)
+
+# ----- compression ------------------------------------------------------------
+# Measures how well each codec compresses real k-space data (e.g. a Shepp-Logan
+# phantom from generate_cartesian_shepp_logan_dataset.py) and how fast it runs.
+# Compression only reduces transfer time when the link is slower than the
+# break-even bandwidth, i.e. when the time saved sending fewer bytes is more
+# than the time spent compressing and decompressing:
+#   (raw - compressed) / bandwidth > t_compress + t_decompress
+def benchmark_compression(args):
+    with ismrmrd.Dataset(args.filename, args.in_group, create_if_needed=False) as dset:
+        count = dset.number_of_acquisitions() if args.acquisitions <= 0 else min(args.acquisitions, dset.number_of_acquisitions())
+        acqs  = [dset.read_acquisition(i) for i in range(count)]
+
+    # Serialize message bodies as they would be sent by Connection.write_acquisition()
+    bodies = []
+    for acq in acqs:
+        chunks = []
+        acq.serialize_into(lambda data: chunks.append(bytes(data)))
+        bodies.append(b''.join(chunks))
+    raw = sum([len(body) for body in bodies])
+
+    logging.info("Compressing %d acquisitions (%.1f MB) from %s", count, raw/1e6, args.filename)
+    logging.info("%-6s %5s %8s %12s %12s %14s", "Codec", "Level", "Ratio", "Compress", "Decompress", "Break-even")
+
+    for codec in compression.available_codecs():
+        codecId = compression.get_codec_id(codec)
+        levels  = args.levels if args.levels else [compression.codecs[codec]['level']]
+        for level in levels:
+            tc = []
+            td = []
+            for i in range(args.repeats):
+                tic = time.perf_counter()
+                payloads = [compression.compress(codecId, body, level) for body in bodies]
+                tc.append(time.perf_counter() - tic)
+
+                tic = time.perf_counter()
+                for payload in payloads:
+                    compression.decompress(codecId, payload)
+                td.append(time.perf_counter() - tic)
+
+            compressed = sum([len(payload) for payload in payloads])
+            tc = min(tc)
+            td = min(td)
+            if compressed < raw:
+                breakEven = "%8.1f MB/s" % ((raw - compressed)/(tc + td)/1e6)
+            else:
+                breakEven = "never"
+            logging.info("%-6s %5d %8.3f %7.1f MB/s %7.1f MB/s %14s", codec, level, raw/compressed, raw/tc/1e6, raw/td/1e6, breakEven)
+
+    logging.info("Compression is worthwhile for links slower than the break-even bandwidth")
+
+# ----- savedata ---------------------------------------------------------------
+# Writes the acquisitions of an MRD file and a series of images to a savedata
+# file through Connection (as the server does with -s, in sync mode), for
+# several HDF5 layouts.  The "ismrmrd.Dataset" row is the previous layout,
+# appending one record at a time to contiguously growing datasets.  Images are
+# smooth with some noise, like magnitude images, so they compress realistically.
+def make_smooth_image(size, index):
+    y, x = np.mgrid[0:size, 0:size]
+    data = 2000*np.exp(-((x-size/2)**2 + (y-size/2)**2)/(size*size/8)) * (1 + 0.2*np.sin(index/4 + x/7)) + np.random.normal(0, 20, (size, size))
+    return ismrmrd.Image.from_array(np.clip(data, 0, 4095).astype(np.int16), transpose=False)
+
+def run_savedata(path, layout, metadata, acqs, images):
+    if os.path.exists(path):
+        os.remove(path)
+
+    tic = time.perf_counter()
+    if layout is None:
+        with ismrmrd.Dataset(path, 'dataset') as dset:
+            dset.write_xml_header(bytes(metadata, 'utf-8'))
+            for acq in acqs:
+                dset.append_acquisition(acq)
+            for image in images:
+                dset.append_image('image_0', image)
+    else:
+        connection = Connection(None, True, path)
+        connection.savedataLayout = layout
+        connection.save_metadata(metadata)
+        for acq in acqs:
+            connection.save_acquisition(acq)
+        for image in images:
+            connection.save_image(image)
+        connection.close_save_file()
+    toc = time.perf_counter()
+
+    return toc-tic, os.path.getsize(path)
+
+def benchmark_savedata(args):
+    with ismrmrd.Dataset(args.filename, args.in_group, create_if_needed=False) as dset:
+        metadata = dset.read_xml_header().decode('utf-8')
+        acqs     = [dset.read_acquisition(i) for i in range(dset.number_of_acquisitions())]
+    images = [make_smooth_image(args.image_size, i) for i in range(args.images)]
+
+    nbytes = sum([acq.data.nbytes + acq.traj.nbytes for acq in acqs]) + sum([image.data.nbytes for image in images])
+    logging.info("Saving %d acquisitions from %s and %d images (%d x %d), %.1f MB", len(acqs), args.filename, len(images), args.image_size, args.image_size, nbytes/1e6)
+    logging.info("%-16s %10s %12s %10s", "Layout", "Time", "Throughput", "Size")
+
+    layouts = [('ismrmrd.Dataset', lambda: None),
+               ('chunked',         lambda: SaveDataLayout(None,    False, args.chunk, presize=False)),
+               ('presized',        lambda: SaveDataLayout(None,    False, args.chunk)),
+               ('gzip',            lambda: SaveDataLayout('gzip',  False, args.chunk)),
+               ('gzip+shuffle',    lambda: SaveDataLayout('gzip',  True,  args.chunk)),
+               ('lzf',             lambda: SaveDataLayout('lzf',   False, args.chunk)),
+               ('lzf+shuffle',     lambda: SaveDataLayout('lzf',   True,  args.chunk))]
+
+    with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+        path = os.path.join(folder, 'savedata.h5')
+        for name, layout in layouts:
+            times = []
+            for i in range(args.repeats):
+                elapsed, size = run_savedata(path, layout(), metadata, acqs, images)
+                times.append(elapsed)
+
+            elapsed = min(times)
+            logging.info("%-16s %7.1f ms %7.1f MB/s %7.1f MB", name, elapsed*1000, nbytes/elapsed/1e6, size/1e6)
+
+    logging.info("Compression filters do not apply to the variable length k-space data in /dataset/data")
+
+# ----- sessions ---------------------------------------------------------------
+# Runs the server (main.py) in each session mode and measures sessions from
+# several concurrent clients, which each send the acquisitions of an MRD file and
+# receive the images.  Clients are separate processes, started before the
+# timing, so that they don't compete with the server for the GIL.
+def run_session_client(port, config, metadata, acqs, barrier, results):
+    barrier.wait()
+    tic = time.perf_counter()
+
+    sock = socket.create_connection(('127.0.0.1', port))
+    connection = Connection(sock, False)
+    connection.send_config_file(config)
+    connection.send_metadata(metadata)
+
+    def receive():
+        for item in connection:
+            if item is None:
+                break
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    for acq in acqs:
+        connection.send_acquisition(acq)
+    connection.send_close()
+    receiver.join()
+    sock.close()
+
+    results.put((tic, time.perf_counter()))
+
+def wait_for_port(port, process, timeout=60):
+    tic = time.perf_counter()
+    while time.perf_counter() - tic < timeout:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with code %d" % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start listening on port %d" % port)
+
+def benchmark_sessions(args):
+    with ismrmrd.Dataset(args.filename, args.in_group, create_if_needed=False) as dset:
+        metadata = dset.read_xml_header().decode('utf-8')
+        acqs     = [dset.read_acquisition(i) for i in range(dset.number_of_acquisitions())]
+
+    modes = [('multiprocessing', lambda clients: ['--multiprocessing']),
+             ('multiprocessing -w', lambda clients: ['--multiprocessing', '--workers', str(clients)]),
+             ('threads',         lambda clients: ['--threads', str(clients)])]
+
+    logging.info("Config '%s' with %d acquisitions from %s", args.config, len(acqs), args.filename)
+    logging.info("%-20s %8s %10s %12s %12s", "Mode", "Clients", "Elapsed", "Sessions/s", "Mean session")
+
+    serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    for clients in args.clients:
+        for name, options in modes:
+            # A new server for each run, so that no run benefits from the caches of another
+            command = [sys.executable, serverPath, '-p', str(args.port), '-d', args.config, '--preload', args.config] + options(clients)
+            server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_port(args.port, server)
+
+                barrier   = multiprocessing.Barrier(clients + 1)
+                results   = multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=run_session_client, args=(args.port, args.config, metadata, acqs, barrier, results)) for i in range(clients)]
+                for process in processes:
+                    process.start()
+
+                barrier.wait()
+                times = [results.get(timeout=args.timeout) for i in range(clients)]
+                for process in processes:
+                    process.join()
+            finally:
+                server.terminate()
+                server.wait()
+
+            elapsed = max([end for start, end in times]) - min([start for start, end in times])
+            mean    = np.mean([end - start for start, end in times])
+            logging.info("%-20s %8d %7.2f s %12.2f %10.2f s", name, clients, elapsed, clients/elapsed, mean)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for MRD streaming',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    duplex = subparsers.add_parser('duplex', help='Concurrent receive and send on one Connection',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    duplex.add_argument('--acquisitions',  type=int, default=20000, help='Number of acquisitions sent to the server')
+    duplex.add_argument('--channels',      type=int, default=32,    help='Channels per acquisition')
+    duplex.add_argument('--samples',       type=int, default=256,   help='Samples per acquisition')
+    duplex.add_argument('--burst',         type=int, default=64,    help='Acquisitions sent in each burst')
+    duplex.add_argument('--interval',      type=float, default=2,   help='Pause between bursts of acquisitions (ms)')
+    duplex.add_argument('--image-batches', type=int, default=200,   help='Number of image batches sent by the server')
+    duplex.add_argument('--batch',         type=int, default=16,    help='Images per batch')
+    duplex.add_argument('--image-size',    type=int, default=256,   help='Image matrix size')
+    duplex.add_argument('--repeats',       type=int, default=3,     help='Number of runs (fastest is reported)')
+    duplex.set_defaults(func=benchmark_duplex)
+
+    chk = subparsers.add_parser('check', help='Check that messages sent in both directions at once are received unchanged (exits with an error otherwise)',
+                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    chk.add_argument('--messages',          type=int, default=2000, help='Number of messages sent in each direction')
+    chk.add_argument('--send-buffer-sizes', type=int, nargs='+', default=[0, 1<<20], help='Connection send buffer sizes to test (0 sends each message immediately)')
+    chk.add_argument('--timeout',           type=float, default=60, help='Socket timeout (s)')
+    chk.add_argument('--seed',              type=int, default=0,    help='Seed for the random message contents and sizes')
+    chk.set_defaults(func=check)
+
+    comp = subparsers.add_parser('compression', help='Compression ratio and break-even bandwidth for each codec',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    comp.add_argument('filename',                                   help='MRD file with k-space data, e.g. from generate_cartesian_shepp_logan_dataset.py')
+    comp.add_argument('-g', '--in-group',      default='dataset',  help='Input data group')
+    comp.add_argument('--acquisitions',  type=int, default=0,       help='Number of acquisitions to use (0 for all)')
+    comp.add_argument('--levels',        type=int, nargs='+',       help='Compression levels to test (default is the fast level used for streaming)')
+    comp.add_argument('--repeats',       type=int, default=3,       help='Number of runs (fastest is reported)')
+    comp.set_defaults(func=benchmark_compression)
+
+    save = subparsers.add_parser('savedata', help='Write throughput and file size of savedata HDF5 layouts',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    save.add_argument('filename',                                   help='MRD file with k-space data, e.g. from generate_cartesian_shepp_logan_dataset.py')
+    save.add_argument('-g', '--in-group',      default='dataset',  help='Input data group')
+    save.add_argument('--images',        type=int, default=256,     help='Number of images to save')
+    save.add_argument('--image-size',    type=int, default=256,     help='Image matrix size')
+    save.add_argument('--chunk',         type=int, default=0,       help='Records per chunk (0 for automatic)')
+    save.add_argument('--folder',                                   help='Folder for the test file (default is the system temporary folder)')
+    save.add_argument('--repeats',       type=int, default=3,       help='Number of runs (fastest is reported)')
+    save.set_defaults(func=benchmark_savedata)
+
+    sess = subparsers.add_parser('sessions', help='Concurrent sessions with --multiprocessing and --threads server modes',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sess.add_argument('filename',                                   help='MRD file with k-space data, e.g. from generate_cartesian_shepp_logan_dataset.py')
+    sess.add_argument('-g', '--in-group',      default='dataset',  help='Input data group')
+    sess.add_argument('-c', '--config',        default='simplefft', help='Config module run by the server')
+    sess.add_argument('--clients',       type=int, nargs='+', default=[1, 4, 16], help='Numbers of concurrent clients to test')
+    sess.add_argument('-p', '--port',    type=int, default=9020,    help='Port for the server')
+    sess.add_argument('--timeout',       type=float, default=600,   help='Time allowed for each session (s)')
+    sess.set_defaults(func=benchmark_sessions)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING, stream=sys.stdout)
+    logging.getLogger().setLevel(logging.INFO)
+
+    # Per-message logging from Connection would dominate the timings
+    logging.getLogger().handlers[0].addFilter(lambda record: record.pathname == __file__)
+
+    args.func(args)
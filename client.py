@@ -11,6 +11,7 @@ import sys
 import ismrmrd
 import multiprocessing
 from connection import Connection
+import shmring
 import time
 import os
 import json
@@ -30,10 +31,51 @@ defaults = {
     'verbose':            False,
     'logfile':            '',
     'quiet':              False,
-    'mrd2gif':            False
+    'mrd2gif':            False,
+    'send_buffer_size':   1048576,
+    'compression':        'none',
+    'compression_types':  'acquisition,image,waveform',
+    'compression_level':  None,
+    'shared_memory':      0
 }
 
-def connection_receive_loop(sock, outfile, outgroup, verbose, logfile, quiet, fixTransposed, recvAcqs, recvImages, recvWaveforms):
+def get_transport_parameters(args, sendRing, recvRing):
+    """JSON config parameters that ask the server to use compression or shared memory"""
+    parameters = {}
+    if args.compression != 'none':
+        parameters['compression']      = args.compression
+        parameters['compressionTypes'] = args.compression_types
+        if args.compression_level is not None:
+            parameters['compressionLevel'] = args.compression_level
+
+    if sendRing is not None:
+        parameters['sharedMemory']      = sendRing.name
+        parameters['sharedMemoryReply'] = recvRing.name
+
+    return parameters
+
+def add_config_parameters(configAdditionalText, parameters):
+    """Add parameters to the JSON config, creating it if configAdditionalText is None"""
+    if not parameters:
+        return configAdditionalText
+
+    if configAdditionalText is None:
+        configAdditional = {}
+    else:
+        try:
+            configAdditional = json.loads(configAdditionalText)
+        except:
+            logging.warning("configAdditional is not valid JSON -- cannot add parameters %s", ', '.join(parameters))
+            return configAdditionalText
+
+    if not 'parameters' in configAdditional:
+        configAdditional['parameters'] = {}
+
+    configAdditional['parameters'].update(parameters)
+
+    return json.dumps(configAdditional, indent=2)
+
+def connection_receive_loop(sock, outfile, outgroup, verbose, logfile, quiet, fixTransposed, recvAcqs, recvImages, recvWaveforms, recvRingName=None):
     """Start a Connection instance to receive data, generally run in a separate thread"""
 
     if verbose:
@@ -50,6 +92,12 @@ def connection_receive_loop(sock, outfile, outgroup, verbose, logfile, quiet, fi
 
     incoming_connection = Connection(sock, True, outfile, "", outgroup)
 
+    if recvRingName is not None:
+        try:
+            incoming_connection.enable_shared_memory(recvRing=shmring.SharedMemoryRing.attach(recvRingName, track=True))
+        except Exception as e:
+            logging.error("Not receiving data through shared memory: %s", e)
+
     if fixTransposed:
         logging.warning('fix-transposed is True -- received images may be transposed if needed to ensure uniform dimensions across all images in a series')
         incoming_connection.fixTransposed = True
@@ -64,6 +112,7 @@ def connection_receive_loop(sock, outfile, outgroup, verbose, logfile, quiet, fi
         except:
             pass
         sock.close()
+        incoming_connection.close_shared_memory()
         logging.debug("Socket closed (reader)")
 
         # Dataset may not be closed properly if a close message is not received
@@ -199,13 +248,27 @@ def main(args):
     recvAcqs      = multiprocessing.Value('i', 0)
     recvImages    = multiprocessing.Value('i', 0)
     recvWaveforms = multiprocessing.Value('i', 0)
-    process = multiprocessing.Process(target=connection_receive_loop, args=(sock, args.outfile, args.out_group, args.verbose, args.logfile, args.quiet, args.fix_transposed, recvAcqs, recvImages, recvWaveforms))
+
+    # Shared memory rings for each direction.  They are only used once the
+    # server has attached to them, so a remote server simply gets data over the socket.
+    sendRing = None
+    recvRing = None
+    if args.shared_memory > 0:
+        sendRing = shmring.SharedMemoryRing.create(args.shared_memory*1024*1024)
+        recvRing = shmring.SharedMemoryRing.create(args.shared_memory*1024*1024)
+
+    process = multiprocessing.Process(target=connection_receive_loop, args=(sock, args.outfile, args.out_group, args.verbose, args.logfile, args.quiet, args.fix_transposed, recvAcqs, recvImages, recvWaveforms, recvRing.name if recvRing is not None else None))
     process.daemon = True
     process.start()
 
     # This connection is only used for outgoing data.  It should not be used for
     # writing to the HDF5 file as multi-threading issues can occur
-    connection = Connection(sock, False)
+    connection = Connection(sock, False, sendBufferSize=args.send_buffer_size)
+    if args.compression != 'none':
+        connection.enable_compression(args.compression, args.compression_types, args.compression_level)
+    if sendRing is not None:
+        connection.enable_shared_memory(sendRing=sendRing)
+    transportParameters = get_transport_parameters(args, sendRing, recvRing)
 
     # --------------- Send config -----------------------------
     if (args.config_local):
@@ -256,8 +319,14 @@ def main(args):
 
                         configAdditionalText = json.dumps(configAdditional, indent=2)
 
+                configAdditionalText = add_config_parameters(configAdditionalText, transportParameters)
                 logging.info("Sending configAdditional found in file %s:\n%s", args.filename, configAdditionalText)
                 connection.send_text(configAdditionalText)
+            elif transportParameters:
+                # No additional config in local .json file or in MRD file, but one is needed to request compression or shared memory
+                configAdditionalText = add_config_parameters(None, transportParameters)
+                logging.info("Sending configAdditional:\n%s", configAdditionalText)
+                connection.send_text(configAdditionalText)
             else:
                 # Do nothing -- no additional config in local .json file or in MRD file
                 pass
@@ -280,6 +349,7 @@ def main(args):
 
                     localConfigAdditionalText = json.dumps(localConfigAdditional, indent=2)
 
+            localConfigAdditionalText = add_config_parameters(localConfigAdditionalText, transportParameters)
             logging.info("Sending configAdditional found in file %s:\n%s", configAdditionalFile, localConfigAdditionalText)
             connection.send_text(localConfigAdditionalText)
 
@@ -342,6 +412,9 @@ def main(args):
     process.join()
 
     sock.close()
+    connection.close_shared_memory()
+    if recvRing is not None:
+        recvRing.close()
     logging.info("Socket closed (writer)")
 
     # Save a copy of the MRD XML header now that the connection thread is finished with the file
@@ -392,6 +465,11 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--logfile',            type=str,            help='Path to log file')
     parser.add_argument('-q', '--quiet',              action='store_true', help='Suppress stdout logging')
     parser.add_argument(      '--ignore-json-config', action='store_true', help='Ignore config specified in JSON')
+    parser.add_argument(      '--send-buffer-size',   type=int,            help='Bytes of outgoing data to coalesce before sending (0 to send each message immediately)')
+    parser.add_argument(      '--compression',        choices=['none', 'zlib', 'lzma', 'lz4'], help='Compress data messages in both directions (server must support MRD_MESSAGE_COMPRESSED)')
+    parser.add_argument(      '--compression-types',  type=str,            help='Comma separated list of message types to compress (acquisition, image, waveform)')
+    parser.add_argument(      '--compression-level',  type=int,            help='Codec specific compression level (default is a fast setting)')
+    parser.add_argument(      '--shared-memory',      type=int,            help='Size (MB) of shared memory rings used to pass data to a server on the same host (0 to disable)')
     parser.add_argument(      '--mrd2gif',            action='store_true', help='Run mrd2gif on output file')
 
     parser.set_defaults(**defaults)
@@ -0,0 +1,65 @@
+# Payload compression for MRD_MESSAGE_COMPRESSED messages
+import constants
+
+import zlib
+import lzma
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Default levels favour speed, as compression is done inline while streaming
+codecs = {
+    'zlib': {'id': constants.MRD_COMPRESSION_ZLIB, 'level': 1},
+    'lzma': {'id': constants.MRD_COMPRESSION_LZMA, 'level': 0},
+    'lz4':  {'id': constants.MRD_COMPRESSION_LZ4,  'level': 0},
+}
+
+# Names used in the "compressionTypes" config parameter
+message_types = {
+    'acquisition': constants.MRD_MESSAGE_ISMRMRD_ACQUISITION,
+    'image':       constants.MRD_MESSAGE_ISMRMRD_IMAGE,
+    'waveform':    constants.MRD_MESSAGE_ISMRMRD_WAVEFORM,
+}
+
+def available_codecs():
+    """List of codec names that can be used in this environment"""
+    return [name for name in codecs if (name != 'lz4') or (lz4 is not None)]
+
+def get_codec_id(name):
+    if name not in available_codecs():
+        raise ValueError("Unsupported compression codec '%s' (available: %s)" % (name, ', '.join(available_codecs())))
+    return codecs[name]['id']
+
+def parse_message_types(types):
+    """Convert a comma separated string (or list) of message type names into a set of message IDs"""
+    if isinstance(types, str):
+        types = [type.strip() for type in types.split(',') if type.strip() != '']
+
+    ids = set()
+    for type in types:
+        if type not in message_types:
+            raise ValueError("Unsupported compression message type '%s' (available: %s)" % (type, ', '.join(message_types)))
+        ids.add(message_types[type])
+    return ids
+
+def compress(codecId, data, level=None):
+    if codecId == constants.MRD_COMPRESSION_ZLIB:
+        return zlib.compress(data, codecs['zlib']['level'] if level is None else level)
+    elif codecId == constants.MRD_COMPRESSION_LZMA:
+        return lzma.compress(data, preset=codecs['lzma']['level'] if level is None else level)
+    elif (codecId == constants.MRD_COMPRESSION_LZ4) and (lz4 is not None):
+        return lz4.frame.compress(data, compression_level=codecs['lz4']['level'] if level is None else level)
+    else:
+        raise ValueError("Unsupported compression codec %d" % codecId)
+
+def decompress(codecId, data):
+    if codecId == constants.MRD_COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    elif codecId == constants.MRD_COMPRESSION_LZMA:
+        return lzma.decompress(data)
+    elif (codecId == constants.MRD_COMPRESSION_LZ4) and (lz4 is not None):
+        return lz4.frame.decompress(data)
+    else:
+        raise ValueError("Unsupported compression codec %d" % codecId)
@@ -0,0 +1,128 @@
+# Registry of the config modules that the server can run, see Server.process()
+import importlib
+import importlib.util
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+# A config module is a .py file with a top level process(connection, config, metadata)
+PROCESS_PATTERN = re.compile(rb'^def\s+process\s*\(\s*connection\b', re.MULTILINE)
+
+class ConfigRegistry:
+    """
+    Finds and imports config modules by name.
+
+    discover() lists the config modules in the folders searched (the server's
+    folder, its custom/ folder and any added with --configFolder, which are
+    also added to the Python path).  preload() imports modules when the server starts, so that
+    sessions, including those in forked worker processes, don't pay for the
+    import.  If a module has a warmup() function, it can be called then too,
+    e.g. to initialize libraries or caches.
+
+    get() returns a module, importing it on first use like importlib and
+    reloading it when its file has been modified since it was imported, so a
+    new version of a module can be deployed without restarting the server.
+    """
+
+    def __init__(self, folders=None):
+        serverFolder = os.path.dirname(os.path.abspath(__file__))
+        customFolder = os.path.join(serverFolder, 'custom')
+
+        self.folders = [serverFolder]
+        for folder in ([customFolder] if os.path.isdir(customFolder) else []) + list(folders or []):
+            folder = os.path.abspath(folder)
+            if folder not in self.folders:
+                self.folders.append(folder)
+            if folder not in sys.path:
+                sys.path.append(folder)
+
+        self.modules = {}    # name: (module, mtime)
+        self.lock    = threading.Lock()
+
+    def __getstate__(self):
+        # Modules can't be pickled (e.g. for the spawn start method), so they
+        # are imported again as needed in the new process
+        return {'folders': self.folders}
+
+    def __setstate__(self, state):
+        self.folders = state['folders']
+        for folder in self.folders:
+            if folder not in sys.path:
+                sys.path.append(folder)
+        self.modules = {}
+        self.lock    = threading.Lock()
+
+    def discover(self):
+        """Names of the config modules in the searched folders"""
+        names = []
+        for folder in self.folders:
+            try:
+                files = sorted(os.listdir(folder))
+            except OSError as e:
+                logging.warning("Could not search config folder '%s': %s", folder, e)
+                continue
+
+            for file in files:
+                name, ext = os.path.splitext(file)
+                if (ext != '.py') or (name in names) or not name.isidentifier():
+                    continue
+                try:
+                    with open(os.path.join(folder, file), 'rb') as f:
+                        if PROCESS_PATTERN.search(f.read()):
+                            names.append(name)
+                except OSError:
+                    pass
+        return names
+
+    def preload(self, names, warmup=False):
+        """Import (and optionally warm up) config modules.  Modules that fail to import are skipped."""
+        for name in names:
+            tic = time.perf_counter()
+            module = self.get(name)
+            if module is None:
+                continue
+
+            if warmup and callable(getattr(module, 'warmup', None)):
+                try:
+                    module.warmup()
+                except Exception as e:
+                    logging.warning("Warmup of config module '%s' failed: %s", name, e)
+
+            logging.debug("Preloaded config module '%s' in %.0f ms", name, (time.perf_counter()-tic)*1000)
+
+    def get(self, name):
+        """
+        Return the config module, or None if it doesn't exist or fails to import.
+        Only the config module itself is reloaded when its file changes, not
+        modules that it imports.
+        """
+        with self.lock:
+            try:
+                if name in self.modules:
+                    module, mtime = self.modules[name]
+                    if self.get_mtime(module) != mtime:
+                        logging.info("Config module '%s' has changed -- reloading", name)
+                        module = importlib.reload(module)
+                elif name in sys.modules:
+                    module = sys.modules[name]
+                elif importlib.util.find_spec(name) is None:
+                    return None
+                else:
+                    module = importlib.import_module(name)
+            except Exception as e:
+                # A module that fails to reload is retried by the next get()
+                logging.error("Failed to load config '%s' with error:\n  %s", name, e)
+                return None
+
+            self.modules[name] = (module, self.get_mtime(module))
+            return module
+
+    @staticmethod
+    def get_mtime(module):
+        try:
+            return os.stat(module.__file__).st_mtime_ns
+        except (OSError, TypeError, AttributeError):
+            return None
@@ -1,18 +1,38 @@
 import constants
+import compression
+import tracing
+import mrdhelper
+import serverlog
+import shmring
+from lazyimage import LazyImage
+from savedatawriter import SaveDataWriter
+from savedatalayout import SaveDataLayout
 import ismrmrd
 import ctypes
 import os
 from datetime import datetime
 import h5py
+import ismrmrd.hdf5
 import random
 import threading
+import collections
+import time
 
 import logging
 import socket
 import numpy as np
 
+# Maximum number of buffers passed to a single sendmsg() call
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# Message type names used in statistics, e.g. 'ISMRMRD_IMAGE'
+MESSAGE_NAMES = {id: name[len('MRD_MESSAGE_'):] for name, id in vars(constants).items() if name.startswith('MRD_MESSAGE_') and isinstance(id, int)}
+
 class Connection:
-    def __init__(self, socket, savedata, savedataFile = "", savedataFolder = "", savedataGroup = "dataset"):
+    def __init__(self, socket, savedata, savedataFile = "", savedataFolder = "", savedataGroup = "dataset", sendBufferSize = 0):
         self.savedata       = savedata
         self.savedataFile   = savedataFile
         self.savedataFolder = savedataFolder
@@ -20,6 +40,21 @@ class Connection:
         self.fixTransposed  = False
         self.mrdFilePath    = None
         self.dset           = None
+
+        # How the savedata file is written: 'sync' writes in the receiving thread,
+        # 'async' queues writes to a SaveDataWriter thread, and 'durable' also waits
+        # for the file to be written and synced to disk when the close is received
+        self.savedataMode   = 'sync'
+        self.savedataWriter = None
+
+        # Chunking, compression and pre-sizing of the datasets in the file
+        self.savedataLayout = SaveDataLayout()
+
+        # Shape, dtype, image count and number of transposed images of each image
+        # series in the savedata file, so that incoming images can be checked
+        # against the series without reading the file
+        self.savedSeries    = {}
+
         self.socket         = socket
         self.is_exhausted   = False
         self.sentAcqs       = 0
@@ -28,7 +63,82 @@ class Connection:
         self.recvAcqs       = 0
         self.recvImages     = 0
         self.recvWaveforms  = 0
-        self.lock           = threading.Lock()
+
+        # Per message type counters and timings, see get_stats().  recvTime and
+        # sendTime are the time spent blocked in the socket, which is subtracted
+        # from the time spent handling a message to give the (de)serialization time
+        self.messageStats     = {}
+        self.startTime        = time.perf_counter()
+        self.recvTime         = 0.0
+        self.recvBytes        = 0
+        self.sendTime         = 0.0
+        self.queuedBytes      = 0
+        self.sendStatsOnClose = False
+        self.firstImageTime   = None
+
+        # Lines logged for each acquisition, image and waveform are rate-limited
+        self.messageLog       = serverlog.MessageLog()
+        self.messageSummaryLogged = False
+
+        # Timeline of the session's messages and savedata writes, see tracing.SessionTrace
+        self.trace            = tracing.NULL_TRACE
+        self.tracedSaves      = {}
+
+        # Time spent in each stage of the config module, see mrdhelper.stage()
+        self.stageTimes       = mrdhelper.StageTimes()
+
+        # Memory used by the session and the limit it ran with, see memoryusage.SessionMemory
+        self.memory           = None
+
+        # Return received images as LazyImage, which parses the attributes only
+        # when they are used and can be sent back without re-serializing
+        self.lazyImages       = False
+
+        # Reading and sending use independent locks so that a thread receiving
+        # data isn't blocked by another thread sending (and vice versa)
+        self.readLock       = threading.Lock()
+        self.writeLock      = threading.RLock()
+
+        # Outgoing messages are gathered into a list of buffers and sent with a
+        # single vectored write.  Data messages (acquisitions, images, waveforms)
+        # are held until at least sendBufferSize bytes are pending; control
+        # messages (config, metadata, text, close) are always sent immediately.
+        # A sendBufferSize of 0 sends each message (or list of images) as soon
+        # as it has been serialized.
+        self.sendBufferSize  = sendBufferSize
+        self.sendBuffer      = []
+        self.sendBufferBytes = 0
+
+        # Header of an acquisition that has been read by read_acquisition_batch()
+        # but not yet returned because it did not fit into the current batch
+        self.pendingAcquisitionHeader = None
+
+        # Identifier consumed by peek_mrd_message_identifier() but not yet handled
+        self.peekedIdentifier         = None
+
+        # Optional compression of outgoing data messages, see enable_compression().
+        # Incoming MRD_MESSAGE_COMPRESSED messages are always accepted and are
+        # read from inflatedBuffer while they are being deserialized
+        self.compressionCodec = None
+        self.compressionLevel = None
+        self.compressedTypes  = set()
+        self.inflatedBuffer   = None
+        self.inflatedOffset   = 0
+
+        # Optional shared memory rings for message payloads, see enable_shared_memory()
+        self.sendRing          = None
+        self.recvRing          = None
+        self.recvRingId        = None    # ID of the last message received through recvRing
+
+        # Optional background reader, see start_prefetch()
+        self.prefetchThread    = None
+        self.prefetchQueue     = collections.deque()
+        self.prefetchCondition = threading.Condition()
+        self.prefetchDepth     = 0
+        self.prefetchMaxBytes  = 0
+        self.prefetchBytes     = 0
+        self.prefetchDone      = False
+
         self.handlers       = {
             constants.MRD_MESSAGE_CONFIG_FILE:         self.read_config_file,
             constants.MRD_MESSAGE_CONFIG_TEXT:         self.read_config_text,
@@ -37,7 +147,9 @@ class Connection:
             constants.MRD_MESSAGE_TEXT:                self.read_text,
             constants.MRD_MESSAGE_ISMRMRD_ACQUISITION: self.read_acquisition,
             constants.MRD_MESSAGE_ISMRMRD_WAVEFORM:    self.read_waveform,
-            constants.MRD_MESSAGE_ISMRMRD_IMAGE:       self.read_image
+            constants.MRD_MESSAGE_ISMRMRD_IMAGE:       self.read_image,
+            constants.MRD_MESSAGE_COMPRESSED:          self.read_compressed,
+            constants.MRD_MESSAGE_SHARED_MEMORY:       self.read_shared_memory
         }
 
     def create_save_file(self):
@@ -56,15 +168,121 @@ class Connection:
             logging.info("Incoming data will be saved to: '%s' in group '%s'", self.mrdFilePath, self.savedataGroup)
             self.dset = ismrmrd.Dataset(self.mrdFilePath, self.savedataGroup)
             self.dset._file.require_group(self.savedataGroup)
+            self.load_saved_series()
+
+            if self.uses_savedata_writer() and (self.savedataWriter is None):
+                self.savedataWriter = SaveDataWriter()
+
+    def uses_savedata_writer(self):
+        return self.savedataMode != 'sync'
+
+    def load_saved_series(self):
+        # Image series already in the file, if savedataFile is an existing file
+        self.savedSeries = {}
+        for name in self.dset.list():
+            if name.startswith('image_') and name[6:].isdigit() and ('data' in self.dset._dataset[name]):
+                data = self.dset._dataset[name]['data']
+                self.savedSeries[name] = {'shape': data.shape[1:], 'dtype': data.dtype, 'count': data.shape[0], 'transposed': 0}
 
     def save_additional_config(self, configAdditionalText):
         if self.savedata is True:
             if self.dset is None:
                 self.create_save_file()
 
-            self.dset._file.require_group("dataset")
-            dsetConfigAdditional = self.dset._dataset.require_dataset('configAdditional',shape=(1,), dtype=h5py.special_dtype(vlen=bytes))
-            dsetConfigAdditional[0] = bytes(configAdditionalText, 'utf-8')
+            self.save(Connection.write_string, self.dset, 'configAdditional', configAdditionalText)
+
+    # ----- Savedata file writes -----------------------------------------------
+    # Writes to the savedata file are run through save() and save_rows(), which
+    # call them directly in 'sync' mode or queue them to the SaveDataWriter
+    # thread otherwise.  Queued rows for the same dataset are merged so that the
+    # file is resized and written once per batch.  Received data is copied into
+    # the queued rows, as it may be modified by the config module before it is
+    # written.
+    def save(self, func, *args):
+        func = self.traced_save(func)
+        if self.savedataWriter is None:
+            func(*args)
+        else:
+            self.savedataWriter.call(func, *args)
+
+    def save_rows(self, func, args, key, rows, nbytes):
+        func = self.traced_save(func)
+        if self.savedataWriter is None:
+            func(*args, [rows])
+        else:
+            self.savedataWriter.append(func, args, key, rows, nbytes)
+
+    def traced_save(self, func):
+        # The same wrapper is returned for each function, so that the writer
+        # still merges consecutive appends
+        if not self.trace.enabled:
+            return func
+        if func not in self.tracedSaves:
+            self.tracedSaves[func] = self.trace.wrap(func, func.__name__, 'savedata')
+        return self.tracedSaves[func]
+
+    def copy_for_save(self, array):
+        return array.copy() if self.savedataWriter is not None else array
+
+    def wait_for_save(self):
+        # Raises if a queued write has failed
+        if self.savedataWriter is not None:
+            self.savedataWriter.wait()
+
+    def stop_savedata_writer(self):
+        if self.savedataWriter is not None:
+            self.savedataWriter.stop()
+            self.savedataWriter = None
+
+    @staticmethod
+    def write_string(dset, name, text):
+        dset._file.require_group(dset._dataset_name)
+        dsetString = dset._dataset.require_dataset(name, shape=(1,), dtype=h5py.special_dtype(vlen=bytes))
+        dsetString[0] = bytes(text, 'utf-8')
+
+    @staticmethod
+    def append_rows(dset, layout, name, dtype, items):
+        # Equivalent to Dataset.append_acquisition() or append_waveform() for
+        # each row, but with a single write of the HDF5 dataset
+        rows = items[0] if len(items) == 1 else np.concatenate(items)
+
+        dset._file.require_group(dset._dataset_name)
+        layout.append(dset._dataset, name, rows, dtype, layout.expectedAcquisitions if name == 'data' else 0)
+
+    @staticmethod
+    def append_images(dset, layout, impath, items):
+        # Equivalent to Dataset.append_image() for each image, where items are
+        # (headers, attributes, data) tuples from image_rows()
+        headers    = np.concatenate([item[0] for item in items])
+        attributes = [attribute for item in items for attribute in item[1]]
+        data       = items[0][2] if len(items) == 1 else np.concatenate([item[2] for item in items])
+
+        dset._file.require_group(dset._dataset_name)
+        group = dset._dataset.require_group(impath)
+        layout.append(group, 'header',     headers,                            ismrmrd.hdf5.image_header_dtype, layout.expectedImages)
+        layout.append(group, 'attributes', np.array(attributes, dtype=object), h5py.special_dtype(vlen=str),    layout.expectedImages)
+        layout.append(group, 'data',       data,                               data.dtype,                      layout.expectedImages)
+
+    @staticmethod
+    def close_dataset(dset, layout, durable=False):
+        filename = dset._file.filename
+        layout.finish(dset)
+        dset.close()
+
+        if durable:
+            # Flush the file and its directory entry to disk
+            for path, flags in ((filename, os.O_RDONLY), (os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))):
+                try:
+                    fd = os.open(path, flags)
+                except OSError:
+                    continue
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    pass
+                finally:
+                    os.close(fd)
+            logging.debug("Synced file %s to disk", filename)
 
     def send_logging(self, level, contents):
         try:
@@ -76,6 +294,13 @@ class Connection:
         self.send_text(formatted_contents)
 
     def __iter__(self):
+        if self.prefetchThread is not None:
+            # The reader thread marks the connection as exhausted as soon as it
+            # has read the close message, so keep going until the queue is drained
+            while not self.prefetchDone:
+                yield self.next()
+            return
+
         while not self.is_exhausted:
             yield self.next()
 
@@ -83,29 +308,404 @@ class Connection:
         return self.next()
 
     def read(self, nbytes):
-        return self.socket.recv(nbytes, socket.MSG_WAITALL)
+        if self.inflatedBuffer is not None:
+            return self.read_inflated(nbytes)
+
+        tic = time.perf_counter()
+        data = self.socket.recv(nbytes, socket.MSG_WAITALL)
+
+        # MSG_WAITALL can still return early, e.g. if interrupted by a signal or
+        # if the socket has a timeout, so keep reading until the other end closes
+        if 0 < len(data) < nbytes:
+            chunks = [data]
+            nread  = len(data)
+            while nread < nbytes:
+                chunk = self.socket.recv(nbytes - nread, socket.MSG_WAITALL)
+                if len(chunk) == 0:
+                    break
+                chunks.append(chunk)
+                nread += len(chunk)
+            data = b''.join(chunks)
+        self.recvTime  += time.perf_counter() - tic
+        self.recvBytes += len(data)
+        return data
+
+    def read_into(self, array):
+        if self.inflatedBuffer is not None:
+            array.reshape(-1).view(np.uint8)[:] = np.frombuffer(self.read_inflated_view(array.nbytes), dtype=np.uint8)
+            return
+
+        # Receive directly into the memory of a preallocated (contiguous) ndarray,
+        # avoiding the intermediate bytes object and copy of read()
+        buffer = memoryview(array.reshape(-1).view(np.uint8))
+        nbytes = len(buffer)
+        nread  = 0
+        tic    = time.perf_counter()
+        try:
+            while nread < nbytes:
+                n = self.socket.recv_into(buffer[nread:], nbytes - nread, socket.MSG_WAITALL)
+                if n == 0:
+                    raise ConnectionResetError("Connection closed after %d of %d bytes were received" % (nread, nbytes))
+                nread += n
+        finally:
+            self.recvTime  += time.perf_counter() - tic
+            self.recvBytes += nread
+
+    def read_inflated(self, nbytes):
+        return self.read_inflated_view(nbytes).tobytes()
+
+    def read_inflated_view(self, nbytes):
+        data = self.inflatedBuffer[self.inflatedOffset:self.inflatedOffset+nbytes]
+        self.inflatedOffset += len(data)
+        return data
+
+    def enable_compression(self, codec, messageTypes=('acquisition', 'image', 'waveform'), level=None):
+        """
+        Compress outgoing messages of the given types, sending them wrapped in MRD_MESSAGE_COMPRESSED
+            - codec        : 'zlib', 'lzma' or 'lz4' (if the lz4 package is installed)
+            - messageTypes : list or comma separated string of 'acquisition', 'image', 'waveform'
+            - level        : codec specific compression level, or None for a fast default
+        """
+        self.compressionCodec = compression.get_codec_id(codec)
+        self.compressionLevel = level
+        self.compressedTypes  = compression.parse_message_types(messageTypes)
+        logging.info("Compressing outgoing %s messages with %s", ', '.join([name for name, id in compression.message_types.items() if id in self.compressedTypes]), codec)
+
+    def enable_shared_memory(self, sendRing=None, recvRing=None):
+        """
+        Pass data message payloads through shared memory when the other end of
+        the connection is on the same host.  Only a small MRD_MESSAGE_SHARED_MEMORY
+        descriptor is sent over the socket for each message.
+            - sendRing : shmring.SharedMemoryRing for outgoing messages
+            - recvRing : shmring.SharedMemoryRing for incoming messages
+
+        Outgoing messages go through the socket as usual until the reader of
+        sendRing has attached to it, and whenever the ring is full, so data is
+        never lost if the peer can't map the segment.  The rings are closed by
+        shutdown_close().
+        """
+        self.sendRing = sendRing
+        self.recvRing = recvRing
+        if recvRing is not None:
+            recvRing.set_reader_attached()
+            logging.info("Receiving data through shared memory '%s'", recvRing.name)
+        if sendRing is not None:
+            logging.info("Sending data through shared memory '%s'", sendRing.name)
+
+    def close_shared_memory(self):
+        for ring in (self.sendRing, self.recvRing):
+            if ring is not None:
+                try:
+                    ring.close()
+                except:
+                    logging.warning("Failed to close shared memory '%s'", ring.name)
+        self.sendRing = None
+        self.recvRing = None
+
+    def write_message(self, id, serialize_into):
+        # Write an identifier and the message body produced by serialize_into(write),
+        # passing the body through shared memory or compressing it if enabled
+        if (self.sendRing is not None) and self.sendRing.is_reader_attached():
+            chunks = []
+            serialize_into(lambda data: chunks.append(data if isinstance(data, (bytes, bytearray, memoryview)) else bytes(data)))
+            length   = sum([len(chunk) for chunk in chunks])
+            position = self.sendRing.write(chunks, length)
+            if position is not None:
+                self.write(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_SHARED_MEMORY))
+                self.write(constants.MrdMessageSharedMemoryHeader.pack(id, position, length))
+                self.queuedBytes += length
+                return
+
+            # Ring is full, so send this message over the socket
+            def serialize_into(write):
+                for chunk in chunks:
+                    write(chunk)
 
-    def peek(self, nbytes):
-        return self.socket.recv(nbytes, socket.MSG_PEEK)
+        if id not in self.compressedTypes:
+            self.write(constants.MrdMessageIdentifier.pack(id))
+            serialize_into(self.write)
+            return
+
+        chunks = []
+        serialize_into(lambda data: chunks.append(bytes(data)))
+        body = b''.join(chunks)
+        payload = compression.compress(self.compressionCodec, body, self.compressionLevel)
+
+        self.write(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_COMPRESSED))
+        self.write(constants.MrdMessageCompressedHeader.pack(id, self.compressionCodec, len(body), len(payload)))
+        self.write(payload)
+
+    def write(self, data):
+        # Queue data for the next flush().  ctypes headers are copied since the
+        # caller may modify them before the buffer is sent.  Views of arrays
+        # (e.g. LazyImage data) are sent without a copy when each message is
+        # flushed right away, but copied if held in the send buffer
+        if not isinstance(data, (bytes, bytearray, memoryview)) or ((self.sendBufferSize > 0) and not isinstance(data, bytes)):
+            data = bytes(data)
+        if len(data) == 0:
+            return
+        self.sendBuffer.append(data)
+        self.sendBufferBytes += len(data)
+        self.queuedBytes     += len(data)
+
+    def take_send_buffer(self, force=True):
+        # Returns the pending buffers (and clears them) if they are due to be
+        # sent according to the flush policy, otherwise None
+        if (self.sendBufferBytes == 0) or ((force is False) and (self.sendBufferBytes < self.sendBufferSize)):
+            return None
+
+        buffers = [memoryview(buf).cast('B') for buf in self.sendBuffer]
+        self.sendBuffer      = []
+        self.sendBufferBytes = 0
+        return buffers
+
+    def flush(self, force=True):
+        with self.writeLock:
+            buffers = self.take_send_buffer(force)
+            if buffers is None:
+                return
+
+            tic = time.perf_counter()
+            try:
+                self.send_buffers(buffers)
+            finally:
+                self.sendTime += time.perf_counter() - tic
+
+    def send_buffers(self, buffers):
+        if not hasattr(self.socket, 'sendmsg'):
+            # sendmsg() is not available in Windows
+            self.socket.sendall(b''.join(buffers))
+            return
+
+        # sendmsg() may return after a partial write, so advance through the
+        # buffers until everything has been sent
+        while buffers:
+            nsent = self.socket.sendmsg(buffers[:IOV_MAX])
+            while nsent > 0:
+                if nsent >= len(buffers[0]):
+                    nsent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = buffers[0][nsent:]
+                    nsent = 0
 
     def next(self):
-        with self.lock:
-            id = self.read_mrd_message_identifier()
+        if self.prefetchThread is not None:
+            return self.next_prefetched()
+
+        with self.readLock:
+            return self.read_message()
+
+    def read_message(self):
+        start = self.stats_snapshot()
+        if self.pendingAcquisitionHeader is not None:
+            item = self.read_acquisition()
+            self.record_received(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, start)
+            return item
+
+        id = self.read_mrd_message_identifier()
+
+        if (self.is_exhausted == True):
+            return
+
+        handler = self.handlers.get(id, lambda: Connection.unknown_message_identifier(id))
+        item = handler()
+        self.record_received(self.get_recorded_id(id), start)
+        return item
+
+    # ----- Statistics -----------------------------------------------------------
+    # Time spent waiting for the socket (including waiting for the other end to
+    # send data) is recorded separately from the time spent (de)serializing
+    # messages, so that the remaining time of a session can be attributed to
+    # processing.  Received MRD_MESSAGE_COMPRESSED messages are counted under
+    # the wrapper, as that is what was sent over the socket.  Messages passed
+    # through shared memory are counted under their own ID, including the
+    # payload in the ring.
+    def stats_snapshot(self):
+        return (time.perf_counter(), self.recvTime, self.recvBytes, self.sendTime, self.queuedBytes)
+
+    def get_recorded_id(self, id):
+        # ID under which a received message is counted
+        if id == constants.MRD_MESSAGE_SHARED_MEMORY:
+            return self.recvRingId
+        return id
+
+    def get_message_stats(self, id):
+        name = MESSAGE_NAMES.get(id, str(id))
+        if name not in self.messageStats:
+            self.messageStats[name] = {'received': 0, 'receivedBytes': 0, 'recvWait': 0.0, 'deserialize': 0.0,
+                                       'sent':     0, 'sentBytes':     0, 'sendWait': 0.0, 'serialize':   0.0}
+        return self.messageStats[name]
+
+    def record_received(self, id, start, count=1):
+        elapsed  = time.perf_counter() - start[0]
+        recvWait = self.recvTime - start[1]
+
+        stats = self.get_message_stats(id)
+        stats['received']      += count
+        stats['receivedBytes'] += self.recvBytes - start[2]
+        stats['recvWait']      += recvWait
+        stats['deserialize']   += elapsed - recvWait
+
+        if self.trace.enabled:
+            self.trace.add('receive ' + MESSAGE_NAMES.get(id, str(id)), 'receive', start[0], start[0] + elapsed, {'count': count, 'recvWait_ms': recvWait*1000})
+
+    def record_sent(self, id, start, count=1):
+        elapsed  = time.perf_counter() - start[0]
+        sendWait = self.sendTime - start[3]
+
+        stats = self.get_message_stats(id)
+        stats['sent']      += count
+        stats['sentBytes'] += self.queuedBytes - start[4]
+        stats['sendWait']  += sendWait
+        stats['serialize'] += elapsed - sendWait
+
+        if self.trace.enabled:
+            self.trace.add('send ' + MESSAGE_NAMES.get(id, str(id)), 'send', start[0], start[0] + elapsed, {'count': count, 'sendWait_ms': sendWait*1000})
+
+    def get_stats(self):
+        """
+        Counters and timings (in seconds) for this connection, as a dict:
+            - elapsed     : time since the connection was created
+            - recvWait    : time blocked receiving from the socket
+            - deserialize : time spent deserializing (and saving) received messages
+            - sendWait    : time blocked sending to the socket
+            - serialize   : time spent serializing sent messages
+            - other       : remaining time, e.g. spent in the recon module
+            - messages    : dict of the above (and message/byte counts) for each message type
+        """
+        # Items are listed first, as the metrics thread reads them while the session runs
+        messages = {name: dict(stats) for name, stats in list(self.messageStats.items())}
+        stats = {'elapsed': time.perf_counter() - self.startTime}
+        for key in ('recvWait', 'deserialize', 'sendWait', 'serialize'):
+            stats[key] = sum([message[key] for message in messages.values()])
+        stats['other']    = stats['elapsed'] - stats['recvWait'] - stats['deserialize'] - stats['sendWait'] - stats['serialize']
+        stats['messages'] = messages
+        return stats
+
+    def format_stats(self):
+        stats = self.get_stats()
+        lines = ["Connection statistics (%.3f s elapsed, %.3f s waiting to receive, %.3f s deserializing, %.3f s waiting to send, %.3f s serializing, %.3f s other)"
+                 % (stats['elapsed'], stats['recvWait'], stats['deserialize'], stats['sendWait'], stats['serialize'], stats['other'])]
+        lines.append("%-22s %8s %10s %9s %9s %8s %10s %9s %9s" % ("Message", "Recv", "Recv MB", "Wait s", "Deser s", "Sent", "Sent MB", "Wait s", "Ser s"))
+        for name, message in stats['messages'].items():
+            lines.append("%-22s %8d %10.2f %9.3f %9.3f %8d %10.2f %9.3f %9.3f" % (name, message['received'], message['receivedBytes']/1e6, message['recvWait'], message['deserialize'],
+                                                                               message['sent'], message['sentBytes']/1e6, message['sendWait'], message['serialize']))
+        return "\n".join(lines)
+
+    def format_stage_times(self):
+        # Stages recorded by the config module, with the time spent serializing
+        # and sending images, or None if the config module has no stages
+        if len(self.stageTimes.stages) == 0:
+            return None
+
+        extra  = {}
+        images = self.messageStats.get(MESSAGE_NAMES[constants.MRD_MESSAGE_ISMRMRD_IMAGE])
+        if (images is not None) and (images['sent'] > 0):
+            extra['serialize'] = {'calls': images['sent'], 'ms': round((images['serialize'] + images['sendWait'])*1000, 3)}
+        return self.stageTimes.format(extra)
+
+    def log_message_summary(self):
+        # Logged once, when the first of the close messages is received or sent
+        summary = self.messageLog.format_summary()
+        if (summary is not None) and not self.messageSummaryLogged:
+            self.messageSummaryLogged = True
+            logging.info(summary)
+
+    def get_close_reports(self):
+        # (MRD logging level, text) messages sent to the client before the close
+        # message, which are logged by write_text()
+        reports = []
+        stageTimes = self.format_stage_times()
+        if stageTimes is not None:
+            reports.append((constants.MRD_LOGGING_INFO, stageTimes))
+        if self.memory is not None:
+            reports += self.memory.get_messages()
+        return reports
+
+    # ----- Prefetching --------------------------------------------------------
+    # When enabled, a background thread reads and deserializes incoming messages
+    # (and saves them, if savedata is enabled) into a bounded queue, so that the
+    # socket keeps being drained while the recon module is busy processing.
+    # Iterating over the connection or calling next() then takes items from the
+    # queue.  The queue holds at most 'depth' messages and 'maxBytes' bytes of
+    # data, although a single message larger than maxBytes is always accepted.
+    def start_prefetch(self, depth=64, maxBytes=256*1024*1024):
+        if self.prefetchThread is not None:
+            return
+
+        self.prefetchDepth    = depth
+        self.prefetchMaxBytes = maxBytes
+        self.prefetchDone     = self.is_exhausted
+        self.prefetchThread   = threading.Thread(target=self.prefetch_loop, name="ConnectionPrefetch", daemon=True)
+        self.prefetchThread.start()
+        logging.debug("Prefetching up to %d messages (%d bytes)", depth, maxBytes)
 
-            if (self.is_exhausted == True):
+    def prefetch_loop(self):
+        while not self.is_exhausted:
+            error = None
+            try:
+                item = self.read_message()
+            except Exception as e:
+                item  = None
+                error = e
+
+            nbytes = Connection.sizeof_item(item)
+            with self.prefetchCondition:
+                while (len(self.prefetchQueue) > 0) and ((len(self.prefetchQueue) >= self.prefetchDepth) or (self.prefetchBytes + nbytes > self.prefetchMaxBytes)):
+                    self.prefetchCondition.wait()
+
+                self.prefetchQueue.append((item, nbytes, error, self.is_exhausted or (error is not None)))
+                self.prefetchBytes += nbytes
+                self.prefetchCondition.notify_all()
+
+            if error is not None:
+                return
+
+    def next_prefetched(self):
+        with self.prefetchCondition:
+            if self.prefetchDone:
                 return
 
-            handler = self.handlers.get(id, lambda: Connection.unknown_message_identifier(id))
-            return handler()
+            while len(self.prefetchQueue) == 0:
+                self.prefetchCondition.wait()
+
+            item, nbytes, error, last = self.prefetchQueue.popleft()
+            self.prefetchBytes -= nbytes
+            self.prefetchDone   = last
+            self.prefetchCondition.notify_all()
+
+        if error is not None:
+            raise error
+        return item
+
+    @staticmethod
+    def sizeof_item(item):
+        if isinstance(item, ismrmrd.Acquisition):
+            return item.data.nbytes + item.traj.nbytes
+        elif isinstance(item, ismrmrd.Image):
+            return item.data.nbytes + len(item.attribute_string)
+        elif isinstance(item, ismrmrd.Waveform):
+            return item.data.nbytes
+        elif isinstance(item, str):
+            return len(item)
+        else:
+            return 0
 
     def shutdown_close(self):
         # Encapsulate shutdown in a try block because the socket may have
         # already been closed on the other side
+        try:
+            self.flush()
+        except:
+            logging.warning("Failed to send %d buffered bytes before closing", self.sendBufferBytes)
         try:
             self.socket.shutdown(socket.SHUT_RDWR)
         except:
             pass
         self.socket.close()
+        self.close_shared_memory()
+        self.stop_savedata_writer()
         logging.info("Socket closed")
 
     @staticmethod
@@ -114,32 +714,45 @@ class Connection:
         raise StopIteration
 
     def read_mrd_message_identifier(self):
-        try:
-            identifier_bytes = self.read(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER)
-        except ConnectionResetError:
-            logging.error("Connection closed unexpectedly")
-            self.is_exhausted = True
-            return
+        if self.peekedIdentifier is not None:
+            identifier_bytes      = self.peekedIdentifier
+            self.peekedIdentifier = None
+        else:
+            try:
+                identifier_bytes = self.read(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER)
+            except ConnectionResetError:
+                logging.error("Connection closed unexpectedly")
+                self.is_exhausted = True
+                return
 
-        if (len(identifier_bytes) == 0):
+        if (len(identifier_bytes) < constants.SIZEOF_MRD_MESSAGE_IDENTIFIER):
             self.is_exhausted = True
             return
 
         return constants.MrdMessageIdentifier.unpack(identifier_bytes)[0]
 
     def peek_mrd_message_identifier(self):
-        try:
-            identifier_bytes = self.peek(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER)
-        except ConnectionResetError:
-            logging.error("Connection closed unexpectedly")
-            self.is_exhausted = True
-            return
+        if self.prefetchThread is not None:
+            raise RuntimeError("peek_mrd_message_identifier() cannot be used while prefetching")
+
+        if self.pendingAcquisitionHeader is not None:
+            return constants.MRD_MESSAGE_ISMRMRD_ACQUISITION
+
+        # MSG_PEEK may return only part of the identifier, so it is read and
+        # held for the next call to read_mrd_message_identifier() instead
+        if self.peekedIdentifier is None:
+            try:
+                self.peekedIdentifier = self.read(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER)
+            except ConnectionResetError:
+                logging.error("Connection closed unexpectedly")
+                self.is_exhausted = True
+                return
 
-        if (len(identifier_bytes) == 0):
+        if (len(self.peekedIdentifier) < constants.SIZEOF_MRD_MESSAGE_IDENTIFIER):
             self.is_exhausted = True
             return
 
-        return constants.MrdMessageIdentifier.unpack(identifier_bytes)[0]
+        return constants.MrdMessageIdentifier.unpack(self.peekedIdentifier)[0]
 
     def read_mrd_message_length(self):
         length_bytes = self.read(constants.SIZEOF_MRD_MESSAGE_LENGTH)
@@ -152,10 +765,16 @@ class Connection:
     #   ID               (   2 bytes, unsigned short)
     #   Config file name (1024 bytes, char          )
     def send_config_file(self, filename):
-        with self.lock:
-            logging.info("--> Sending MRD_MESSAGE_CONFIG_FILE (1)")
-            self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CONFIG_FILE))
-            self.socket.send(constants.MrdMessageConfigurationFile.pack(filename.encode()))
+        with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_config_file(filename)
+            self.flush()
+            self.record_sent(constants.MRD_MESSAGE_CONFIG_FILE, start)
+
+    def write_config_file(self, filename):
+        logging.info("--> Sending MRD_MESSAGE_CONFIG_FILE (1)")
+        self.write(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CONFIG_FILE))
+        self.write(constants.MrdMessageConfigurationFile.pack(filename.encode()))
 
     def read_config_file(self):
         logging.info("<-- Received MRD_MESSAGE_CONFIG_FILE (1)")
@@ -164,6 +783,10 @@ class Connection:
         config_file = config_file.split(b'\x00',1)[0].decode('utf-8')  # Strip off null terminators in fixed 1024 size
 
         logging.debug("    " + config_file)
+        self.save_config_file(config_file)
+        return config_file
+
+    def save_config_file(self, config_file):
         if (config_file == "savedataonly"):
             logging.info("Save data, but no processing based on config")
             if self.savedata is True:
@@ -176,11 +799,7 @@ class Connection:
             if self.dset is None:
                 self.create_save_file()
 
-            self.dset._file.require_group("dataset")
-            dsetConfigFile = self.dset._dataset.require_dataset('config_file',shape=(1,), dtype=h5py.special_dtype(vlen=bytes))
-            dsetConfigFile[0] = bytes(config_file, 'utf-8')
-
-        return config_file
+            self.save(Connection.write_string, self.dset, 'config_file', config_file)
 
     # ----- MRD_MESSAGE_CONFIG_TEXT (2) --------------------------------------
     # This message contains the configuration information (text contents) used 
@@ -190,12 +809,18 @@ class Connection:
     #   Length           (   4 bytes, uint32_t      )
     #   Config text data (  variable, char          )
     def send_config_text(self, contents):
-        with self.lock:
-            logging.info("--> Sending MRD_MESSAGE_CONFIG_TEXT (2)")
-            self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CONFIG_TEXT))
-            contents_with_nul = '%s\0' % contents # Add null terminator
-            self.socket.send(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
-            self.socket.send(contents_with_nul.encode())
+        with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_config_text(contents)
+            self.flush()
+            self.record_sent(constants.MRD_MESSAGE_CONFIG_TEXT, start)
+
+    def write_config_text(self, contents):
+        logging.info("--> Sending MRD_MESSAGE_CONFIG_TEXT (2)")
+        self.write(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CONFIG_TEXT))
+        contents_with_nul = '%s\0' % contents # Add null terminator
+        self.write(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
+        self.write(contents_with_nul.encode())
 
     def read_config_text(self):
         logging.info("<-- Received MRD_MESSAGE_CONFIG_TEXT (2)")
@@ -204,16 +829,15 @@ class Connection:
         config = config.split(b'\x00',1)[0].decode('utf-8')  # Strip off null teminator
 
         logging.debug("    " + config)
+        self.save_config_text(config)
+        return config
 
+    def save_config_text(self, config):
         if self.savedata is True:
             if self.dset is None:
                 self.create_save_file()
 
-            self.dset._file.require_group("dataset")
-            dsetConfig = self.dset._dataset.require_dataset('config',shape=(1,), dtype=h5py.special_dtype(vlen=bytes))
-            dsetConfig[0] = bytes(config, 'utf-8')
-
-        return config
+            self.save(Connection.write_string, self.dset, 'config', config)
 
     # ----- MRD_MESSAGE_METADATA_XML_TEXT (3) -----------------------------------
     # This message contains the metadata for the entire dataset, formatted as
@@ -223,52 +847,88 @@ class Connection:
     #   Length           (   4 bytes, uint32_t      )
     #   Text xml data    (  variable, char          )
     def send_metadata(self, contents):
-        with self.lock:
-            logging.info("--> Sending MRD_MESSAGE_METADATA_XML_TEXT (3)")
-            self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_METADATA_XML_TEXT))
-            contents_with_nul = '%s\0' % contents # Add null terminator
-            self.socket.send(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
-            self.socket.send(contents_with_nul.encode())
+        with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_metadata(contents)
+            self.flush()
+            self.record_sent(constants.MRD_MESSAGE_METADATA_XML_TEXT, start)
+
+    def write_metadata(self, contents):
+        logging.info("--> Sending MRD_MESSAGE_METADATA_XML_TEXT (3)")
+        self.write(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_METADATA_XML_TEXT))
+        contents_with_nul = '%s\0' % contents # Add null terminator
+        self.write(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
+        self.write(contents_with_nul.encode())
 
     def read_metadata(self):
         logging.info("<-- Received MRD_MESSAGE_METADATA_XML_TEXT (3)")
         length = self.read_mrd_message_length()
         metadata = self.read(length)
         metadata = metadata.split(b'\x00',1)[0].decode('utf-8')  # Strip off null teminator
+        self.save_metadata(metadata)
+        return metadata
 
+    def save_metadata(self, metadata):
         if self.savedata is True:
             if self.dset is None:
                 self.create_save_file()
 
             logging.debug("    Saving XML header to file")
-            self.dset.write_xml_header(bytes(metadata, 'utf-8'))
-
-        return metadata
+            self.save(self.dset.write_xml_header, bytes(metadata, 'utf-8'))
+            self.save(self.savedataLayout.set_expected, metadata)
 
     # ----- MRD_MESSAGE_CLOSE (4) ----------------------------------------------
     # This message signals that all data has been sent (either from server or client).
     def send_close(self):
-        with self.lock:
-            logging.info("--> Sending MRD_MESSAGE_CLOSE (4)")
-            self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CLOSE))
+        with self.writeLock:
+            if self.sendStatsOnClose:
+                self.send_text(self.format_stats())
+
+            for level, text in self.get_close_reports():
+                self.send_logging(level, text)
+
+            start = self.stats_snapshot()
+            self.write_close()
+            self.flush()
+            self.record_sent(constants.MRD_MESSAGE_CLOSE, start)
+            logging.log(self.get_stats_log_level(), self.format_stats())
+            self.log_message_summary()
+
+    def get_stats_log_level(self):
+        # Connections that send their statistics to the other end before the
+        # close (the server) log them once, as that message is written
+        return logging.DEBUG if self.sendStatsOnClose else logging.INFO
+
+    def write_close(self):
+        logging.info("--> Sending MRD_MESSAGE_CLOSE (4)")
+        self.write(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CLOSE))
 
     def read_close(self):
         logging.info("<-- Received MRD_MESSAGE_CLOSE (4)")
         logging.info("    Total received acquisitions: %5d", self.recvAcqs)
         logging.info("    Total received images:       %5d", self.recvImages)
         logging.info("    Total received waveforms:    %5d", self.recvWaveforms)
+        logging.log(self.get_stats_log_level(), self.format_stats())
+        self.log_message_summary()
         logging.info("------------------------------------------")
 
+        self.close_save_file()
+        self.is_exhausted = True
+        return
+
+    def close_save_file(self):
         if self.savedata is True:
             if self.dset is None:
                 self.create_save_file()
 
             logging.debug("Closing file %s", self.dset._file.filename)
-            self.dset.close()
+            self.save(Connection.close_dataset, self.dset, self.savedataLayout, self.savedataMode == 'durable')
             self.dset = None
 
-        self.is_exhausted = True
-        return
+            # Data must be written (and in 'durable' mode, on disk) before the
+            # close is acknowledged
+            if self.savedataMode != 'async':
+                self.wait_for_save()
 
     # ----- MRD_MESSAGE_TEXT (5) -----------------------------------
     # This message contains arbitrary text data.
@@ -277,13 +937,19 @@ class Connection:
     #   Length           (   4 bytes, uint32_t      )
     #   Text data        (  variable, char          )
     def send_text(self, contents):
-        with self.lock:
-            logging.info("--> Sending MRD_MESSAGE_TEXT (5)")
-            logging.info("    %s", contents)
-            self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_TEXT))
-            contents_with_nul = '%s\0' % contents # Add null terminator
-            self.socket.send(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
-            self.socket.send(contents_with_nul.encode())
+        with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_text(contents)
+            self.flush()
+            self.record_sent(constants.MRD_MESSAGE_TEXT, start)
+
+    def write_text(self, contents):
+        logging.info("--> Sending MRD_MESSAGE_TEXT (5)")
+        logging.info("    %s", contents)
+        self.write(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_TEXT))
+        contents_with_nul = '%s\0' % contents # Add null terminator
+        self.write(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
+        self.write(contents_with_nul.encode())
 
     def read_text(self):
         logging.info("<-- Received MRD_MESSAGE_TEXT (5)")
@@ -301,28 +967,146 @@ class Connection:
     #   Trajectory       (  variable, float         )
     #   Raw k-space data (  variable, float         )
     def send_acquisition(self, acquisition):
-        with self.lock:
-            self.sentAcqs += 1
-            if (self.sentAcqs == 1) or (self.sentAcqs % 100 == 0):
-                logging.info("--> Sending MRD_MESSAGE_ISMRMRD_ACQUISITION (1008) (total: %d)", self.sentAcqs)
+        with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_acquisition(acquisition)
+            self.flush(force=False)
+            self.record_sent(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, start)
+
+    def write_acquisition(self, acquisition):
+        self.sentAcqs += 1
+        if self.messageLog.should_log('sentAcquisitions'):
+            logging.info("--> Sending MRD_MESSAGE_ISMRMRD_ACQUISITION (1008) (total: %d)", self.sentAcqs)
 
-            self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION))
-            acquisition.serialize_into(self.socket.send)
+        self.write_message(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, acquisition.serialize_into)
 
     def read_acquisition(self):
         self.recvAcqs += 1
-        if (self.recvAcqs == 1) or (self.recvAcqs % 100 == 0):
+        if self.messageLog.should_log('receivedAcquisitions'):
             logging.info("<-- Received MRD_MESSAGE_ISMRMRD_ACQUISITION (1008) (total: %d)", self.recvAcqs)
 
-        acq = ismrmrd.Acquisition.deserialize_from(self.read)
+        # Explicit version of deserialize_from() that receives the trajectory and
+        # k-space data directly into the arrays allocated by the Acquisition
+        if self.pendingAcquisitionHeader is not None:
+            header_bytes = self.pendingAcquisitionHeader
+            self.pendingAcquisitionHeader = None
+        else:
+            header_bytes = self.read(ctypes.sizeof(ismrmrd.AcquisitionHeader))
+        acq = ismrmrd.Acquisition(header_bytes)
+
+        if acq.traj.size > 0:
+            self.read_into(acq.traj)
+        if acq.data.size > 0:
+            self.read_into(acq.data)
 
+        self.save_acquisition(acq)
+        return acq
+
+    def save_acquisition(self, acq):
         if self.savedata is True:
             if self.dset is None:
                 self.create_save_file()
 
-            self.dset.append_acquisition(acq)
+            rows = self.acquisition_rows(np.frombuffer(acq.getHead(), dtype=ismrmrd.hdf5.acquisition_header_dtype), [acq.data], [acq.traj])
+            self.save_rows(Connection.append_rows, (self.dset, self.savedataLayout, 'data', ismrmrd.hdf5.acquisition_dtype), (self.dset, 'data'), rows, acq.data.nbytes + acq.traj.nbytes)
+
+    def read_acquisition_batch(self, max_n, stop_flag=None):
+        """
+        Read up to max_n consecutive acquisitions without creating an Acquisition object for each
+            Input:
+                - max_n     : maximum number of acquisitions to read
+                - stop_flag : if set (e.g. ismrmrd.ACQ_LAST_IN_SLICE), end the batch after
+                              an acquisition that has this flag set
+            Output (not available while prefetching):
+                - headers   : structured array [n] of AcquisitionHeaders with dtype
+                              ismrmrd.hdf5.acquisition_header_dtype (the 340 byte fixed header)
+                - data      : complex64 array [n cha samples]
+                - traj      : float32 array [n samples dims]
+
+        The batch ends early if the next message is not an acquisition, or if the next
+        acquisition has a different number of channels, samples or trajectory dimensions
+        (it is returned by the next call instead).  n is 0 if the next message is not an
+        acquisition, in which case it should be read with next().
+        """
+        if self.prefetchThread is not None:
+            raise RuntimeError("read_acquisition_batch() cannot be used while prefetching")
+
+        with self.readLock:
+            start   = self.stats_snapshot()
+            headers = np.zeros((max_n,), dtype=ismrmrd.hdf5.acquisition_header_dtype)
+            data    = None
+            traj    = None
+            n       = 0
+            while n < max_n:
+                if self.pendingAcquisitionHeader is not None:
+                    headers[n:n+1] = np.frombuffer(self.pendingAcquisitionHeader, dtype=headers.dtype)
+                    self.pendingAcquisitionHeader = None
+                else:
+                    if self.peek_mrd_message_identifier() != constants.MRD_MESSAGE_ISMRMRD_ACQUISITION:
+                        break
+                    self.read_mrd_message_identifier()
+                    self.read_into(headers[n:n+1])
+
+                n, data, traj, done = self.add_to_acquisition_batch(headers, data, traj, n, stop_flag)
+                if done:
+                    break
+
+                if traj[n-1].size > 0:
+                    self.read_into(traj[n-1])
+                if data[n-1].size > 0:
+                    self.read_into(data[n-1])
+
+                if (stop_flag is not None) and (headers[n-1]['flags'] & (1 << (stop_flag - 1))):
+                    break
+
+            if n > 0:
+                self.record_received(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, start, n)
+            return self.finish_acquisition_batch(headers, data, traj, n)
+
+    def add_to_acquisition_batch(self, headers, data, traj, n, stop_flag):
+        # Bookkeeping for read_acquisition_batch() after headers[n] has been read.
+        # Allocates the data/trajectory blocks for the first acquisition, or stores
+        # the header for later if it doesn't match the shape of the current batch
+        cha, samples, dims = (int(headers[n]['active_channels']), int(headers[n]['number_of_samples']), int(headers[n]['trajectory_dimensions']))
+        if data is None:
+            data = np.empty((len(headers), cha, samples), dtype=np.complex64)
+            traj = np.empty((len(headers), samples, dims), dtype=np.float32)
+        elif (cha, samples, dims) != (data.shape[1], data.shape[2], traj.shape[2]):
+            self.pendingAcquisitionHeader = headers[n:n+1].tobytes()
+            return n, data, traj, True
 
-        return acq
+        self.recvAcqs += 1
+        if self.messageLog.should_log('receivedAcquisitions'):
+            logging.info("<-- Received MRD_MESSAGE_ISMRMRD_ACQUISITION (1008) (total: %d)", self.recvAcqs)
+
+        return n+1, data, traj, False
+
+    def finish_acquisition_batch(self, headers, data, traj, n):
+        if data is None:
+            data = np.empty((0, 0, 0), dtype=np.complex64)
+            traj = np.empty((0, 0, 0), dtype=np.float32)
+
+        headers, data, traj = headers[:n], data[:n], traj[:n]
+        self.save_acquisition_batch(headers, data, traj)
+        return headers, data, traj
+
+    def save_acquisition_batch(self, headers, data, traj):
+        if (self.savedata is True) and (len(headers) > 0):
+            if self.dset is None:
+                self.create_save_file()
+
+            rows = self.acquisition_rows(headers, data, traj)
+            nbytes = sum([d.nbytes for d in data]) + sum([t.nbytes for t in traj])
+            self.save_rows(Connection.append_rows, (self.dset, self.savedataLayout, 'data', ismrmrd.hdf5.acquisition_dtype), (self.dset, 'data'), rows, nbytes)
+
+    def acquisition_rows(self, headers, data, traj):
+        # Rows of the HDF5 'data' dataset for acquisition headers and arrays
+        h5acq = np.empty((len(headers),), dtype=ismrmrd.hdf5.acquisition_dtype)
+        h5acq['head'] = headers
+        for i in range(len(headers)):
+            h5acq[i]['data'] = self.copy_for_save(data[i].view(np.float32).reshape(-1))
+            h5acq[i]['traj'] = self.copy_for_save(traj[i].view(np.float32).reshape(-1))
+        return h5acq
 
     # ----- MRD_MESSAGE_ISMRMRD_IMAGE (1022) -----------------------------------
     # This message contains a single [x y z cha] image.
@@ -333,58 +1117,78 @@ class Connection:
     #   Attribute data   (  variable, char          )
     #   Image data       (  variable, variable      )
     def send_image(self, images):
-        with self.lock:
-            if not isinstance(images, list):
-                images = [images]
-
-            logging.info("--> Sending MRD_MESSAGE_ISMRMRD_IMAGE (1022) (%d images)", len(images))
-            for image in images:
-                if image is None:
-                    continue
-
-                self.sentImages += 1
-                self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_IMAGE))
-                image.serialize_into(self.socket.send)
-
-            # Explicit version of serialize_into() for more verbose debugging
-            # self.socket.send(image.getHead())
-            # self.socket.send(constants.MrdMessageAttribLength.pack(len(image.attribute_string)))
-            # self.socket.send(bytes(image.attribute_string, 'utf-8'))
-            # self.socket.send(bytes(image.data))
+        with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_image(images)
+
+            # All images in the list are sent together in a single vectored write
+            self.flush(force=False)
+            self.record_sent(constants.MRD_MESSAGE_ISMRMRD_IMAGE, start, len(images) if isinstance(images, list) else 1)
+
+    def write_image(self, images):
+        if not isinstance(images, list):
+            images = [images]
+
+        if self.messageLog.should_log('sentImages'):
+            logging.info("--> Sending MRD_MESSAGE_ISMRMRD_IMAGE (1022) (%d images) (total: %d)", len(images), self.sentImages + len(images))
+        if self.firstImageTime is None:
+            self.firstImageTime = time.perf_counter()
+        for image in images:
+            if image is None:
+                continue
+
+            self.sentImages += 1
+            self.write_message(constants.MRD_MESSAGE_ISMRMRD_IMAGE, image.serialize_into)
+
+        # Explicit version of serialize_into() for more verbose debugging
+        # self.write(image.getHead())
+        # self.write(constants.MrdMessageAttribLength.pack(len(image.attribute_string)))
+        # self.write(bytes(image.attribute_string, 'utf-8'))
+        # self.write(bytes(image.data))
 
     def read_image(self):
         self.recvImages += 1
-        logging.info("<-- Received MRD_MESSAGE_ISMRMRD_IMAGE (1022)")
+        verbose = self.messageLog.should_log('receivedImages')
+        if verbose:
+            logging.info("<-- Received MRD_MESSAGE_ISMRMRD_IMAGE (1022) (total: %d)", self.recvImages)
         # return ismrmrd.Image.deserialize_from(self.read)
 
         # Explicit version of deserialize_from() for more verbose debugging
-        logging.debug("   Reading in %d bytes of image header", ctypes.sizeof(ismrmrd.ImageHeader))
         header_bytes = self.read(ctypes.sizeof(ismrmrd.ImageHeader))
 
         attribute_length_bytes = self.read(ctypes.sizeof(ctypes.c_uint64))
         attribute_length = ctypes.c_uint64.from_buffer_copy(attribute_length_bytes)
-        logging.debug("   Reading in %d bytes of attributes", attribute_length.value)
 
         attribute_bytes = self.read(attribute_length.value)
-        if (attribute_length.value > 25000):
-            logging.debug("   Attributes (truncated): %s", attribute_bytes[0:24999].decode('utf-8'))
-        else:
-            logging.debug("   Attributes: %s", attribute_bytes.decode('utf-8'))
 
-        image = ismrmrd.Image(header_bytes, attribute_bytes.split(b'\x00',1)[0].decode('utf-8'))  # Strip off null teminator
+        # The attributes are only decoded if they are logged
+        if verbose and logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("   Read %d bytes of image header and %d bytes of attributes", ctypes.sizeof(ismrmrd.ImageHeader), attribute_length.value)
+            if (attribute_length.value > 25000):
+                logging.debug("   Attributes (truncated): %s", attribute_bytes[0:24999].decode('utf-8', errors='replace'))
+            else:
+                logging.debug("   Attributes: %s", attribute_bytes.decode('utf-8', errors='replace'))
 
-        logging.info("    Image is size %d x %d x %d with %d channels of type %s", image.getHead().matrix_size[0], image.getHead().matrix_size[1], image.getHead().matrix_size[2], image.channels, image.data.dtype)
+        if self.lazyImages:
+            image = LazyImage(header_bytes, attribute_bytes.split(b'\x00',1)[0])  # Strip off null teminator
+        else:
+            image = ismrmrd.Image(header_bytes, attribute_bytes.split(b'\x00',1)[0].decode('utf-8'))  # Strip off null teminator
+
+        if verbose:
+            logging.info("    Image is size %d x %d x %d with %d channels of type %s", image.getHead().matrix_size[0], image.getHead().matrix_size[1], image.getHead().matrix_size[2], image.channels, image.data.dtype)
         def calculate_number_of_entries(nchannels, xs, ys, zs):
             return nchannels * xs * ys * zs
 
         nentries = calculate_number_of_entries(image.channels, *image.getHead().matrix_size)
         nbytes = nentries * image.data.dtype.itemsize
 
-        logging.debug("Reading in %d bytes of image data", nbytes)
-        data_bytes = self.read(nbytes)
+        if nbytes > 0:
+            self.read_into(image.data)
 
-        image.data.ravel()[:] = np.frombuffer(data_bytes, dtype=image.data.dtype)
+        return self.save_image(image)
 
+    def save_image(self, image):
+        # Returns the image as stored, which may have been transposed (see below)
         if self.savedata is True:
             # MRD HDF5 files store all images in a series in a single ND array.  If images in
             # the same series have a different matrix size, they cannot be stored.  In the
@@ -392,8 +1196,9 @@ class Connection:
             # transformation into DICOM orientation) and the fixTransposed option is enabled,
             # transpose the images, update the metadata, and store the image.
             seriesName = "image_%d" % image.image_series_index
-            if self.dset and seriesName in self.dset.list():
-                prevShape = self.dset.read_image("image_%d" % image.image_series_index, self.dset.number_of_images(seriesName)-1).data.shape
+            series = self.savedSeries.get(seriesName) if self.dset else None
+            if series is not None:
+                prevShape = series['shape']
 
                 if image.data.shape != prevShape:
                     if self.fixTransposed:
@@ -427,6 +1232,7 @@ class Connection:
                             imgT.attribute_string = tmpMeta.serialize()
 
                             image = imgT
+                            series['transposed'] += 1
                         else:
                             logging.error(f'    Incoming image for series {image.image_series_index} has shape {image.data.shape} which is not the same shape as existing current data in the series {prevShape}!')
                     else:
@@ -435,10 +1241,24 @@ class Connection:
 
             if self.dset is None:
                 self.create_save_file()
-            self.dset.append_image("image_%d" % image.image_series_index, image)
+
+            dtype = ismrmrd.hdf5.get_hdf5type(image.data_type)
+            series = self.savedSeries.setdefault(seriesName, {'shape': image.data.shape, 'dtype': dtype, 'count': 0, 'transposed': 0})
+            if dtype != series['dtype']:
+                logging.warning(f'    Incoming image for series {image.image_series_index} has data type {dtype} which will be converted to the data type of the series {series["dtype"]}')
+            series['count'] += 1
+
+            rows = self.image_rows(image)
+            self.save_rows(Connection.append_images, (self.dset, self.savedataLayout, seriesName), (self.dset, seriesName, rows[2].shape, rows[2].dtype), rows, rows[2].nbytes)
 
         return image
 
+    def image_rows(self, image):
+        # Header, attributes and data of an image as stored in an image series
+        # group, each with a leading dimension of 1
+        data = image.data.view(ismrmrd.hdf5.get_hdf5type(image.data_type))[np.newaxis]
+        return (np.frombuffer(image.getHead(), dtype=ismrmrd.hdf5.image_header_dtype), [image.attribute_string], self.copy_for_save(data))
+
     # ----- MRD_MESSAGE_ISMRMRD_WAVEFORM (1026) -----------------------------
     # This message contains abitrary (e.g. physio) waveform data.
     # Message consists of:
@@ -446,26 +1266,117 @@ class Connection:
     #   Fixed header     ( 240 bytes, mixed         )
     #   Waveform data    (  variable, uint32_t      )
     def send_waveform(self, waveform):
-        with self.lock:
-            self.sentWaveforms += 1
-            if (self.sentWaveforms == 1) or (self.sentWaveforms % 100 == 0):
-                logging.info("--> Sending MRD_MESSAGE_ISMRMRD_WAVEFORM (1026) (total: %d)", self.sentWaveforms)
+        with self.writeLock:
+            start = self.stats_snapshot()
+            self.write_waveform(waveform)
+            self.flush(force=False)
+            self.record_sent(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM, start)
+
+    def write_waveform(self, waveform):
+        self.sentWaveforms += 1
+        if self.messageLog.should_log('sentWaveforms'):
+            logging.info("--> Sending MRD_MESSAGE_ISMRMRD_WAVEFORM (1026) (total: %d)", self.sentWaveforms)
 
-            self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM))
-            waveform.serialize_into(self.socket.send)
+        self.write_message(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM, waveform.serialize_into)
 
     def read_waveform(self):
         self.recvWaveforms += 1
-        if (self.recvWaveforms == 1) or (self.recvWaveforms % 100 == 0):
+        if self.messageLog.should_log('receivedWaveforms'):
             logging.info("<-- Received MRD_MESSAGE_ISMRMRD_WAVEFORM (1026) (total: %d)", self.recvWaveforms)
 
-        waveform = ismrmrd.Waveform.deserialize_from(self.read)
+        header_bytes = self.read(ctypes.sizeof(ismrmrd.WaveformHeader))
+        waveform = ismrmrd.Waveform(header_bytes)
 
+        if waveform.data.size > 0:
+            self.read_into(waveform.data)
+
+        self.save_waveform(waveform)
+        return waveform
+
+    def save_waveform(self, waveform):
         if self.savedata is True:
             if self.dset is None:
                 self.create_save_file()
 
-            self.dset.append_waveform(waveform)
+            h5wav = np.empty((1,), dtype=ismrmrd.hdf5.waveform_dtype)
+            h5wav['head'] = np.frombuffer(waveform.getHead(), dtype=ismrmrd.hdf5.waveform_header_dtype)
+            h5wav[0]['data'] = self.copy_for_save(waveform.data.view(np.uint32).reshape(-1))
+            self.save_rows(Connection.append_rows, (self.dset, self.savedataLayout, 'waveforms', ismrmrd.hdf5.waveform_dtype), (self.dset, 'waveforms'), h5wav, waveform.data.nbytes)
 
-        return waveform
+    # ----- MRD_MESSAGE_COMPRESSED (4001) ----------------------------------------
+    # Private message wrapping an acquisition, image or waveform message whose
+    # body (everything after the ID) is compressed.  Enabled for outgoing data
+    # by enable_compression(), normally negotiated through the "compression" and
+    # "compressionTypes" JSON config parameters.
+    # Message consists of:
+    #   ID                  (   2 bytes, unsigned short)
+    #   Wrapped message ID  (   2 bytes, unsigned short)
+    #   Codec               (   2 bytes, unsigned short)
+    #   Uncompressed length (   8 bytes, uint64_t      )
+    #   Compressed length   (   8 bytes, uint64_t      )
+    #   Compressed data     (  variable, char          )
+    def read_compressed(self):
+        header_bytes = self.read(constants.SIZEOF_MRD_MESSAGE_COMPRESSED_HEADER)
+        id, codec, length, compressedLength = Connection.parse_compressed_header(header_bytes)
+        self.inflate(codec, length, self.read(compressedLength))
+
+        # The wrapped message is deserialized by its usual handler, reading from
+        # the decompressed data instead of the socket
+        try:
+            return self.handlers[id]()
+        finally:
+            self.inflatedBuffer = None
 
+    @staticmethod
+    def parse_compressed_header(header_bytes):
+        id, codec, length, compressedLength = constants.MrdMessageCompressedHeader.unpack(header_bytes)
+        if id not in compression.message_types.values():
+            raise ValueError("Unsupported message type %d in MRD_MESSAGE_COMPRESSED" % id)
+        return id, codec, length, compressedLength
+
+    def inflate(self, codec, length, payload):
+        body = compression.decompress(codec, payload)
+        if len(body) != length:
+            raise ValueError("MRD_MESSAGE_COMPRESSED decompressed to %d bytes instead of %d" % (len(body), length))
+
+        self.inflatedBuffer = memoryview(body)
+        self.inflatedOffset = 0
+
+    # ----- MRD_MESSAGE_SHARED_MEMORY (4002) -------------------------------------
+    # Private message for an acquisition, image or waveform message whose body
+    # (everything after the ID) has been written to the receive shared memory
+    # ring, see enable_shared_memory().  Normally negotiated through the
+    # "sharedMemory" and "sharedMemoryReply" JSON config parameters.
+    # Message consists of:
+    #   ID                  (   2 bytes, unsigned short)
+    #   Wrapped message ID  (   2 bytes, unsigned short)
+    #   Position in ring    (   8 bytes, uint64_t      )
+    #   Length              (   8 bytes, uint64_t      )
+    def read_shared_memory(self):
+        header_bytes = self.read(constants.SIZEOF_MRD_MESSAGE_SHARED_MEMORY_HEADER)
+        id, position, length = self.map_shared_memory(header_bytes)
+
+        # The wrapped message is deserialized by its usual handler, copying
+        # directly from shared memory instead of reading from the socket
+        try:
+            return self.handlers[id]()
+        finally:
+            self.unmap_shared_memory(position, length)
+
+    def map_shared_memory(self, header_bytes):
+        id, position, length = constants.MrdMessageSharedMemoryHeader.unpack(header_bytes)
+        if self.recvRing is None:
+            raise ValueError("Received MRD_MESSAGE_SHARED_MEMORY without shared memory enabled")
+        if id not in compression.message_types.values():
+            raise ValueError("Unsupported message type %d in MRD_MESSAGE_SHARED_MEMORY" % id)
+
+        self.inflatedBuffer = self.recvRing.view(position, length)
+        self.inflatedOffset = 0
+        self.recvRingId     = id
+        self.recvBytes     += length
+        return id, position, length
+
+    def unmap_shared_memory(self, position, length):
+        self.inflatedBuffer.release()
+        self.inflatedBuffer = None
+        self.recvRing.release(position, length)
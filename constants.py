@@ -33,6 +33,8 @@ MRD_MESSAGE_ISMRMRD_IMAGEWITHATTRIB_REAL_SHORT     = 1021 # DEPRECATED
 MRD_MESSAGE_ISMRMRD_IMAGE                          = 1022
 MRD_MESSAGE_RECONDATA                              = 1023 # UNSUPPORTED
 MRD_MESSAGE_ISMRMRD_WAVEFORM                       = 1026
+MRD_MESSAGE_COMPRESSED                             = 4001 # PRIVATE
+MRD_MESSAGE_SHARED_MEMORY                          = 4002 # PRIVATE
 MRD_MESSAGE_EXT_ID_MAX                             = 4096 # CONTROL
 
 MrdMessageLength = struct.Struct('<I')
@@ -47,6 +49,19 @@ SIZEOF_MRD_MESSAGE_CONFIGURATION_FILE = len(MrdMessageConfigurationFile.pack(b''
 MrdMessageAttribLength = struct.Struct('<Q')
 SIZEOF_MRD_MESSAGE_ATTRIB_LENGTH = len(MrdMessageAttribLength.pack(0))
 
+# Wrapped message ID, codec, uncompressed length, compressed length
+MrdMessageCompressedHeader = struct.Struct('<HHQQ')
+SIZEOF_MRD_MESSAGE_COMPRESSED_HEADER = len(MrdMessageCompressedHeader.pack(0, 0, 0, 0))
+
+# Wrapped message ID, position in shared memory ring, length
+MrdMessageSharedMemoryHeader = struct.Struct('<HQQ')
+SIZEOF_MRD_MESSAGE_SHARED_MEMORY_HEADER = len(MrdMessageSharedMemoryHeader.pack(0, 0, 0))
+
+# Compression codecs for MRD_MESSAGE_COMPRESSED
+MRD_COMPRESSION_ZLIB = 1
+MRD_COMPRESSION_LZMA = 2
+MRD_COMPRESSION_LZ4  = 3
+
 # Logging serverity levels
 MRD_LOGGING_DEBUG    = "DEBUG   "
 MRD_LOGGING_INFO     = "INFO    "
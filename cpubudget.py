@@ -0,0 +1,89 @@
+# CPU sets and numerical thread budgets of the processes handling sessions, see Server.serve()
+import logging
+import os
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+# Variables read by numerical libraries when they are loaded (OpenBLAS, MKL,
+# BLIS, Accelerate, OpenMP and numexpr)
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def get_cpus():
+    """CPUs that this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def parse_thread_budget(value, concurrency):
+    """
+    Number of numerical threads per session for --numericThreads: 'none' (0,
+    the libraries' defaults), 'auto' (the CPUs divided by concurrency, the
+    number of sessions that can run at the same time) or a number
+    """
+    if value == 'none':
+        return 0
+    if value == 'auto':
+        return max(1, len(get_cpus()) // max(1, concurrency))
+
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = -1
+    if threads < 0:
+        raise ValueError("Expected 'none', 'auto' or a number of threads, got '%s'" % value)
+    return threads
+
+def set_thread_environment(threads):
+    """Set the thread counts read by numerical libraries, which must be done before they are imported"""
+    if threads > 0:
+        for variable in THREAD_VARIABLES:
+            os.environ[variable] = str(threads)
+
+class CpuBudget:
+    """
+    Limits the threads used by numerical libraries (BLAS and OpenMP thread
+    pools) in each process handling sessions to threads, and with affinity,
+    pins each process started for sessions (-m, --workers) to its own set of
+    threads CPUs, so that concurrent sessions don't oversubscribe the CPUs.
+
+    Processes are given the CPU sets in turn by slot (the worker's index, or
+    the number of connections for -m), wrapping around when there are more
+    processes than sets.  Sessions in threads of the server process (--threads,
+    --asyncio) share its thread pools, so only the thread budget applies.
+
+    The budget is set with threadpoolctl when it is installed, and otherwise
+    relies on the environment variables set by set_thread_environment()
+    before numpy was imported.  numpy.fft is single-threaded, so its FFTs
+    aren't affected.
+    """
+
+    def __init__(self, threads=0, affinity=False):
+        self.cpus     = get_cpus()
+        self.threads  = threads
+        self.affinity = affinity and hasattr(os, 'sched_setaffinity')
+        self.limiter  = None
+
+        if affinity and not self.affinity:
+            logging.warning("CPU affinity is not supported on this platform")
+
+    def get_cpu_set(self, slot):
+        size  = min(self.threads, len(self.cpus)) if self.threads > 0 else 1
+        count = len(self.cpus) // size
+        start = (slot % count) * size
+        return self.cpus[start:start+size]
+
+    def apply(self, slot=None):
+        """Set the thread budget of this process, and its CPU set if slot is given"""
+        if self.affinity and (slot is not None):
+            cpus = self.get_cpu_set(slot)
+            os.sched_setaffinity(0, cpus)
+            logging.debug("Process %d runs on CPUs %s", os.getpid(), ",".join([str(cpu) for cpu in cpus]))
+
+        if self.threads > 0:
+            if threadpoolctl is not None:
+                self.limiter = threadpoolctl.threadpool_limits(limits=self.threads)
+            elif os.environ.get('OMP_NUM_THREADS') != str(self.threads):
+                logging.warning("threadpoolctl is not installed and the numerical thread budget was not set before numpy was imported -- thread pools are not limited")
@@ -1,5 +1,6 @@
 import ismrmrd
 import os
+import collections
 import itertools
 import logging
 import traceback
@@ -11,12 +12,40 @@ import base64
 import ctypes
 import re
 import mrdhelper
+import kspacebuffer
 import constants
-from time import perf_counter
 
 # Folder for debug output files
 debugFolder = "/tmp/share/debug"
 
+# Images that are passed through unmodified don't need to be fully parsed, so
+# they are received as LazyImage (see Server.get_lazy_images())
+LAZY_IMAGES = True
+
+# Imaging readouts are read in batches of up to this many straight into arrays,
+# instead of as an ismrmrd.Acquisition each (see Connection.read_acquisition_batch())
+acquisitionBatchSize = 256
+
+# Readouts that are not accumulated for the image
+skippedAcquisitionFlags = sum([1 << (flag-1) for flag in (ismrmrd.ACQ_IS_NOISE_MEASUREMENT, ismrmrd.ACQ_IS_PARALLEL_CALIBRATION, ismrmrd.ACQ_IS_PHASECORR_DATA, ismrmrd.ACQ_IS_NAVIGATION_DATA)])
+
+AcquisitionBatch = collections.namedtuple('AcquisitionBatch', ['headers', 'data', 'traj'])
+
+def read_items(connection):
+    # Messages received from the client, with consecutive readouts returned as
+    # an AcquisitionBatch.  A prefetching connection has already read the
+    # readouts as ismrmrd.Acquisition, so its messages are returned unchanged
+    if connection.prefetchThread is not None:
+        yield from connection
+        return
+
+    while not connection.is_exhausted:
+        headers, data, traj = connection.read_acquisition_batch(acquisitionBatchSize, ismrmrd.ACQ_LAST_IN_SLICE)
+        if len(headers) > 0:
+            yield AcquisitionBatch(headers, data, traj)
+        else:
+            yield connection.next()
+
 def process(connection, config, mrdHeader):
     logging.info("Config: \n%s", config)
 
@@ -42,21 +71,36 @@ def process(connection, config, mrdHeader):
 
     # Continuously parse incoming data parsed from MRD messages
     currentSeries = 0
-    acqGroup = []
+    acqGroup = kspacebuffer.KSpaceBuffer(mrdHeader, config)
     imgGroup = []
     waveformGroup = []
     try:
-        for item in connection:
+        for item in read_items(connection):
             # ----------------------------------------------------------
             # Raw k-space data messages
             # ----------------------------------------------------------
-            if isinstance(item, ismrmrd.Acquisition):
+            if isinstance(item, AcquisitionBatch):
+                # Accumulate all imaging readouts in a group
+                imaging = (item.headers['flags'] & skippedAcquisitionFlags) == 0
+                with mrdhelper.stage('sort'):
+                    acqGroup.add_batch(item.headers[imaging], item.data[imaging])
+
+                # A batch ends with the readout that has ACQ_LAST_IN_SLICE set,
+                # at which point process_raw() is run on the accumulated data
+                if item.headers[-1]['flags'] & (1 << (ismrmrd.ACQ_LAST_IN_SLICE-1)):
+                    logging.info("Processing a group of k-space data")
+                    image = process_raw(acqGroup, connection, config, mrdHeader)
+                    connection.send_image(image)
+                    acqGroup.clear()
+
+            elif isinstance(item, ismrmrd.Acquisition):
                 # Accumulate all imaging readouts in a group
                 if (not item.is_flag_set(ismrmrd.ACQ_IS_NOISE_MEASUREMENT) and
                     not item.is_flag_set(ismrmrd.ACQ_IS_PARALLEL_CALIBRATION) and
                     not item.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA) and
                     not item.is_flag_set(ismrmrd.ACQ_IS_NAVIGATION_DATA)):
-                    acqGroup.append(item)
+                    with mrdhelper.stage('sort'):
+                        acqGroup.add(item)
 
                 # When this criteria is met, run process_raw() on the accumulated
                 # data, which returns images that are sent back to the client.
@@ -64,7 +108,7 @@ def process(connection, config, mrdHeader):
                     logging.info("Processing a group of k-space data")
                     image = process_raw(acqGroup, connection, config, mrdHeader)
                     connection.send_image(image)
-                    acqGroup = []
+                    acqGroup.clear()
 
             # ----------------------------------------------------------
             # Image data messages
@@ -84,9 +128,7 @@ def process(connection, config, mrdHeader):
                 if (item.image_type is ismrmrd.IMTYPE_MAGNITUDE) or (item.image_type == 0):
                     imgGroup.append(item)
                 else:
-                    tmpMeta = ismrmrd.Meta.deserialize(item.attribute_string)
-                    tmpMeta['Keep_image_geometry']    = 1
-                    item.attribute_string = tmpMeta.serialize()
+                    mrdhelper.set_meta_values(item, {'Keep_image_geometry': 1})
 
                     connection.send_image(item)
                     continue
@@ -120,7 +162,7 @@ def process(connection, config, mrdHeader):
             logging.info("Processing a group of k-space data (untriggered)")
             image = process_raw(acqGroup, connection, config, mrdHeader)
             connection.send_image(image)
-            acqGroup = []
+            acqGroup.clear()
 
         if len(imgGroup) > 0:
             logging.info("Processing a group of images (untriggered)")
@@ -136,6 +178,7 @@ def process(connection, config, mrdHeader):
         connection.send_close()
 
 
+@mrdhelper.timed_stage
 def process_raw(acqGroup, connection, config, mrdHeader):
     if len(acqGroup) == 0:
         return []
@@ -144,105 +187,84 @@ def process_raw(acqGroup, connection, config, mrdHeader):
     logging.info(f'     process_raw called with {len(acqGroup)} readouts')
     logging.info(f'-----------------------------------------------')
 
-    # Start timer
-    tic = perf_counter()
-
     # Create folder, if necessary
     if not os.path.exists(debugFolder):
         os.makedirs(debugFolder)
         logging.debug("Created folder " + debugFolder + " for debug output files")
 
-    # Format data into single [cha PE RO phs] array
-    lin = [acquisition.idx.kspace_encode_step_1 for acquisition in acqGroup]
-    phs = [acquisition.idx.phase                for acquisition in acqGroup]
-
-    # Use the zero-padded matrix size
-    data = np.zeros((acqGroup[0].data.shape[0], 
-                     mrdHeader.encoding[0].encodedSpace.matrixSize.y, 
-                     mrdHeader.encoding[0].encodedSpace.matrixSize.x, 
-                     max(phs)+1), 
-                    acqGroup[0].data.dtype)
-
-    rawHead = [None]*(max(phs)+1)
+    # Readouts were formatted into a single [cha PE RO phs] array as they were
+    # received (see KSpaceBuffer), which may be memory mapped for large scans
+    # (timed as the 'sort' stage)
+    with mrdhelper.stage('flip'):
+        data    = acqGroup.data
+        rawHead = acqGroup.heads
 
-    for acq, lin, phs in zip(acqGroup, lin, phs):
-        if (lin < data.shape[1]) and (phs < data.shape[3]):
-            # TODO: Account for asymmetric echo in a better way
-            data[:,lin,-acq.data.shape[1]:,phs] = acq.data
-
-            # center line of k-space is encoded in user[5]
-            if (rawHead[phs] is None) or (np.abs(acq.getHead().idx.kspace_encode_step_1 - acq.getHead().idx.user[5]) < np.abs(rawHead[phs].idx.kspace_encode_step_1 - rawHead[phs].idx.user[5])):
-                rawHead[phs] = acq.getHead()
-
-    # Flip matrix in RO/PE to be consistent with ICE
-    data = np.flip(data, (1, 2))
+        # Flip matrix in RO/PE to be consistent with ICE
+        data = np.flip(data, (1, 2))
 
     logging.debug("Raw data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "raw.npy", data)
 
     # Fourier Transform
-    data = fft.fftshift( data, axes=(1, 2))
-    data = fft.ifft2(    data, axes=(1, 2))
-    data = fft.ifftshift(data, axes=(1, 2))
-    data *= np.prod(data.shape) # FFT scaling for consistency with ICE
+    with mrdhelper.stage('fft'):
+        data = fft.fftshift( data, axes=(1, 2))
+        data = fft.ifft2(    data, axes=(1, 2))
+        data = fft.ifftshift(data, axes=(1, 2))
+        data *= np.prod(data.shape) # FFT scaling for consistency with ICE
 
     # Sum of squares coil combination
     # Data will be [PE RO phs]
-    data = np.abs(data)
-    data = np.square(data)
-    data = np.sum(data, axis=0)
-    data = np.sqrt(data)
+    with mrdhelper.stage('coil-combine'):
+        data = np.abs(data)
+        data = np.square(data)
+        data = np.sum(data, axis=0)
+        data = np.sqrt(data)
 
     logging.debug("Image data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "img.npy", data)
 
-    # Remove readout oversampling
-    if mrdHeader.encoding[0].reconSpace.matrixSize.x != 0:
-        offset = int((data.shape[1] - mrdHeader.encoding[0].reconSpace.matrixSize.x)/2)
-        data = data[:,offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.x]
-
-    # Remove phase oversampling
-    if mrdHeader.encoding[0].reconSpace.matrixSize.y != 0:
-        offset = int((data.shape[0] - mrdHeader.encoding[0].reconSpace.matrixSize.y)/2)
-        data = data[offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.y,:]
+    # Remove readout and phase oversampling
+    with mrdhelper.stage('crop'):
+        # Remove readout oversampling
+        if mrdHeader.encoding[0].reconSpace.matrixSize.x != 0:
+            offset = int((data.shape[1] - mrdHeader.encoding[0].reconSpace.matrixSize.x)/2)
+            data = data[:,offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.x]
 
-    logging.debug("Image without oversampling is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "imgCrop.npy", data)
+        # Remove phase oversampling
+        if mrdHeader.encoding[0].reconSpace.matrixSize.y != 0:
+            offset = int((data.shape[0] - mrdHeader.encoding[0].reconSpace.matrixSize.y)/2)
+            data = data[offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.y,:]
 
-    # Measure processing time
-    toc = perf_counter()
-    strProcessTime = "Total processing time: %.2f ms" % ((toc-tic)*1000.0)
-    logging.info(strProcessTime)
-
-    # Send this as a text message back to the client
-    connection.send_logging(constants.MRD_LOGGING_INFO, strProcessTime)
+        logging.debug("Image without oversampling is size %s" % (data.shape,))
+        np.save(debugFolder + "/" + "imgCrop.npy", data)
 
     # Format as ISMRMRD image data
-    imagesOut = []
-    for phs in range(data.shape[2]):
-        # Create new MRD instance for the processed image
-        # data has shape [PE RO phs], i.e. [y x].
-        # from_array() should be called with 'transpose=False' to avoid warnings, and when called
-        # with this option, can take input as: [cha z y x], [z y x], or [y x]
-        tmpImg = ismrmrd.Image.from_array(data[...,phs], transpose=False)
-
-        # Set the header information
-        tmpImg.setHead(mrdhelper.update_img_header_from_raw(tmpImg.getHead(), rawHead[phs]))
-        tmpImg.field_of_view = (ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.x), 
-                                ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.y), 
-                                ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.z))
-        tmpImg.image_index = phs
-
-        # Set ISMRMRD Meta Attributes
-        tmpMeta = ismrmrd.Meta()
-        tmpMeta['DataRole']               = 'Image'
-        tmpMeta['ImageProcessingHistory'] = ['FIRE', 'PYTHON']
-        tmpMeta['Keep_image_geometry']    = 1
-
-        xml = tmpMeta.serialize()
-        logging.debug("Image MetaAttributes: %s", xml)
-        tmpImg.attribute_string = xml
-        imagesOut.append(tmpImg)
+    with mrdhelper.stage('meta'):
+        imagesOut = []
+        for phs in range(data.shape[2]):
+            # Create new MRD instance for the processed image
+            # data has shape [PE RO phs], i.e. [y x].
+            # from_array() should be called with 'transpose=False' to avoid warnings, and when called
+            # with this option, can take input as: [cha z y x], [z y x], or [y x]
+            tmpImg = ismrmrd.Image.from_array(data[...,phs], transpose=False)
+
+            # Set the header information
+            tmpImg.setHead(mrdhelper.update_img_header_from_raw(tmpImg.getHead(), rawHead[phs]))
+            tmpImg.field_of_view = (ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.x), 
+                                    ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.y), 
+                                    ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.z))
+            tmpImg.image_index = phs
+
+            # Set ISMRMRD Meta Attributes
+            tmpMeta = ismrmrd.Meta()
+            tmpMeta['DataRole']               = 'Image'
+            tmpMeta['ImageProcessingHistory'] = ['FIRE', 'PYTHON']
+            tmpMeta['Keep_image_geometry']    = 1
+
+            xml = tmpMeta.serialize()
+            logging.debug("Image MetaAttributes: %s", xml)
+            tmpImg.attribute_string = xml
+            imagesOut.append(tmpImg)
 
     # Call process_image() to invert image contrast
     imagesOut = process_image(imagesOut, connection, config, mrdHeader)
@@ -250,6 +272,7 @@ def process_raw(acqGroup, connection, config, mrdHeader):
     return imagesOut
 
 
+@mrdhelper.timed_stage
 def process_image(imgGroup, connection, config, mrdHeader):
     if len(imgGroup) == 0:
         return []
@@ -268,12 +291,13 @@ def process_image(imgGroup, connection, config, mrdHeader):
     # Note: The MRD Image class stores data as [cha z y x]
 
     # Extract image data into a 5D array of size [img cha z y x]
-    data = np.stack([img.data                              for img in imgGroup])
-    head = [img.getHead()                                  for img in imgGroup]
-    meta = [ismrmrd.Meta.deserialize(img.attribute_string) for img in imgGroup]
+    with mrdhelper.stage('sort'):
+        data = np.stack([img.data                              for img in imgGroup])
+        head = [img.getHead()                                  for img in imgGroup]
+        meta = [ismrmrd.Meta.deserialize(img.attribute_string) for img in imgGroup]
 
-    # Reformat data to [y x z cha img], i.e. [row col] for the first two dimensions
-    data = data.transpose((3, 4, 2, 1, 0))
+        # Reformat data to [y x z cha img], i.e. [row col] for the first two dimensions
+        data = data.transpose((3, 4, 2, 1, 0))
 
     # Display MetaAttributes for first image
     logging.debug("MetaAttributes[0]: %s", ismrmrd.Meta.serialize(meta[0]))
@@ -285,27 +309,29 @@ def process_image(imgGroup, connection, config, mrdHeader):
     logging.debug("Original image data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "imgOrig.npy", data)
 
-    if mrdhelper.get_json_config_param(config, 'options') == 'complex':
-        # Complex images are requested
-        data = data.astype(np.complex64)
-        maxVal = data.max()
-    else:
-        # Determine max value (12 or 16 bit)
-        BitsStored = 12
-        if (mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored") is not None):
-            BitsStored = mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored")
-        maxVal = 2**BitsStored - 1
-
-        # Normalize and convert to int16
-        data = data.astype(np.float64)
-        data *= maxVal/data.max()
-        data = np.around(data)
-        data = data.astype(np.int16)
+    with mrdhelper.stage('quantize'):
+        if mrdhelper.get_json_config_param(config, 'options') == 'complex':
+            # Complex images are requested
+            data = data.astype(np.complex64)
+            maxVal = data.max()
+        else:
+            # Determine max value (12 or 16 bit)
+            BitsStored = 12
+            if (mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored") is not None):
+                BitsStored = mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored")
+            maxVal = 2**BitsStored - 1
+
+            # Normalize and convert to int16
+            data = data.astype(np.float64)
+            data *= maxVal/data.max()
+            data = np.around(data)
+            data = data.astype(np.int16)
 
     # Invert image contrast
-    data = maxVal-data
-    data = np.abs(data)
-    np.save(debugFolder + "/" + "imgInverted.npy", data)
+    with mrdhelper.stage('invert'):
+        data = maxVal-data
+        data = np.abs(data)
+        np.save(debugFolder + "/" + "imgInverted.npy", data)
 
     if mrdhelper.get_json_config_param(config, 'options') == 'rgb':
         logging.info('Converting data into RGB')
@@ -336,85 +362,87 @@ def process_image(imgGroup, connection, config, mrdHeader):
     currentSeries = 0
 
     # Re-slice back into 2D images
-    imagesOut = [None] * data.shape[-1]
-    for iImg in range(data.shape[-1]):
-        # Create new MRD instance for the inverted image
-        # Transpose from convenience shape of [y x z cha] to MRD Image shape of [cha z y x]
-        # from_array() should be called with 'transpose=False' to avoid warnings, and when called
-        # with this option, can take input as: [cha z y x], [z y x], or [y x]
-        imagesOut[iImg] = ismrmrd.Image.from_array(data[...,iImg].transpose((3, 2, 0, 1)), transpose=False)
-
-        # Create a copy of the original fixed header and update the data_type
-        # (we changed it to int16 from all other types)
-        oldHeader = head[iImg]
-        oldHeader.data_type = imagesOut[iImg].data_type
-
-        # Set the image_type to match the data_type for complex data
-        if (imagesOut[iImg].data_type == ismrmrd.DATATYPE_CXFLOAT) or (imagesOut[iImg].data_type == ismrmrd.DATATYPE_CXDOUBLE):
-            oldHeader.image_type = ismrmrd.IMTYPE_COMPLEX
-
-        if mrdhelper.get_json_config_param(config, 'options') == 'rgb':
-            # Set RGB parameters
-            oldHeader.image_type = 6  # To be defined as ismrmrd.IMTYPE_RGB
-            oldHeader.channels   = 3  # RGB "channels".  This is set by from_array, but need to be explicit as we're copying the old header instead
-
-        # Unused example, as images are grouped by series before being passed into this function now
-        # oldHeader.image_series_index = currentSeries
-
-        # Increment series number when flag detected (i.e. follow ICE logic for splitting series)
-        if mrdhelper.get_meta_value(meta[iImg], 'IceMiniHead') is not None:
-            if mrdhelper.extract_minihead_bool_param(base64.b64decode(meta[iImg]['IceMiniHead']).decode('utf-8'), 'BIsSeriesEnd') is True:
-                currentSeries += 1
-
-        imagesOut[iImg].setHead(oldHeader)
-
-        # Create a copy of the original ISMRMRD Meta attributes and update
-        tmpMeta = meta[iImg]
-        tmpMeta['DataRole']                       = 'Image'
-        tmpMeta['ImageProcessingHistory']         = ['PYTHON', 'INVERT']
-        tmpMeta['WindowCenter']                   = str((maxVal+1)/2)
-        tmpMeta['WindowWidth']                    = str((maxVal+1))
-        tmpMeta['SequenceDescriptionAdditional']  = 'FIRE'
-        tmpMeta['Keep_image_geometry']            = 1
-
-        if mrdhelper.get_json_config_param(config, 'options') == 'roi':
-            # Example for sending ROIs
-            logging.info("Creating ROI_example")
-            tmpMeta['ROI_example'] = create_example_roi(data.shape)
-
-        if mrdhelper.get_json_config_param(config, 'options') == 'colormap':
-            # Example for setting colormap
-            tmpMeta['LUTFileName'] = 'MicroDeltaHotMetal.pal'
-
-        if mrdhelper.get_json_config_param(config, 'options') == 'rgb':
-            # Example for setting RGB
-            tmpMeta['SequenceDescriptionAdditional']  = 'FIRE_RGB'
-            tmpMeta['ImageProcessingHistory'].append('RGB')
-
-            # RGB images have no windowing
-            del tmpMeta['WindowCenter']
-            del tmpMeta['WindowWidth']
-
-            # RGB images shouldn't undergo further processing, e.g. orientation or distortion correction
-            tmpMeta['InternalSend'] = 1
-
-        # Add image orientation directions to MetaAttributes if not already present
-        if tmpMeta.get('ImageRowDir') is None:
-            tmpMeta['ImageRowDir'] = ["{:.18f}".format(oldHeader.read_dir[0]), "{:.18f}".format(oldHeader.read_dir[1]), "{:.18f}".format(oldHeader.read_dir[2])]
-
-        if tmpMeta.get('ImageColumnDir') is None:
-            tmpMeta['ImageColumnDir'] = ["{:.18f}".format(oldHeader.phase_dir[0]), "{:.18f}".format(oldHeader.phase_dir[1]), "{:.18f}".format(oldHeader.phase_dir[2])]
-
-        metaXml = tmpMeta.serialize()
-        logging.debug("Image MetaAttributes: %s", xml.dom.minidom.parseString(metaXml).toprettyxml())
-        logging.debug("Image data has %d elements", imagesOut[iImg].data.size)
-
-        imagesOut[iImg].attribute_string = metaXml
+    with mrdhelper.stage('meta'):
+        imagesOut = [None] * data.shape[-1]
+        for iImg in range(data.shape[-1]):
+            # Create new MRD instance for the inverted image
+            # Transpose from convenience shape of [y x z cha] to MRD Image shape of [cha z y x]
+            # from_array() should be called with 'transpose=False' to avoid warnings, and when called
+            # with this option, can take input as: [cha z y x], [z y x], or [y x]
+            imagesOut[iImg] = ismrmrd.Image.from_array(data[...,iImg].transpose((3, 2, 0, 1)), transpose=False)
+
+            # Create a copy of the original fixed header and update the data_type
+            # (we changed it to int16 from all other types)
+            oldHeader = head[iImg]
+            oldHeader.data_type = imagesOut[iImg].data_type
+
+            # Set the image_type to match the data_type for complex data
+            if (imagesOut[iImg].data_type == ismrmrd.DATATYPE_CXFLOAT) or (imagesOut[iImg].data_type == ismrmrd.DATATYPE_CXDOUBLE):
+                oldHeader.image_type = ismrmrd.IMTYPE_COMPLEX
+
+            if mrdhelper.get_json_config_param(config, 'options') == 'rgb':
+                # Set RGB parameters
+                oldHeader.image_type = 6  # To be defined as ismrmrd.IMTYPE_RGB
+                oldHeader.channels   = 3  # RGB "channels".  This is set by from_array, but need to be explicit as we're copying the old header instead
+
+            # Unused example, as images are grouped by series before being passed into this function now
+            # oldHeader.image_series_index = currentSeries
+
+            # Increment series number when flag detected (i.e. follow ICE logic for splitting series)
+            if mrdhelper.get_meta_value(meta[iImg], 'IceMiniHead') is not None:
+                if mrdhelper.extract_minihead_bool_param(base64.b64decode(meta[iImg]['IceMiniHead']).decode('utf-8'), 'BIsSeriesEnd') is True:
+                    currentSeries += 1
+
+            imagesOut[iImg].setHead(oldHeader)
+
+            # Create a copy of the original ISMRMRD Meta attributes and update
+            tmpMeta = meta[iImg]
+            tmpMeta['DataRole']                       = 'Image'
+            tmpMeta['ImageProcessingHistory']         = ['PYTHON', 'INVERT']
+            tmpMeta['WindowCenter']                   = str((maxVal+1)/2)
+            tmpMeta['WindowWidth']                    = str((maxVal+1))
+            tmpMeta['SequenceDescriptionAdditional']  = 'FIRE'
+            tmpMeta['Keep_image_geometry']            = 1
+
+            if mrdhelper.get_json_config_param(config, 'options') == 'roi':
+                # Example for sending ROIs
+                logging.info("Creating ROI_example")
+                tmpMeta['ROI_example'] = create_example_roi(data.shape)
+
+            if mrdhelper.get_json_config_param(config, 'options') == 'colormap':
+                # Example for setting colormap
+                tmpMeta['LUTFileName'] = 'MicroDeltaHotMetal.pal'
+
+            if mrdhelper.get_json_config_param(config, 'options') == 'rgb':
+                # Example for setting RGB
+                tmpMeta['SequenceDescriptionAdditional']  = 'FIRE_RGB'
+                tmpMeta['ImageProcessingHistory'].append('RGB')
+
+                # RGB images have no windowing
+                del tmpMeta['WindowCenter']
+                del tmpMeta['WindowWidth']
+
+                # RGB images shouldn't undergo further processing, e.g. orientation or distortion correction
+                tmpMeta['InternalSend'] = 1
+
+            # Add image orientation directions to MetaAttributes if not already present
+            if tmpMeta.get('ImageRowDir') is None:
+                tmpMeta['ImageRowDir'] = ["{:.18f}".format(oldHeader.read_dir[0]), "{:.18f}".format(oldHeader.read_dir[1]), "{:.18f}".format(oldHeader.read_dir[2])]
+
+            if tmpMeta.get('ImageColumnDir') is None:
+                tmpMeta['ImageColumnDir'] = ["{:.18f}".format(oldHeader.phase_dir[0]), "{:.18f}".format(oldHeader.phase_dir[1]), "{:.18f}".format(oldHeader.phase_dir[2])]
+
+            metaXml = tmpMeta.serialize()
+            logging.debug("Image MetaAttributes: %s", xml.dom.minidom.parseString(metaXml).toprettyxml())
+            logging.debug("Image data has %d elements", imagesOut[iImg].data.size)
+
+            imagesOut[iImg].attribute_string = metaXml
 
     # Send a copy of original (unmodified) images back too
     if mrdhelper.get_json_config_param(config, 'sendOriginal', default=False, type='bool') == True:
+        # Called from process_raw(), possibly through a tracing wrapper
         stack = traceback.extract_stack()
-        if stack[-2].name == 'process_raw':
+        if 'process_raw' in [frame.name for frame in stack[:-1]]:
             logging.warning('sendOriginal is true, but input was raw data, so no original images to return!')
         else:
             logging.info('Sending a copy of original unmodified images due to sendOriginal set to True')
@@ -427,9 +455,7 @@ def process_image(imgGroup, connection, config, mrdHeader):
                 tmpImg.image_series_index = 99
 
                 # Ensure Keep_image_geometry is set to not reverse image orientation
-                tmpMeta = ismrmrd.Meta.deserialize(tmpImg.attribute_string)
-                tmpMeta['Keep_image_geometry'] = 1
-                tmpImg.attribute_string = tmpMeta.serialize()
+                mrdhelper.set_meta_values(tmpImg, {'Keep_image_geometry': 1})
 
                 imagesOut.insert(0, tmpImg)
 
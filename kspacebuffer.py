@@ -0,0 +1,145 @@
+# Accumulation of imaging readouts into a k-space array, spilling to disk for
+# scans that are larger than the memory budget
+import logging
+import os
+import tempfile
+import ismrmrd
+import numpy as np
+import mrdhelper
+
+# Defaults for all sessions, set from the server's --kspaceMemoryBudget and
+# --scratchFolder options.  The budget can be overridden for a session by the
+# "kspaceMemoryBudget" JSON config parameter (in MB).
+defaultMemoryBudget = 1024*1024*1024
+scratchFolder       = tempfile.gettempdir()
+
+class KSpaceBuffer:
+    """
+    Replaces a list of acquisitions (acqGroup) that is formatted into a
+    zero-filled [cha PE RO phs] array once the group is complete.  Each readout
+    is copied into the array as it is added, so the acquisitions don't need to
+    be kept and the k-space is only held once.
+
+    The array is sized from the encoded matrix size in the MRD header and the
+    highest phase index seen so far.  If it would be larger than the memory
+    budget, it is a np.memmap of a file in the scratch folder instead, which the
+    OS pages in and out as needed.  Either way, .data is a normal ndarray view.
+    """
+
+    def __init__(self, mrdHeader, config=None):
+        self.mrdHeader    = mrdHeader
+        self.memoryBudget = mrdhelper.get_json_config_param(config, 'kspaceMemoryBudget', default=defaultMemoryBudget/1024/1024, type='float')*1024*1024
+        self.buffer       = None
+        self.paths        = []    # Scratch files that have not been removed yet
+        self.count        = 0
+        self.heads        = []    # For each phase, the header of the readout closest to the center of k-space
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def data(self):
+        """[cha PE RO phs] k-space"""
+        return self.buffer[..., :len(self.heads)]
+
+    def add(self, acq):
+        lin = acq.idx.kspace_encode_step_1
+        phs = acq.idx.phase
+
+        if self.buffer is None:
+            # Use the zero-padded matrix size
+            self.allocate((acq.data.shape[0],
+                           self.mrdHeader.encoding[0].encodedSpace.matrixSize.y,
+                           self.mrdHeader.encoding[0].encodedSpace.matrixSize.x,
+                           phs+1),
+                          acq.data.dtype)
+        elif phs >= self.buffer.shape[3]:
+            self.grow(max(phs+1, 2*self.buffer.shape[3]))
+
+        self.count += 1
+        if phs >= len(self.heads):
+            self.heads.extend([None]*(phs+1-len(self.heads)))
+
+        if lin < self.buffer.shape[1]:
+            # TODO: Account for asymmetric echo in a better way
+            self.buffer[:,lin,-acq.data.shape[1]:,phs] = acq.data
+
+            # center line of k-space is encoded in user[5]
+            if (self.heads[phs] is None) or (np.abs(acq.idx.kspace_encode_step_1 - acq.idx.user[5]) < np.abs(self.heads[phs].idx.kspace_encode_step_1 - self.heads[phs].idx.user[5])):
+                self.heads[phs] = acq.getHead()
+
+    def add_batch(self, headers, data):
+        """
+        Add readouts read by Connection.read_acquisition_batch(), with headers
+        a structured array [n] of acquisition headers and data [n cha samples]
+        """
+        if len(headers) == 0:
+            return
+
+        lin = headers['idx']['kspace_encode_step_1'].astype(int)
+        phs = headers['idx']['phase'].astype(int)
+
+        if self.buffer is None:
+            # Use the zero-padded matrix size
+            self.allocate((data.shape[1],
+                           self.mrdHeader.encoding[0].encodedSpace.matrixSize.y,
+                           self.mrdHeader.encoding[0].encodedSpace.matrixSize.x,
+                           phs.max()+1),
+                          data.dtype)
+        elif phs.max() >= self.buffer.shape[3]:
+            self.grow(max(phs.max()+1, 2*self.buffer.shape[3]))
+
+        self.count += len(headers)
+        if phs.max() >= len(self.heads):
+            self.heads.extend([None]*(phs.max()+1-len(self.heads)))
+
+        inside = lin < self.buffer.shape[1]
+        lin, phs, headers, data = lin[inside], phs[inside], headers[inside], data[inside]
+        self.buffer[:,lin,-data.shape[2]:,phs] = data
+
+        # center line of k-space is encoded in user[5]
+        distance = np.abs(lin - headers['idx']['user'][:,5].astype(int))
+        for p in np.unique(phs):
+            i = np.flatnonzero(phs == p)[np.argmin(distance[phs == p])]
+            if (self.heads[p] is None) or (distance[i] < np.abs(self.heads[p].idx.kspace_encode_step_1 - self.heads[p].idx.user[5])):
+                self.heads[p] = ismrmrd.AcquisitionHeader.from_buffer_copy(headers[i].tobytes())
+
+    def allocate(self, shape, dtype):
+        nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+        if nbytes <= self.memoryBudget:
+            self.buffer = np.zeros(shape, dtype)
+            return
+
+        # Zero-filled sparse file.  It is unlinked right away where possible, so
+        # that it is removed even if the process is killed.
+        fd, path = tempfile.mkstemp(prefix='kspace_', suffix='.dat', dir=scratchFolder)
+        os.close(fd)
+        self.buffer = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        self.paths.append(path)
+        logging.info("K-space of %.1f MB exceeds the memory budget of %.1f MB -- buffering in %s", nbytes/1024/1024, self.memoryBudget/1024/1024, path)
+        self.remove_files()
+
+    def grow(self, phases):
+        old = self.buffer
+        self.allocate(old.shape[:3] + (phases,), old.dtype)
+        self.buffer[..., :old.shape[3]] = old
+
+        del old
+        self.remove_files()
+
+    def remove_files(self):
+        # On Windows, a file can't be removed while it is mapped, so this is
+        # retried once the buffer is released
+        for path in list(self.paths):
+            try:
+                os.remove(path)
+                self.paths.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """Release the k-space to start a new group"""
+        self.buffer = None
+        self.count  = 0
+        self.heads  = []
+        self.remove_files()
@@ -0,0 +1,113 @@
+# Image type for received images that defers parsing until it is needed
+import ctypes
+import ismrmrd
+import numpy as np
+from xml.sax.saxutils import escape
+
+class LazyImage(ismrmrd.Image):
+    """
+    ismrmrd.Image created from the raw bytes of a received image message,
+    returned by Connection when lazyImages is enabled.
+
+    The attribute string is kept as received and only parsed into an
+    ismrmrd.Meta when .meta is used (or the image is changed through a method
+    that needs it), and the data is a view of the received buffer rather than
+    a copy.  When sent, the unparsed attribute bytes and the data buffer are
+    written as they are, so an image that is passed through unchanged (or after
+    patch_meta()) costs about one copy into the socket.
+
+    The data is written without a copy when the message is sent right away,
+    and copied when the Connection holds it in its send buffer (sendBufferSize
+    > 0), so the image can be modified after it is sent.
+    """
+
+    def __init__(self, header_bytes, attribute_bytes, data_buffer=None):
+        # ismrmrd.Image.__init__() is not called, as it parses the attribute
+        # string.  If data_buffer (a uint8 ndarray) is not given, an uninitialized
+        # buffer is allocated to receive the data into.
+        self._head           = ismrmrd.ImageHeader.from_buffer_copy(header_bytes)
+        self._attributeBytes = attribute_bytes
+        self._meta           = None
+
+        dtype = ismrmrd.get_dtype_from_data_type(self._head.data_type)
+        shape = (self._head.channels, self._head.matrix_size[2], self._head.matrix_size[1], self._head.matrix_size[0])
+        if data_buffer is None:
+            data_buffer = np.empty(int(np.prod(shape))*dtype.itemsize, dtype=np.uint8)
+        self._data = data_buffer.view(dtype).reshape(shape)
+
+    # ismrmrd.Image methods access its private __data and __meta attributes
+    # (name mangled to _Image__data and _Image__meta), so they are redirected
+    # to the lazy versions here
+    @property
+    def _Image__data(self):
+        return self._data
+
+    @_Image__data.setter
+    def _Image__data(self, val):
+        self._data = val
+
+    @property
+    def _Image__meta(self):
+        if self._meta is None:
+            self._meta = ismrmrd.Meta.deserialize(self._attributeBytes.decode('utf-8'))
+            self._attributeBytes = None
+        return self._meta
+
+    @_Image__meta.setter
+    def _Image__meta(self, val):
+        self._meta           = val
+        self._attributeBytes = None
+
+    @property
+    def attribute_string(self):
+        if self._meta is None:
+            return self._attributeBytes.decode('utf-8')
+        return self._meta.serialize()
+
+    @attribute_string.setter
+    def attribute_string(self, val):
+        # Parsed again only if needed
+        self._meta           = None
+        self._attributeBytes = val.encode('utf-8')
+
+    @property
+    def attribute_string_len(self):
+        return len(self.attribute_bytes())
+
+    def attribute_bytes(self):
+        if self._meta is None:
+            return self._attributeBytes
+        return self._meta.serialize().encode('utf-8')
+
+    def patch_meta(self, values):
+        """
+        Set Meta attributes from a dict.  New attributes are appended to the
+        attribute XML without parsing it; if an attribute already exists (or the
+        Meta has already been parsed) it is updated through .meta instead.
+        """
+        if self._meta is None:
+            if len(self._attributeBytes) == 0:
+                self._attributeBytes = ismrmrd.Meta(values).serialize().encode('utf-8')
+                return
+
+            end = self._attributeBytes.rfind(b'</ismrmrdMeta>')
+            if (end >= 0) and all([('<name>%s</name>' % escape(name)).encode('utf-8') not in self._attributeBytes for name in values]):
+                elements = []
+                for name, value in values.items():
+                    elements.append('<meta><name>%s</name>' % escape(name))
+                    for item in (value if isinstance(value, list) else [value]):
+                        elements.append('<value>%s</value>' % escape(str(item)))
+                    elements.append('</meta>')
+                self._attributeBytes = self._attributeBytes[:end] + ''.join(elements).encode('utf-8') + self._attributeBytes[end:]
+                return
+
+        self.meta.update(values)
+
+    def serialize_into(self, write):
+        attribute_bytes = self.attribute_bytes()
+        self._head.attribute_string_len = len(attribute_bytes)
+
+        write(self._head)
+        write(ctypes.c_uint64(len(attribute_bytes)))
+        write(attribute_bytes)
+        write(memoryview(np.ascontiguousarray(self._data).reshape(-1).view(np.uint8)))
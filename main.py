@@ -1,28 +1,89 @@
 #!/usr/bin/python3
 
-from server import Server
+import cpubudget
+import serverlog
 
 import argparse
 import logging
 import sys
 import os
 import signal
+import tempfile
 
 defaults = {
     'host':           '0.0.0.0',
     'port':           9002,
     'defaultConfig':  'invertcontrast',
-    'savedataFolder': '/tmp/share/saved_data'
+    'savedataFolder': '/tmp/share/saved_data',
+    'sendBufferSize': 0,
+    'prefetch':       0,
+    'prefetchBytes':  256*1024*1024,
+    'sharedMemory':   False,
+    'savedataMode':   'sync',
+    'savedataCompression': 'none',
+    'savedataChunk':  0,
+    'kspaceMemoryBudget': 1024,
+    'scratchFolder':  tempfile.gettempdir(),
+    'workers':        0,
+    'maxSessionsPerWorker': 0,
+    'configFolder':   [],
+    'preload':        ['simplefft', 'invertcontrast', 'analyzeflow'],
+    'backlog':        0,
+    'maxSessions':    0,
+    'configLimit':    [],
+    'configPriority': [],
+    'threads':        0,
+    'metricsPort':    0,
+    'metricsHost':    '127.0.0.1',
+    'profile':        'none',
+    'profileInterval': 5,
+    'memoryReport':   'none',
+    'memoryTopSites': 10,
+    'memoryLimit':    0,
+    'logFormat':      'text',
+    'logInterval':    1.0,
+    'numericThreads': 'none',
+    'cpuAffinity':    False
 }
 
+def parse_config_values(values):
+    # ['config=N', ...] to {'config': N}
+    parsed = {}
+    for value in values:
+        name, sep, number = value.rpartition('=')
+        if not sep or not name:
+            raise ValueError("Expected <config>=<number>, got '%s'" % value)
+        parsed[name] = int(number)
+    return parsed
+
 def main(args):
+    # Imported here, after the thread budget is set in the environment, as
+    # numerical libraries read it when numpy is imported
+    from server import Server
+    import kspacebuffer
+
+    kspacebuffer.defaultMemoryBudget = args.kspaceMemoryBudget*1024*1024
+    kspacebuffer.scratchFolder       = args.scratchFolder
+    serverlog.messageInterval        = args.logInterval
+
     # Create a multi-threaded dispatcher to handle incoming connections
-    server = Server(args.host, args.port, args.defaultConfig, args.savedata, args.savedataFolder, args.multiprocessing)
+    server = Server(args.host, args.port, args.defaultConfig, args.savedata, args.savedataFolder, args.multiprocessing,
+                    sendBufferSize=args.sendBufferSize, prefetchDepth=args.prefetch, prefetchBytes=args.prefetchBytes, sharedMemory=args.sharedMemory,
+                    savedataMode=args.savedataMode, savedataCompression=args.savedataCompression, savedataShuffle=args.savedataShuffle, savedataChunk=args.savedataChunk,
+                    workers=args.workers, maxSessionsPerWorker=args.maxSessionsPerWorker, threads=args.threads, backlog=args.backlog,
+                    configFolders=args.configFolder, preload=args.preload, warmup=args.warmup,
+                    maxSessions=args.maxSessions, configLimits=args.configLimit, configPriorities=args.configPriority,
+                    metricsPort=args.metricsPort, metricsSocket=args.metricsSocket, metricsHost=args.metricsHost,
+                    trace=args.trace, profile=args.profile, profileInterval=args.profileInterval,
+                    memoryReport=args.memoryReport, memoryTopSites=args.memoryTopSites, memoryLimit=args.memoryLimit,
+                    numericThreads=args.numericThreads, cpuAffinity=args.cpuAffinity)
 
     # Trap signal interrupts (e.g. ctrl+c, SIGTERM) and gracefully stop
     def handle_signals(signum, frame):
         print("Received signal interrupt -- stopping server")
-        server.socket.close()
+        if not args.asyncio:
+            # The event loop closes its listening socket itself as it shuts down
+            server.socket.close()
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, handle_signals)
@@ -33,7 +94,10 @@ def main(args):
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
     # Start server
-    server.serve()
+    if args.asyncio:
+        server.serve_asyncio()
+    else:
+        server.serve()
 
 if __name__ == '__main__':
 
@@ -43,17 +107,74 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port',            type=int,            help='Port')
     parser.add_argument('-H', '--host',            type=str,            help='Host')
     parser.add_argument('-d', '--defaultConfig',   type=str,            help='Default (fallback) config module')
+    parser.add_argument(      '--configFolder',    type=str,            action='append', help='Additional folder with config modules, besides the server\'s folder and its custom folder (can be repeated)')
+    parser.add_argument(      '--preload',         type=str,            nargs='*', help="Config modules to import when the server starts ('all' for every config module found)")
+    parser.add_argument(      '--warmup',          action='store_true', help='Call the warmup() function of preloaded config modules, if they have one')
     parser.add_argument('-v', '--verbose',         action='store_true', help='Verbose output.')
     parser.add_argument('-l', '--logfile',         type=str,            help='Path to log file')
     parser.add_argument('-s', '--savedata',        action='store_true', help='Save incoming data')
     parser.add_argument('-S', '--savedataFolder',  type=str,            help='Folder to save incoming data')
+    parser.add_argument(      '--trace',           action='store_true', help='Save a timeline of each session to --savedataFolder as a trace event JSON file (for Perfetto or chrome://tracing)')
+    parser.add_argument(      '--profile',         type=str,            choices=['none', 'cprofile', 'sample'], help="Profile each session's config module and save the profile to --savedataFolder (can also be set for a session by the 'profile' JSON config parameter)")
+    parser.add_argument(      '--profileInterval', type=float,          help='Milliseconds between samples with --profile sample')
+    parser.add_argument(      '--memoryReport',    type=str,            choices=['none', 'rss', 'tracemalloc'], help="Report the peak resident memory of each session and its stages ('rss'), and the top allocation sites ('tracemalloc'), at the end of the session (can also be set for a session by the 'memoryReport' JSON config parameter)")
+    parser.add_argument(      '--memoryTopSites',  type=int,            help='Number of allocation sites reported with --memoryReport tracemalloc')
+    parser.add_argument(      '--memoryLimit',     type=int,            help='Limit the memory (address space, in MB) of each process started for a session (-m, --workers), so that a session over it ends with an error (0 for no limit)')
+    parser.add_argument(      '--numericThreads',  type=str,            help="Threads used by numerical libraries (BLAS, OpenMP) for each session: 'none' for the libraries' defaults, 'auto' to divide the CPUs between concurrent sessions (--workers, --threads or --maxSessions), or a number")
+    parser.add_argument(      '--cpuAffinity',     action='store_true', help='Pin each process handling sessions (-m, --workers) to its own set of --numericThreads CPUs')
     parser.add_argument('-m', '--multiprocessing', action='store_true', help='Use multiprocessing')
+    parser.add_argument('-w', '--workers',         type=int,            help='With --multiprocessing, number of pre-started worker processes (0 to start a process for each connection)')
+    parser.add_argument(      '--maxSessionsPerWorker', type=int,       help='Sessions handled by a worker process before it is replaced (0 for no limit)')
+    parser.add_argument('-t', '--threads',         type=int,            help='Number of sessions handled at the same time by a pool of threads (0 to handle sessions one at a time).  With --asyncio, the number of threads running config modules (0 for Python\'s default), separate from the threads used for short blocking calls.')
+    parser.add_argument(      '--backlog',         type=int,            help='Number of pending connections the listening socket can hold')
+    parser.add_argument(      '--maxSessions',     type=int,            help='Maximum number of sessions processed at the same time (0 for no limit).  Further sessions wait in a queue.')
+    parser.add_argument(      '--configLimit',     type=str,            action='append', help='Maximum number of concurrent sessions for a config, as <config>=<number> (can be repeated)')
+    parser.add_argument(      '--configPriority',  type=str,            action='append', help='Queue priority of a config (higher first, default 0), as <config>=<number> (can be repeated)')
+    parser.add_argument(      '--asyncio',         action='store_true', help='Handle connections on a single asyncio event loop')
+    parser.add_argument('-b', '--sendBufferSize',  type=int,            help='Bytes of outgoing image data to coalesce before sending (0 to send each batch immediately)')
+    parser.add_argument(      '--prefetch',        type=int,            help='Number of incoming messages to read ahead in a background thread (0 to disable)')
+    parser.add_argument(      '--prefetchBytes',   type=int,            help='Maximum bytes of incoming data held by --prefetch')
+    parser.add_argument(      '--sharedMemory',    action='store_true', help='Allow clients on the same host to send data through shared memory')
+    parser.add_argument(      '--savedataMode',    type=str,            choices=['sync', 'async', 'durable'], help='Write saved data in the receiving thread (sync), on a background thread (async), or on a background thread and synced to disk before the close is acknowledged (durable)')
+    parser.add_argument(      '--savedataCompression', type=str,       help="Compression of saved datasets: 'none', 'gzip', 'gzip:<level>' or 'lzf'")
+    parser.add_argument(      '--savedataShuffle', action='store_true', help='Use the shuffle filter with --savedataCompression')
+    parser.add_argument(      '--savedataChunk',   type=int,            help='Records (acquisitions, waveforms or images) per chunk of saved datasets (0 for automatic)')
+    parser.add_argument(      '--kspaceMemoryBudget', type=float,      help='MB of k-space a config module may buffer in memory before spilling to a file in --scratchFolder')
+    parser.add_argument(      '--scratchFolder',   type=str,            help='Folder for k-space buffered on disk')
+    parser.add_argument(      '--metricsPort',     type=int,            help='Port for an HTTP endpoint with server metrics in the Prometheus text format (0 to disable)')
+    parser.add_argument(      '--metricsHost',     type=str,            help='Address the metrics endpoint listens on')
+    parser.add_argument(      '--metricsSocket',   type=str,            help='Path of a Unix socket serving the metrics endpoint')
     parser.add_argument('-r', '--crlf',            action='store_true', help='Use Windows (CRLF) line endings')
+    parser.add_argument(      '--logFormat',       type=str,            choices=['text', 'json'], help='Log as text lines or as one JSON object per line')
+    parser.add_argument(      '--logInterval',     type=float,          help='Seconds between log lines for repeated messages of a kind (e.g. each image received), or 0 to log every message')
+    parser.add_argument(      '--logSync',         action='store_true', help='Write logs in the thread that logs them instead of a background thread')
 
     parser.set_defaults(**defaults)
 
     args = parser.parse_args()
 
+    try:
+        args.configLimit    = parse_config_values(args.configLimit)
+        args.configPriority = parse_config_values(args.configPriority)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.multiprocessing and (args.threads > 0):
+        parser.error("--threads cannot be combined with --multiprocessing")
+
+    # Sessions that can run at the same time share the CPUs
+    if args.multiprocessing and (args.workers > 0):
+        concurrency = args.workers
+    elif args.threads > 0:
+        concurrency = args.threads
+    else:
+        concurrency = args.maxSessions
+    try:
+        args.numericThreads = cpubudget.parse_thread_budget('auto' if (args.cpuAffinity and args.numericThreads == 'none') else args.numericThreads, concurrency)
+    except ValueError as e:
+        parser.error("--numericThreads: %s" % e)
+    cpubudget.set_thread_environment(args.numericThreads)
+
     if args.crlf:
         fmt='%(asctime)s - %(message)s\r'
     else:
@@ -71,24 +192,11 @@ if __name__ == '__main__':
         absLogPath = os.path.abspath(args.logfile)
         if not os.path.exists(os.path.dirname(absLogPath)):
             os.makedirs(os.path.dirname(absLogPath))
-
-        logging.basicConfig(
-            format=fmt,
-            level=logLevel,
-            handlers=[
-                logging.FileHandler(args.logfile),
-                logging.StreamHandler(sys.stdout)
-            ],
-            force=True
-        )
     else:
         print("No logfile provided")
-        logging.basicConfig(
-            format=fmt,
-            level=logLevel,
-            handlers=[
-                logging.StreamHandler(sys.stdout)
-            ],
-            force=True
-        )
+
+    # Log records are written to the file and stdout by a background thread,
+    # unless --logSync is used
+    serverlog.setup(fmt, logLevel, args.logfile, args.logFormat == 'json', queued=not args.logSync)
+
     main(args)
\ No newline at end of file
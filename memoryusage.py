@@ -0,0 +1,187 @@
+# Per-session memory usage and limits, see Server.process() and mrdhelper.stage()
+import constants
+import json
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+from metrics import Metrics
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+MODES = ('rss', 'tracemalloc')
+MB    = 1024*1024
+
+# Sessions using tracemalloc, which is stopped when the last one finishes
+tracingLock     = threading.Lock()
+tracingSessions = 0
+
+class SessionMemory:
+    """
+    Records the memory used by a session at the boundaries of its stages (the
+    entry and exit of each mrdhelper.stage()), which get_messages() reports
+    when the session is closed.
+
+    'rss' records the resident memory of the process at each boundary, and
+    the highest value seen while each stage was open.  'tracemalloc' also
+    traces Python allocations (including NumPy arrays), recording the peak
+    traced memory of each stage and the allocation sites holding the most
+    memory at the boundary where the traced memory was highest.  Its overhead
+    is significant, so it is meant for diagnosing large datasets.
+
+    Memory is measured for the process, so with --threads or --asyncio the
+    values include other sessions running at the same time.
+
+    limit is the ceiling set with set_memory_limit() (0 for none), which
+    makes allocations over it raise MemoryError.  The stage in which that
+    happened is reported as an error.
+    """
+
+    def __init__(self, mode=None, topSites=10, limit=0):
+        global tracingSessions
+
+        if mode not in MODES + (None,):
+            raise ValueError("Unsupported memory report mode '%s'" % mode)
+
+        self.mode      = mode
+        self.topSites  = topSites
+        self.limit     = limit
+        self.stages    = {}      # stage path: [peak RSS, peak traced memory]
+        self.exceeded  = None    # stage path in which MemoryError was raised
+        self.tracing   = False
+        self.topTraced = 0
+        self.sites     = []
+
+        if mode == 'tracemalloc':
+            with tracingLock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracingSessions += 1
+            self.tracing = True
+            self.startTraced = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        self.startRss = get_rss() if mode else None
+        self.peakRss  = self.startRss
+
+    def sample(self, names, exiting=False):
+        """Record the memory used at a boundary of the open stages names (outermost first)"""
+        if self.mode is None:
+            return
+
+        rss = get_rss()
+        if (rss is not None) and ((self.peakRss is None) or (rss > self.peakRss)):
+            self.peakRss = rss
+
+        traced = peakTraced = 0
+        if self.tracing:
+            traced, peakTraced = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            peakTraced -= self.startTraced
+
+        for i in range(len(names)):
+            peaks = self.stages.setdefault('/'.join(names[:i+1]), [0, 0])
+            peaks[0] = max(peaks[0], rss or 0)
+            peaks[1] = max(peaks[1], peakTraced)
+
+        # Snapshots are slow, so only taken when the traced memory has grown by 10%
+        if exiting and self.tracing and (traced > 1.1*self.topTraced):
+            self.topTraced = traced
+            self.sites     = self.get_top_sites()
+
+    def set_exceeded(self, path):
+        if self.exceeded is None:
+            self.exceeded = path
+
+    def get_top_sites(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                                              tracemalloc.Filter(False, __file__),
+                                                              tracemalloc.Filter(False, "<frozen importlib._bootstrap>")))
+        return ["%s:%d: %.1f MB in %d blocks" % (os.path.basename(stat.traceback[0].filename), stat.traceback[0].lineno, stat.size/MB, stat.count)
+                for stat in snapshot.statistics('lineno')[:self.topSites]]
+
+    def finish(self):
+        global tracingSessions
+
+        if self.tracing:
+            self.tracing = False
+            with tracingLock:
+                tracingSessions -= 1
+                if tracingSessions == 0:
+                    tracemalloc.stop()
+
+    def get_stats(self):
+        def to_mb(value):
+            return None if value is None else round(value/MB, 1)
+
+        stats = {'rssMB': {'start': to_mb(self.startRss), 'end': to_mb(get_rss()), 'peak': to_mb(self.peakRss), 'processPeak': to_mb(get_peak_rss())}}
+        if self.limit > 0:
+            stats['limitMB'] = to_mb(self.limit)
+
+        stats['stages'] = {}
+        for path, (rss, traced) in self.stages.items():
+            stats['stages'][path] = {'rssMB': to_mb(rss)}
+            if self.mode == 'tracemalloc':
+                stats['stages'][path]['tracedPeakMB'] = to_mb(traced)
+
+        if self.mode == 'tracemalloc':
+            stats['topAllocations'] = self.sites
+        return stats
+
+    def get_messages(self):
+        """(MRD logging level, text) messages reporting the session's memory usage"""
+        messages = []
+        if self.exceeded is not None:
+            messages.append((constants.MRD_LOGGING_ERROR, "Session stopped in stage '%s': memory limit of %.0f MB (--memoryLimit) exceeded" % (self.exceeded, self.limit/MB)))
+        if self.mode is not None:
+            messages.append((constants.MRD_LOGGING_INFO, "Memory usage: " + json.dumps(self.get_stats())))
+        self.finish()
+        return messages
+
+def get_rss():
+    """Resident memory of this process in bytes, or None if it can't be determined"""
+    return Metrics.get_resident_memory(os.getpid())
+
+def get_peak_rss():
+    """Highest resident memory of this process in bytes, or None if it can't be determined"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+def get_address_space():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def set_memory_limit(limit):
+    """
+    Limit the address space of this process to limit bytes (RLIMIT_AS), so
+    that allocations over it raise MemoryError in the session instead of the
+    OOM killer ending the server.  Resident memory can't be limited with
+    setrlimit on Linux, so the limit includes memory that is reserved but not
+    used (e.g. thread stacks and malloc arenas).
+    """
+    if resource is None:
+        logging.warning("Memory limits are not supported on this platform")
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if (hard != resource.RLIM_INFINITY) and (limit > hard):
+        logging.warning("Memory limit of %.0f MB is over the hard limit of %.0f MB", limit/MB, hard/MB)
+        limit = hard
+
+    used = get_address_space()
+    if (used is not None) and (used >= limit):
+        logging.warning("Memory limit of %.0f MB is less than the %.0f MB of address space already used by process %d -- not limiting memory", limit/MB, used/MB, os.getpid())
+        return
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    logging.debug("Limited the address space of process %d to %.0f MB", os.getpid(), limit/MB)
@@ -0,0 +1,320 @@
+# Server telemetry in the Prometheus text format, see Server.handle()
+import bisect
+import contextlib
+import http.server
+import logging
+import multiprocessing
+import os
+import socket
+import socketserver
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Upper bounds (s) of the histogram buckets for session durations and times to
+# the first image
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Seconds between reports of the messages and bytes of running sessions
+REPORT_INTERVAL = 1.0
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0]*(len(BUCKETS)+1)
+        self.sum    = 0.0
+        self.count  = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def format(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_sum{%s} %.6f' % (name, labels, self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+        return lines
+
+class Metrics:
+    """
+    Counters and histograms of the sessions handled by the server, served in
+    the Prometheus text format over HTTP (port) and/or a Unix socket (path),
+    e.g. curl http://localhost:<port>/metrics or
+    curl --unix-socket <path> http://localhost/metrics.
+
+    Sessions report when they start and finish through a multiprocessing queue,
+    so that sessions in processes started by the server (-m, --workers) are
+    counted too.  A thread in the server process applies the events to the
+    totals.  The messages and bytes received and sent by running sessions are
+    reported every REPORT_INTERVAL seconds by a thread in each process that
+    handles sessions, and the rest when a session finishes.  The resident
+    memory of the server and its child processes is read when the metrics are
+    requested.
+    """
+
+    def __init__(self, port=0, path=None, host='127.0.0.1'):
+        self.enabled = (port > 0) or bool(path)
+        self.servers = []
+        if not self.enabled:
+            return
+
+        self.events     = multiprocessing.Queue()
+        self.lock       = threading.Lock()
+        self.serverPid  = os.getpid()
+        self.active     = {}    # (pid, session id): config
+        self.sessions   = {}    # config: finished sessions
+        self.durations  = {}    # config: Histogram
+        self.firstImage = {}    # config: Histogram
+        self.messages   = {}    # (direction, message type): [messages, bytes]
+        self.reset_running()
+
+        threading.Thread(target=self.collect, daemon=True, name='metrics').start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset_running)
+
+        if port > 0:
+            self.start_server(http.server.ThreadingHTTPServer, (host, port))
+            logging.info("Serving metrics at http://%s:%d/metrics", host, port)
+        if path:
+            if os.path.exists(path):
+                os.remove(path)
+            self.start_server(UnixHTTPServer, path)
+            logging.info("Serving metrics on Unix socket %s", path)
+
+    def __getstate__(self):
+        # Only the queue is needed to report events from other processes
+        return {'enabled': self.enabled, 'events': self.events if self.enabled else None}
+
+    def __setstate__(self, state):
+        self.enabled = state['enabled']
+        self.events  = state['events']
+        self.servers = []
+        self.reset_running()
+
+    def start_server(self, serverClass, address):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.format().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics request: " + format, *args)
+
+        server = serverClass(address, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http').start()
+        self.servers.append(server)
+
+    @contextlib.contextmanager
+    def session(self, connection, config):
+        """Context manager that counts the session as active and reports its statistics at exit"""
+        if not self.enabled:
+            yield
+            return
+
+        config = config if isinstance(config, str) else ''
+        key    = (os.getpid(), id(connection))
+        self.events.put(('start', key, config))
+        with self.runningLock:
+            self.running[key] = (connection, {})
+            if self.reporterPid != os.getpid():
+                self.reporterPid = os.getpid()
+                threading.Thread(target=self.report, daemon=True, name='metrics-report').start()
+        try:
+            yield
+        finally:
+            with self.runningLock:
+                messages = self.get_new_messages(self.running.pop(key))
+            stats      = connection.get_stats()
+            firstImage = None
+            if connection.firstImageTime is not None:
+                firstImage = connection.firstImageTime - connection.startTime
+            self.events.put(('finish', key, config, stats['elapsed'], firstImage, messages))
+
+    # ----- Processes handling sessions -----------------------------------------
+    def reset_running(self):
+        # Also run in processes forked by the server, which don't have the
+        # reporter thread and may have copied the lock while it was held
+        self.running     = {}    # (pid, session id): (connection, {message type: counts reported so far})
+        self.runningLock = threading.Lock()
+        self.reporterPid = None
+
+    def report(self):
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            with self.runningLock:
+                updates = [(key, self.get_new_messages(session)) for key, session in self.running.items()]
+            for key, messages in updates:
+                if len(messages) > 0:
+                    self.events.put(('messages', key, messages))
+
+    @staticmethod
+    def get_new_messages(session):
+        # (received, received bytes, sent, sent bytes) of each message type
+        # since the session was last reported, with runningLock held
+        connection, reported = session
+        messages = {}
+        for name, message in connection.get_stats()['messages'].items():
+            counts   = (message['received'], message['receivedBytes'], message['sent'], message['sentBytes'])
+            previous = reported.get(name, (0, 0, 0, 0))
+            if counts != previous:
+                messages[name] = tuple([count - last for count, last in zip(counts, previous)])
+                reported[name] = counts
+        return messages
+
+    # ----- Server process -------------------------------------------------------
+    def collect(self):
+        while True:
+            try:
+                event = self.events.get()
+            except (EOFError, OSError):
+                return
+
+            with self.lock:
+                if event[0] == 'start':
+                    self.active[event[1]] = event[2]
+                elif event[0] == 'messages':
+                    self.add_messages(event[2])
+                elif event[0] == 'finish':
+                    key, config, elapsed, firstImage, messages = event[1:]
+                    self.active.pop(key, None)
+                    self.sessions[config] = self.sessions.get(config, 0) + 1
+                    self.durations.setdefault(config, Histogram()).observe(elapsed)
+                    if firstImage is not None:
+                        self.firstImage.setdefault(config, Histogram()).observe(firstImage)
+                    self.add_messages(messages)
+
+    def add_messages(self, messages):
+        for name, (received, receivedBytes, sent, sentBytes) in messages.items():
+            for direction, count, nbytes in (('received', received, receivedBytes), ('sent', sent, sentBytes)):
+                if (count > 0) or (nbytes > 0):
+                    totals = self.messages.setdefault((direction, name), [0, 0])
+                    totals[0] += count
+                    totals[1] += nbytes
+
+    def get_processes(self):
+        # Server process and the processes it started (per connection or pool workers)
+        return [('server', self.serverPid)] + [('worker', pid) for pid in self.get_children(self.serverPid)]
+
+    @staticmethod
+    def get_children(pid):
+        if psutil is not None:
+            try:
+                return [child.pid for child in psutil.Process(pid).children() if child.status() != psutil.STATUS_ZOMBIE]
+            except psutil.Error:
+                return []
+
+        # /proc/<pid>/stat is "pid (name) state ppid ...", where name may contain spaces
+        children = []
+        try:
+            entries = os.listdir('/proc')
+        except OSError:
+            return children
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    fields = f.read().rpartition(')')[2].split()
+            except OSError:
+                continue
+            if (len(fields) > 1) and (fields[0] != 'Z') and (int(fields[1]) == pid):
+                children.append(int(entry))
+        return children
+
+    def prune_sessions(self, pids):
+        # Sessions of processes that exited without reporting that they finished
+        for key in list(self.active):
+            if key[0] not in pids:
+                del self.active[key]
+
+    @staticmethod
+    def get_resident_memory(pid):
+        """Resident memory of a process in bytes, or None if it can't be determined"""
+        if psutil is not None:
+            try:
+                return psutil.Process(pid).memory_info().rss
+            except psutil.Error:
+                return None
+        try:
+            with open('/proc/%d/statm' % pid) as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def format(self):
+        processes = self.get_processes()
+        with self.lock:
+            self.prune_sessions(set([pid for role, pid in processes]))
+
+            active = {}
+            for config in self.active.values():
+                active[config] = active.get(config, 0) + 1
+
+            lines = ['# HELP mrd_sessions_active Sessions being processed',
+                     '# TYPE mrd_sessions_active gauge',
+                     'mrd_sessions_active %d' % len(self.active)]
+
+            lines += ['# HELP mrd_config_sessions_active Sessions being processed, by config',
+                      '# TYPE mrd_config_sessions_active gauge']
+            lines += ['mrd_config_sessions_active{config="%s"} %d' % (escape(config), count) for config, count in sorted(active.items())]
+
+            lines += ['# HELP mrd_sessions_total Sessions finished, by config',
+                      '# TYPE mrd_sessions_total counter']
+            lines += ['mrd_sessions_total{config="%s"} %d' % (escape(config), count) for config, count in sorted(self.sessions.items())]
+
+            for direction in ('received', 'sent'):
+                for unit, index in (('messages', 0), ('bytes', 1)):
+                    name = 'mrd_%s_%s_total' % (direction, unit)
+                    lines += ['# HELP %s MRD %s %s by sessions, by message type' % (name, unit, direction),
+                              '# TYPE %s counter' % name]
+                    lines += ['%s{message="%s"} %d' % (name, message, totals[index]) for (dir, message), totals in sorted(self.messages.items()) if dir == direction]
+
+            for name, description, histograms in (('mrd_session_duration_seconds',      'Duration of sessions, by config',                       self.durations),
+                                                  ('mrd_time_to_first_image_seconds',   'Time from connection to the first image sent, by config', self.firstImage)):
+                lines += ['# HELP %s %s' % (name, description),
+                          '# TYPE %s histogram' % name]
+                for config, histogram in sorted(histograms.items()):
+                    lines += histogram.format(name, 'config="%s"' % escape(config))
+
+        lines += ['# HELP mrd_process_resident_memory_bytes Resident memory of the server and its worker processes',
+                  '# TYPE mrd_process_resident_memory_bytes gauge']
+        for role, pid in processes:
+            rss = self.get_resident_memory(pid)
+            if rss is not None:
+                lines.append('mrd_process_resident_memory_bytes{role="%s",pid="%d"} %d' % (role, pid, rss))
+
+        return "\n".join(lines) + "\n"
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind() expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, address = super().get_request()
+        return request, ('', 0)
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
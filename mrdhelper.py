@@ -2,6 +2,13 @@
 import ismrmrd
 import re
 import base64
+import contextlib
+import functools
+import json
+import threading
+import time
+import tracing
+from lazyimage import LazyImage
 
 def update_img_header_from_raw(imgHead, rawHead):
     """Populate ImageHeader fields from AcquisitionHeader"""
@@ -88,6 +95,15 @@ def get_meta_value(meta, key):
     else:
         return None
 
+def set_meta_values(image, values):
+    """Set MRD Meta Attributes of an image from a dict (without parsing the attributes of a LazyImage, if possible)"""
+    if isinstance(image, LazyImage):
+        image.patch_meta(values)
+    else:
+        tmpMeta = ismrmrd.Meta.deserialize(image.attribute_string)
+        tmpMeta.update(values)
+        image.attribute_string = tmpMeta.serialize()
+
 def extract_minihead_bool_param(miniHead, name):
     """Extract a bool parameter from the serialized text of the ICE MiniHeader"""
     val = extract_minihead_param(miniHead, name, 'ParamBool')
@@ -287,3 +303,95 @@ def parse_text(txt):
     string = txt[6]
 
     return x, y, rgb, visibility, string
+
+class StageTimes:
+    """
+    Total time and number of calls of each named stage of a session's processing
+    (e.g. 'sort', 'fft', 'coil-combine', 'crop', 'quantize', 'meta'), as recorded
+    by stage() and timed_stage.  A stage inside another is named '<outer>/<inner>'.
+
+    The server sets up one for each session (connection.stageTimes), which the
+    connection sends to the client as a JSON logging message before the close.
+    """
+
+    def __init__(self):
+        self.stages = {}    # name: [calls, seconds], in the order first recorded
+        self.lock   = threading.Lock()
+
+    def add(self, name, seconds, calls=1):
+        with self.lock:
+            totals = self.stages.setdefault(name, [0, 0.0])
+            totals[0] += calls
+            totals[1] += seconds
+
+    def get_stats(self):
+        """{name: {'calls': calls, 'ms': total milliseconds}} for each stage"""
+        with self.lock:
+            return {name: {'calls': calls, 'ms': round(seconds*1000, 3)} for name, (calls, seconds) in self.stages.items()}
+
+    def format(self, extra=None):
+        """'Stage timings: ' followed by get_stats() (and any extra stages) as JSON"""
+        stats = self.get_stats()
+        stats.update(extra or {})
+        return "Stage timings: " + json.dumps(stats)
+
+# Stage timings, memory usage and names of the open stages of the session in
+# the current thread
+stageLocal = threading.local()
+
+@contextlib.contextmanager
+def stage_session(stageTimes, memory=None):
+    """Record stages in this thread to stageTimes, and their memory usage to memory (a memoryusage.SessionMemory)"""
+    previous = (getattr(stageLocal, 'times', None), getattr(stageLocal, 'memory', None), getattr(stageLocal, 'path', []))
+    stageLocal.times  = stageTimes
+    stageLocal.memory = memory
+    stageLocal.path   = []
+    try:
+        yield
+    finally:
+        stageLocal.times, stageLocal.memory, stageLocal.path = previous
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time a named stage of processing, e.g.
+        with mrdhelper.stage('fft'):
+            data = fft.ifft2(data, axes=(1, 2))
+    The time is added to the session's StageTimes and the stage is shown in its
+    trace.  If the session's memory usage is recorded, it is sampled at the
+    start and end of the stage.
+    """
+    times = getattr(stageLocal, 'times', None)
+    if times is None:
+        with tracing.span(name):
+            yield
+        return
+
+    memory = stageLocal.memory
+    if memory is not None:
+        memory.sample(stageLocal.path)
+
+    stageLocal.path.append(name)
+    path = '/'.join(stageLocal.path)
+    times.add(path, 0.0, calls=0)    # Listed before the stages inside it
+    tic  = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    except MemoryError:
+        if memory is not None:
+            memory.set_exceeded(path)
+        raise
+    finally:
+        times.add(path, time.perf_counter() - tic)
+        if memory is not None:
+            memory.sample(stageLocal.path, exiting=True)
+        stageLocal.path.pop()
+
+def timed_stage(func):
+    """Decorator that times each call of func as a stage named after the function"""
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+    return call
@@ -0,0 +1,153 @@
+# Per-session CPU profiles of config modules, see Server.process()
+import cProfile
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+MODES = ('cprofile', 'sample')
+
+class SessionProfiler:
+    """
+    Profiles a config module's process() for one session.
+
+    'cprofile' uses cProfile to record every call (deterministic, but with a
+    large overhead for code with many small calls) and is saved as a pstats
+    .prof file, e.g. for python -m pstats or snakeviz.
+
+    'sample' records the stack of the session's thread every interval seconds
+    (see Sampler) and is saved in the collapsed stack format
+    (.collapsed) for flamegraph.pl or speedscope.  Its overhead is small and
+    independent of the number of calls.
+    """
+
+    def __init__(self, mode, interval=0.005):
+        if mode not in MODES:
+            raise ValueError("Unsupported profiling mode '%s'" % mode)
+
+        self.mode     = mode
+        self.interval = interval
+        self.profile  = None
+        self.stacks   = collections.Counter()
+        self.samples  = 0
+
+    def run(self, func, *args):
+        """Call func(*args) while profiling"""
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            try:
+                return func(*args)
+            finally:
+                self.profile.disable()
+        else:
+            sampler.add(threading.get_ident(), self, self.interval)
+            try:
+                return func(*args)
+            finally:
+                sampler.remove(threading.get_ident())
+
+    def add_stack(self, frame):
+        # Called by the sampler.  Frames above run() are not part of the session.
+        names = []
+        while (frame is not None) and (frame.f_code is not SessionProfiler.run.__code__):
+            names.append("%s (%s:%d)" % (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_code.co_firstlineno))
+            frame = frame.f_back
+
+        if len(names) > 0:
+            self.stacks[';'.join(reversed(names))] += 1
+            self.samples += 1
+
+    def write(self, folder, name=''):
+        """Save the profile as profile_<time>_<name>.prof or .collapsed in folder and return its path"""
+        if (folder) and (not os.path.exists(folder)):
+            os.makedirs(folder)
+
+        path = os.path.join(folder, "profile_" + datetime.now().strftime("%Y-%m-%d-%H%M%S_%f") + ("_" + name if name else ""))
+        if self.mode == 'cprofile':
+            path += ".prof"
+            self.profile.dump_stats(path)
+        else:
+            path += ".collapsed"
+            with open(path, 'w') as f:
+                for stack, count in self.stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
+            logging.debug("Collected %d profiling samples", self.samples)
+        return path
+
+class Sampler:
+    """
+    Samples the stacks of the threads of the sessions in the process that are
+    being profiled.
+
+    A session in the main thread (serial mode, or a process per session) is
+    sampled by a SIGPROF handler every interval of CPU time, using the frame
+    that was interrupted.  The handler is installed by install() when the
+    server starts, as signal handlers can only be installed from the main
+    thread.  Python runs signal handlers in the main thread only, so sessions
+    in other threads (--threads, --asyncio) are sampled by a background thread
+    every interval of wall time instead, using sys._current_frames().
+    """
+
+    def __init__(self):
+        self.profilers = {}    # thread id: SessionProfiler
+        self.lock      = threading.Lock()
+        self.installed = False
+        self.thread    = None
+
+    def install(self):
+        if self.installed or not hasattr(signal, 'SIGPROF') or (threading.current_thread() is not threading.main_thread()):
+            return self.installed
+        signal.signal(signal.SIGPROF, self.handle_signal)
+        self.installed = True
+        return True
+
+    def uses_signal(self, tid):
+        return (tid == threading.main_thread().ident) and self.install()
+
+    def add(self, tid, profiler, interval):
+        with self.lock:
+            self.profilers[tid] = profiler
+            if self.uses_signal(tid):
+                signal.setitimer(signal.ITIMER_PROF, interval, interval)
+            elif self.thread is None:
+                self.thread = threading.Thread(target=self.sample_loop, args=(interval,), daemon=True, name='Sampler')
+                self.thread.start()
+
+    def remove(self, tid):
+        with self.lock:
+            self.profilers.pop(tid, None)
+            if self.uses_signal(tid):
+                signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+            thread = None
+            if not any([not self.uses_signal(other) for other in self.profilers]):
+                thread, self.thread = self.thread, None
+
+        if thread is not None:
+            thread.join()
+
+    def handle_signal(self, signum, frame):
+        # Runs between bytecodes of the main thread, so it must not take self.lock
+        profiler = self.profilers.get(threading.main_thread().ident)
+        if profiler is not None:
+            profiler.add_stack(frame)
+
+    def sample_loop(self, interval):
+        mainThread = threading.main_thread().ident
+        while self.thread is threading.current_thread():
+            time.sleep(interval)
+            frames = sys._current_frames()
+            for tid, profiler in tuple(self.profilers.items()):
+                if (tid != mainThread) and (tid in frames):
+                    profiler.add_stack(frames[tid])
+
+sampler = Sampler()
+
+def install():
+    """Install the SIGPROF handler used by the 'sample' mode (from the main thread)"""
+    sampler.install()
@@ -0,0 +1,107 @@
+# HDF5 layout of the datasets in savedata files, see Connection.savedataLayout
+import logging
+import ismrmrd
+
+# Largest number of records allocated ahead from the encoding limits, in case
+# the limits in the header are not sensible
+MAX_PRESIZE = 1024*1024
+
+class SaveDataLayout:
+    """
+    Creates and appends to the datasets of a savedata file (/dataset/data,
+    /dataset/waveforms and the header, attributes and data of each image_N
+    series) with the configured chunking and compression.
+
+    compression is None, 'gzip', 'gzip:<level>' or 'lzf', optionally combined
+    with the shuffle filter.  chunkRecords is the number of records (acquisitions,
+    waveforms or images) per chunk, or 0 to let h5py choose.
+
+    If presize is enabled, datasets are created with the number of acquisitions
+    and images expected from the encodingLimits of the MRD header (see
+    set_expected()) and grown by doubling, rather than being resized for every
+    write.  Unused records are removed by finish() before the file is closed.
+
+    Filters are not applied to variable length data, so compression has little
+    effect on the k-space and trajectory data in /dataset/data, whereas image
+    data is compressed.
+    """
+
+    def __init__(self, compression=None, shuffle=False, chunkRecords=0, presize=True):
+        self.compression          = None
+        self.compressionOpts      = None
+        self.shuffle              = shuffle
+        self.chunkRecords         = chunkRecords
+        self.presize              = presize
+        self.expectedAcquisitions = 0
+        self.expectedImages       = 0
+        self.counts               = {}   # Records written to each dataset, by path
+
+        if compression and (compression != 'none'):
+            self.compression, _, level = compression.partition(':')
+            if self.compression not in ('gzip', 'lzf'):
+                raise ValueError("Unsupported savedata compression '%s'" % compression)
+            if level:
+                self.compressionOpts = int(level)
+
+    def set_expected(self, metadata):
+        """Estimate the number of acquisitions and images per series from the MRD header text"""
+        try:
+            mrdHead = ismrmrd.xsd.CreateFromDocument(metadata)
+        except:
+            logging.debug("    MRD header could not be parsed to estimate the size of saved datasets")
+            return
+
+        def count(limit):
+            if (limit is None) or (limit.maximum is None):
+                return 1
+            return max(limit.maximum - (limit.minimum or 0) + 1, 1)
+
+        acquisitions = 0
+        images       = 0
+        for encoding in mrdHead.encoding:
+            limits = encoding.encodingLimits
+            if limits is None:
+                continue
+            volumes = count(limits.slice) * count(limits.contrast) * count(limits.phase) * count(limits.repetition) * count(limits.set)
+            acquisitions += volumes * count(limits.kspace_encoding_step_1) * count(limits.kspace_encoding_step_2) * count(limits.average) * count(limits.segment)
+            images        = max(images, volumes)
+
+        self.expectedAcquisitions = min(acquisitions, MAX_PRESIZE)
+        self.expectedImages       = min(images, MAX_PRESIZE)
+        logging.debug("    Expecting %d acquisitions and %d images per series", self.expectedAcquisitions, self.expectedImages)
+
+    def dataset_options(self, recordShape):
+        # Keyword arguments for h5py create_dataset()
+        options = {'chunks': ((self.chunkRecords,) + tuple(recordShape)) if self.chunkRecords > 0 else True}
+        if self.compression is not None:
+            options['compression'] = self.compression
+            if self.compressionOpts is not None:
+                options['compression_opts'] = self.compressionOpts
+        if self.shuffle:
+            options['shuffle'] = True
+        return options
+
+    def append(self, group, name, rows, dtype, expected=0):
+        """Write rows (an array of records) after the records already written to group[name]"""
+        if name in group:
+            dataset = group[name]
+            num     = self.counts.get(dataset.name, dataset.shape[0])
+            if num + len(rows) > dataset.shape[0]:
+                size = num + len(rows)
+                if self.presize:
+                    size = max(size, 2*dataset.shape[0])
+                dataset.resize(size, axis=0)
+        else:
+            size = max(len(rows), expected) if self.presize else len(rows)
+            dataset = group.create_dataset(name, (size,) + rows.shape[1:], maxshape=(None,) + rows.shape[1:], dtype=dtype, **self.dataset_options(rows.shape[1:]))
+            num = 0
+
+        dataset[num:num+len(rows)] = rows
+        self.counts[dataset.name] = num + len(rows)
+
+    def finish(self, dset):
+        """Trim pre-sized datasets to the number of records written"""
+        for path, count in self.counts.items():
+            if (path in dset._file) and (dset._file[path].shape[0] > count):
+                dset._file[path].resize(count, axis=0)
+        self.counts = {}
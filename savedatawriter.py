@@ -0,0 +1,127 @@
+# Background writer for the savedata files of a Connection
+import collections
+import logging
+import threading
+
+class SaveDataWriter:
+    """
+    Runs the HDF5 writes for saving incoming data on a background thread, so
+    that the connection can keep receiving while the file is written.
+
+    Work is queued with call() (run as is) or append() (items added to a
+    dataset).  Everything is run in the order it was queued, but consecutive
+    appends with the same function and key are merged into a single call with
+    up to batchSize items, so that the file is resized and written once per
+    batch rather than once per message.
+
+    The queue is bounded by maxItems and maxBytes, so callers block when the
+    disk can't keep up instead of buffering without limit.  Callers that must
+    not block (e.g. an event loop) can check has_room() and wait_for_room() in
+    another thread before queueing.
+    """
+
+    def __init__(self, maxItems=1024, maxBytes=256*1024*1024, batchSize=256):
+        self.maxItems   = maxItems
+        self.maxBytes   = maxBytes
+        self.batchSize  = batchSize
+        self.queue      = collections.deque()
+        self.queueBytes = 0
+        self.busy       = False
+        self.stopped    = False
+        self.error      = None
+        self.condition  = threading.Condition()
+        self.thread     = threading.Thread(target=self.run, name="SaveDataWriter", daemon=True)
+        self.thread.start()
+
+    def call(self, func, *args):
+        """Queue func(*args)"""
+        self.put((func, args, None, None, 0))
+
+    def append(self, func, args, key, item, nbytes=0):
+        """Queue func(*args, items), where items are merged with adjacent appends having the same func and key"""
+        self.put((func, args, key, [item], nbytes))
+
+    def put(self, entry):
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError("SaveDataWriter has been stopped")
+
+            while self.is_full(entry[4]):
+                self.condition.wait()
+
+            self.queue.append(entry)
+            self.queueBytes += entry[4]
+            self.condition.notify_all()
+
+    def is_full(self, nbytes):
+        # With the condition held
+        return (len(self.queue) > 0) and ((len(self.queue) >= self.maxItems) or (self.queueBytes + nbytes > self.maxBytes))
+
+    def has_room(self, nbytes=0):
+        """Whether an entry of nbytes can be queued without waiting"""
+        with self.condition:
+            return self.stopped or not self.is_full(nbytes)
+
+    def wait_for_room(self, nbytes=0):
+        """Block until an entry of nbytes can be queued without waiting"""
+        with self.condition:
+            while (not self.stopped) and self.is_full(nbytes):
+                self.condition.wait()
+
+    def wait(self):
+        """Block until everything queued so far has been written.  Raises if a write failed."""
+        with self.condition:
+            while (len(self.queue) > 0) or self.busy:
+                self.condition.wait()
+
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise RuntimeError("Failed to save data") from error
+
+    def stop(self):
+        """Write everything that has been queued and end the thread"""
+        try:
+            self.wait()
+        except Exception as e:
+            logging.error("%s: %s", e, e.__cause__)
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while (len(self.queue) == 0) and not self.stopped:
+                    self.condition.wait()
+
+                if len(self.queue) == 0:
+                    return
+
+                func, args, key, items, nbytes = self.queue.popleft()
+                if items is not None:
+                    items = list(items)
+                    while (len(self.queue) > 0) and (len(items) < self.batchSize) and (self.queue[0][0] == func) and (self.queue[0][2] == key):
+                        entry = self.queue.popleft()
+                        items.extend(entry[3])
+                        nbytes += entry[4]
+
+                self.queueBytes -= nbytes
+                self.busy = True
+                self.condition.notify_all()
+
+            try:
+                if items is None:
+                    func(*args)
+                else:
+                    func(*args, items)
+            except Exception as e:
+                logging.exception("Failed to save data")
+                with self.condition:
+                    if self.error is None:
+                        self.error = e
+
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
@@ -1,26 +1,36 @@
 
 import constants
 from connection import Connection
-
+from asyncconnection import AsyncConnection
+import shmring
+from savedatalayout import SaveDataLayout
+from workerpool import WorkerPool
+from configregistry import ConfigRegistry
+from admission import AdmissionControl
+from metrics import Metrics
+import tracing
+import mrdhelper
+import profiling
+import memoryusage
+from cpubudget import CpuBudget
+
+import asyncio
+import concurrent.futures
 import socket
 import logging
 import multiprocessing
 import ismrmrd.xsd
-import importlib
 import os
 import json
 import signal
-
-import simplefft
-import invertcontrast
-import analyzeflow
+import threading
 
 class Server:
     """
     Something something docstring.
     """
 
-    def __init__(self, address, port, defaultConfig, savedata, savedataFolder, multiprocessing):
+    def __init__(self, address, port, defaultConfig, savedata, savedataFolder, multiprocessing, sendBufferSize=0, prefetchDepth=0, prefetchBytes=256*1024*1024, sharedMemory=False, savedataMode='sync', savedataCompression=None, savedataShuffle=False, savedataChunk=0, workers=0, maxSessionsPerWorker=0, configFolders=None, preload=('simplefft', 'invertcontrast', 'analyzeflow'), warmup=False, backlog=0, maxSessions=0, configLimits=None, configPriorities=None, threads=0, metricsPort=0, metricsSocket=None, metricsHost='127.0.0.1', trace=False, profile=None, profileInterval=5, memoryReport=None, memoryTopSites=10, memoryLimit=0, numericThreads=0, cpuAffinity=False):
         logging.info("Starting server and listening for data at %s:%d", address, port)
 
         logging.info("Default config is %s", defaultConfig)
@@ -28,19 +38,125 @@ class Server:
             logging.debug("Saving incoming data is enabled.")
 
         if (multiprocessing is True):
-            logging.debug("Multiprocessing is enabled.")
+            if (workers > 0):
+                logging.debug("Multiprocessing is enabled with a pool of %d worker processes.", workers)
+            else:
+                logging.debug("Multiprocessing is enabled.")
+        elif (threads > 0):
+            logging.debug("Sessions are handled by a pool of %d threads.", threads)
+
+        if (prefetchDepth > 0):
+            logging.debug("Prefetching of up to %d incoming messages is enabled.", prefetchDepth)
+
+        if (sharedMemory is True):
+            logging.debug("Shared memory transport is enabled.")
+
+        if (savedata is True):
+            logging.debug("Saved data is written in '%s' mode.", savedataMode)
+
+        if (trace is True):
+            logging.debug("Session traces are saved in %s.", savedataFolder)
+
+        if profile and (profile != 'none'):
+            logging.debug("Sessions are profiled in '%s' mode.", profile)
+
+        if memoryReport and (memoryReport != 'none'):
+            logging.debug("Memory usage of sessions is reported in '%s' mode.", memoryReport)
+
+        # The memory limit is set in processes that handle one session at a
+        # time, as the server process is shared by all other sessions
+        if (memoryLimit > 0):
+            if (multiprocessing is True):
+                logging.debug("Memory of processes handling sessions is limited to %d MB.", memoryLimit)
+            else:
+                logging.warning("--memoryLimit only applies to processes started for sessions (-m) -- memory is not limited per session")
+                memoryLimit = 0
+
+        if (numericThreads > 0):
+            logging.debug("Numerical libraries use up to %d threads per session.", numericThreads)
+
+        if (cpuAffinity is True):
+            if (multiprocessing is True):
+                logging.debug("Processes handling sessions are pinned to CPU sets.")
+            else:
+                logging.warning("CPU affinity only applies to processes started for sessions (-m)")
+
+        # Check the layout options before accepting connections
+        SaveDataLayout(savedataCompression, savedataShuffle, savedataChunk)
 
         self.defaultConfig = defaultConfig
         self.multiprocessing = multiprocessing
         self.savedata = savedata
         self.savedataFolder = savedataFolder
+        self.sendBufferSize = sendBufferSize
+        self.prefetchDepth  = prefetchDepth
+        self.prefetchBytes  = prefetchBytes
+        self.sharedMemory   = sharedMemory
+        self.savedataMode   = savedataMode
+        self.savedataCompression = savedataCompression
+        self.savedataShuffle     = savedataShuffle
+        self.savedataChunk       = savedataChunk
+        self.workers             = workers
+        self.maxSessionsPerWorker = maxSessionsPerWorker
+        self.threads             = threads
+        self.sessionExecutor     = None    # Runs config modules with --asyncio, see serve_async()
+        self.trace               = trace
+        self.profile             = profile
+        self.profileInterval     = profileInterval
+        self.memoryReport        = memoryReport
+        self.memoryTopSites      = memoryTopSites
+        self.memoryLimit         = memoryLimit
+        self.processCount        = 0
+
+        # Sampling profiles rely on a SIGPROF handler, which can only be
+        # installed from the main thread
+        profiling.install()
+
+        # CPU sets and thread budgets.  Processes started for sessions apply
+        # their own, see init_process()
+        self.cpuBudget = CpuBudget(numericThreads, cpuAffinity)
+        if (multiprocessing is not True):
+            self.cpuBudget.apply()
+
+        # Config modules are imported here, so that forked processes inherit them
+        self.registry = ConfigRegistry(configFolders)
+        available = self.registry.discover()
+        logging.info("Available config modules: %s", ", ".join(available))
+        if 'all' in preload:
+            preload = available
+        self.registry.preload([defaultConfig] + [name for name in preload if name != defaultConfig], warmup)
+
+        # Limits on concurrent sessions, shared with processes started by the server
+        self.admission = AdmissionControl(maxSessions, configLimits, configPriorities)
+        if self.admission.enabled:
+            logging.debug("Admission control is enabled with at most %s concurrent sessions and config limits %s.", maxSessions if maxSessions > 0 else "unlimited", configLimits)
+
+        # Telemetry, reported by sessions in the server and the processes it starts
+        self.metrics = Metrics(metricsPort, metricsSocket, metricsHost)
+
+        self.backlog = backlog
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((address, port))
 
     def serve(self):
         logging.debug("Serving... ")
-        self.socket.listen(0)
+        self.socket.listen(self.backlog)
+
+        # Worker processes are started before any connection is accepted
+        pool = None
+        if (self.multiprocessing is True) and (self.workers > 0):
+            pool = WorkerPool(self.handle, self.workers, self.maxSessionsPerWorker, self.init_process)
+
+        # Sessions share the process, and with it imported modules and caches
+        # (e.g. numpy's FFT plans), while NumPy releases the GIL for heavy work
+        executor = None
+        futures  = set()
+        if (self.multiprocessing is not True) and (self.threads > 0):
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='session')
+
+        if (pool is None) and (self.multiprocessing is not True) and (executor is None):
+            self.admission.limit_sessions(1)
 
         while True:
             try:
@@ -50,22 +166,76 @@ class Server:
                 # signal.siginterrupt is not available in Windows
                 pass
 
+            if pool is not None:
+                pool.wait(self.socket)
+
             sock, (remote_addr, remote_port) = self.socket.accept()
 
             logging.info("Accepting connection from: %s:%d", remote_addr, remote_port)
 
-            if (self.multiprocessing is True):
-                process = multiprocessing.Process(target=self.handle, args=[sock])
+            if pool is not None:
+                pool.dispatch(sock)
+            elif (self.multiprocessing is True):
+                process = multiprocessing.Process(target=self.handle_process, args=[sock, self.processCount])
+                self.processCount += 1
                 process.daemon = True
                 process.start()
                 logging.debug("Spawned process %d to handle connection.", process.pid)
+            elif executor is not None:
+                futures = {future for future in futures if not future.done()}
+                if len(futures) >= self.threads:
+                    logging.info("All %d session threads are busy -- %d connection(s) waiting", self.threads, len(futures)+1-self.threads)
+                futures.add(executor.submit(self.handle, sock))
+            elif self.admission.enabled:
+                # Sessions are still processed one at a time, but wait for
+                # admission in their own thread, so that waiting clients are
+                # accepted and told their position in the queue
+                thread = threading.Thread(target=self.handle, args=[sock], daemon=True)
+                thread.start()
             else:
                 self.handle(sock)
 
+    def serve_asyncio(self):
+        logging.debug("Serving (asyncio)... ")
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        # All sessions share a single event loop for network I/O, while the
+        # config module's process() runs on a pool of threads sized by
+        # --threads (or Python's default for thread pools).  The pool is
+        # separate from the loop's default executor, which runs short blocking
+        # calls (e.g. closing the savedata file), so that those never wait for
+        # config modules, which hold their threads until the session is closed.
+        # asyncio's default backlog is 100
+        self.sessionExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads if self.threads > 0 else None, thread_name_prefix='session')
+
+        server = await asyncio.start_server(self.handle_async, sock=self.socket, backlog=self.backlog if self.backlog > 0 else 100)
+        async with server:
+            await server.serve_forever()
+
+    def init_process(self, slot):
+        # Runs when a process that handles one session at a time is started
+        # (for a connection with -m, or a worker with --workers)
+        self.cpuBudget.apply(slot)
+        if (self.memoryLimit > 0):
+            memoryusage.set_memory_limit(self.memoryLimit*memoryusage.MB)
+
+    def handle_process(self, sock, slot):
+        # Runs in a process started for the connection (-m)
+        self.init_process(slot)
+        self.handle(sock)
+
     def handle(self, sock):
 
         try:
-            connection = Connection(sock, self.savedata, "", self.savedataFolder, "dataset")
+            connection = Connection(sock, self.savedata, "", self.savedataFolder, "dataset", self.sendBufferSize)
+
+            # Report throughput and timings to the client before the close message
+            connection.sendStatsOnClose = True
+            connection.savedataMode     = self.savedataMode
+            connection.savedataLayout   = SaveDataLayout(self.savedataCompression, self.savedataShuffle, self.savedataChunk)
+            if self.trace:
+                connection.trace = tracing.SessionTrace()
 
             # First message is the config (file or text)
             config = next(connection)
@@ -83,119 +253,301 @@ class Server:
                 logging.info("Connection closed without an MRD header received")
                 return
 
-            logging.debug("XML Metadata: %s", metadata_xml)
-            try:
-                metadata = ismrmrd.xsd.CreateFromDocument(metadata_xml)
-                if (metadata.acquisitionSystemInformation.systemFieldStrength_T != None):
-                    logging.info("Data is from a %s %s at %1.1fT", metadata.acquisitionSystemInformation.systemVendor, metadata.acquisitionSystemInformation.systemModel, metadata.acquisitionSystemInformation.systemFieldStrength_T)
-            except:
-                logging.warning("Metadata is not a valid MRD XML structure.  Passing on metadata as text")
-                metadata = metadata_xml
+            metadata = self.parse_metadata(metadata_xml)
 
             # Support additional config parameters passed through a JSON text message
             if connection.peek_mrd_message_identifier() == constants.MRD_MESSAGE_TEXT:
                 configAdditionalText = next(connection)
-                logging.info("Received additional config text: %s", configAdditionalText)
-                connection.save_additional_config(configAdditionalText)
-                try:
-                    configAdditional = json.loads(configAdditionalText)
+                config, configAdditional = self.parse_config_additional(connection, config, configAdditionalText)
+            else:
+                configAdditional = config
 
-                    if ('parameters' in configAdditional):
-                        if ('config' in configAdditional['parameters']):
-                            logging.info("Changing config to: %s", configAdditional['parameters']['config'])
-                            config = configAdditional['parameters']['config']
+            # Decided before the first image is read, e.g. by prefetching
+            connection.lazyImages = self.get_lazy_images(config)
 
-                        if ('customconfig' in configAdditional['parameters']) and (configAdditional['parameters']['customconfig'] != ""):
-                            logging.info("Changing config to: %s", configAdditional['parameters']['customconfig'])
-                            config = configAdditional['parameters']['customconfig']
-                except:
-                    logging.error("Failed to parse as JSON")
+            # Wait until the session can be processed within the concurrency limits
+            with self.admission.session(connection, config), self.metrics.session(connection, config):
+                # Read ahead while the config module is processing data
+                if self.prefetchDepth > 0:
+                    connection.start_prefetch(self.prefetchDepth, self.prefetchBytes)
+
+                self.process(connection, config, configAdditional, metadata)
+
+        except Exception as e:
+            logging.exception(e)
+
+        finally:
+            connection.shutdown_close()
+            self.finalize_save_file(connection)
+            self.write_trace(connection)
+
+    async def handle_async(self, reader, writer):
+        remote_addr, remote_port = writer.get_extra_info('peername')[0:2]
+        logging.info("Accepting connection from: %s:%d", remote_addr, remote_port)
+
+        loop = asyncio.get_running_loop()
+        try:
+            connection = AsyncConnection(reader, writer, self.savedata, "", self.savedataFolder, "dataset", self.sendBufferSize)
+            connection.sendStatsOnClose = True
+            connection.savedataMode     = self.savedataMode
+            connection.savedataLayout   = SaveDataLayout(self.savedataCompression, self.savedataShuffle, self.savedataChunk)
+            if self.trace:
+                connection.trace = tracing.SessionTrace()
+
+            # Created before the first message is saved, unless the client
+            # closes the connection right away
+            if await connection.peek_mrd_message_identifier() not in (constants.MRD_MESSAGE_CLOSE, None):
+                await connection.create_save_file_async()
+
+            config = await connection.next()
+            if ((config is None) & (connection.is_exhausted is True)):
+                logging.info("Connection closed without any data received")
+                return
+
+            metadata_xml = await connection.next()
+            if ((metadata_xml is None) & (connection.is_exhausted is True)):
+                logging.info("Connection closed without an MRD header received")
+                return
+
+            metadata = self.parse_metadata(metadata_xml)
+
+            if await connection.peek_mrd_message_identifier() == constants.MRD_MESSAGE_TEXT:
+                configAdditionalText = await connection.next()
+                config, configAdditional = self.parse_config_additional(connection, config, configAdditionalText)
             else:
                 configAdditional = config
 
-            # Decide what program to use based on config
-            # If not one of these explicit cases, try to load file matching name of config
-            if (config == "simplefft"):
-                logging.info("Starting simplefft processing based on config")
-                simplefft.process(connection, configAdditional, metadata)
-            elif (config == "invertcontrast"):
-                logging.info("Starting invertcontrast processing based on config")
-                invertcontrast.process(connection, configAdditional, metadata)
-            elif (config == "analyzeflow"):
-                logging.info("Starting analyzeflow processing based on config")
-                analyzeflow.process(connection, configAdditional, metadata)
-            elif (config == "null"):
-                logging.info("No processing based on config")
-                try:
-                    for msg in connection:
-                        if msg is None:
-                            break
-                finally:
-                    connection.send_close()
-            elif (config == "savedataonly"):
-                # Dummy loop with no processing
-                try:
-                    for msg in connection:
-                        if msg is None:
-                            break
-                finally:
-                    connection.send_close()
-            else:
-                usedConfig = config
-                if importlib.util.find_spec(config) is None:
-                    logging.error("Could not find config module '%s' -- falling back to default config: %s", config, self.defaultConfig)
-                    usedConfig = self.defaultConfig
+            connection.lazyImages = self.get_lazy_images(config)
 
-                try:
-                    # Load module from file having exact name as config
-                    module = importlib.import_module(usedConfig)
-                    logging.info("Starting config %s", usedConfig)
-                    module.process(connection, configAdditional, metadata)
-                except ImportError as e:
-                    logging.error("Failed to load config '%s' with error:\n  %s", usedConfig, e)
-                    if usedConfig != self.defaultConfig:
-                        logging.info("Falling back to default config: '%s'", self.defaultConfig)
-                        try:
-                            module = importlib.import_module(self.defaultConfig)
-                            logging.info("Starting config %s", self.defaultConfig)
-                            module.process(connection, configAdditional, metadata)
-                        except ImportError as e:
-                            logging.error("Failed to load default config '%s' with error:\n  %s", self.defaultConfig, e)
+            # Recon modules use the blocking Connection API and may be CPU heavy,
+            # so they are run outside of the event loop
+            await loop.run_in_executor(self.sessionExecutor, self.process_admitted, connection.blocking(), config, configAdditional, metadata)
 
         except Exception as e:
             logging.exception(e)
 
         finally:
-            connection.shutdown_close()
+            await connection.shutdown_close()
+            await loop.run_in_executor(None, self.finalize_save_file, connection)
+            await loop.run_in_executor(None, self.write_trace, connection)
+
+    def parse_metadata(self, metadata_xml):
+        logging.debug("XML Metadata: %s", metadata_xml)
+        try:
+            metadata = ismrmrd.xsd.CreateFromDocument(metadata_xml)
+            if (metadata.acquisitionSystemInformation.systemFieldStrength_T != None):
+                logging.info("Data is from a %s %s at %1.1fT", metadata.acquisitionSystemInformation.systemVendor, metadata.acquisitionSystemInformation.systemModel, metadata.acquisitionSystemInformation.systemFieldStrength_T)
+        except:
+            logging.warning("Metadata is not a valid MRD XML structure.  Passing on metadata as text")
+            metadata = metadata_xml
+
+        return metadata
+
+    def parse_config_additional(self, connection, config, configAdditionalText):
+        """Returns the (possibly overridden) config and the parsed JSON config parameters"""
+        logging.info("Received additional config text: %s", configAdditionalText)
+        connection.save_additional_config(configAdditionalText)
+        configAdditional = configAdditionalText
+        try:
+            configAdditional = json.loads(configAdditionalText)
+
+            if ('parameters' in configAdditional):
+                if ('config' in configAdditional['parameters']):
+                    logging.info("Changing config to: %s", configAdditional['parameters']['config'])
+                    config = configAdditional['parameters']['config']
+
+                if ('customconfig' in configAdditional['parameters']) and (configAdditional['parameters']['customconfig'] != ""):
+                    logging.info("Changing config to: %s", configAdditional['parameters']['customconfig'])
+                    config = configAdditional['parameters']['customconfig']
+        except:
+            logging.error("Failed to parse as JSON")
+
+        self.negotiate_compression(connection, configAdditional)
+        self.negotiate_shared_memory(connection, configAdditional)
+        return config, configAdditional
+
+    def negotiate_compression(self, connection, configAdditional):
+        # Clients that can decompress request compressed data messages in the
+        # reply through the "compression", "compressionTypes" and
+        # "compressionLevel" parameters.  Compression is only used when asked
+        # for, so clients that don't understand MRD_MESSAGE_COMPRESSED are not affected.
+        if not isinstance(configAdditional, dict) or ('parameters' not in configAdditional):
+            return
+
+        parameters = configAdditional['parameters']
+        codec = parameters.get('compression', 'none')
+        if (codec is None) or (codec == '') or (codec == 'none'):
+            return
 
-            # Dataset may not be closed properly if a close message is not received
-            if connection.savedata is True:
+        try:
+            level = parameters.get('compressionLevel', None)
+            connection.enable_compression(codec,
+                                          parameters.get('compressionTypes', 'acquisition,image,waveform'),
+                                          None if (level is None) or (level == '') else int(level))
+        except Exception as e:
+            logging.error("Not using compression: %s", e)
+
+    def negotiate_shared_memory(self, connection, configAdditional):
+        # Clients on the same host can pass data through shared memory rings
+        # that they have created, named by the "sharedMemory" (client to server)
+        # and "sharedMemoryReply" (server to client) parameters.  The client keeps
+        # sending over the socket until the server has attached to its ring, so
+        # nothing is lost if the segments can't be opened (e.g. a remote client).
+        if not isinstance(configAdditional, dict) or ('parameters' not in configAdditional):
+            return
+
+        parameters = configAdditional['parameters']
+        if not parameters.get('sharedMemory') and not parameters.get('sharedMemoryReply'):
+            return
+
+        if self.sharedMemory is not True:
+            logging.warning("Client requested shared memory, but it is not enabled on this server")
+            return
+
+        recvRing = None
+        sendRing = None
+        try:
+            if parameters.get('sharedMemory'):
+                recvRing = shmring.SharedMemoryRing.attach(parameters['sharedMemory'])
+            if parameters.get('sharedMemoryReply'):
+                sendRing = shmring.SharedMemoryRing.attach(parameters['sharedMemoryReply'])
+        except Exception as e:
+            logging.error("Not using shared memory: %s", e)
+            for ring in (recvRing, sendRing):
+                if ring is not None:
+                    ring.close()
+            return
+
+        connection.enable_shared_memory(sendRing, recvRing)
+
+    def get_lazy_images(self, config):
+        # Whether received images are returned as LazyImage.  Config modules
+        # that pass images through without changing their data opt in with a
+        # module level LAZY_IMAGES = True
+        if config in ("null", "savedataonly"):
+            return True
+
+        module = self.registry.get(config) if isinstance(config, str) and config.isidentifier() else None
+        if module is None:
+            module = self.registry.get(self.defaultConfig)
+        return getattr(module, 'LAZY_IMAGES', False) is True
+
+    def process_admitted(self, connection, config, configAdditional, metadata):
+        # process() once the session can run within the concurrency limits
+        with self.admission.session(connection, config), self.metrics.session(connection, config):
+            self.process(connection, config, configAdditional, metadata)
+
+    def process(self, connection, config, configAdditional, metadata):
+        # Decide what program to use based on config
+        # If not one of these explicit cases, load the module matching name of config
+        if (config == "null"):
+            logging.info("No processing based on config")
+            try:
+                for msg in connection:
+                    if msg is None:
+                        break
+            finally:
+                connection.send_close()
+        elif (config == "savedataonly"):
+            # Dummy loop with no processing
+            try:
+                for msg in connection:
+                    if msg is None:
+                        break
+            finally:
+                connection.send_close()
+        else:
+            # Module from file having exact name as config, which is reloaded if
+            # the file has changed
+            usedConfig = config
+            module = self.registry.get(config)
+            if (module is None) and (config != self.defaultConfig):
+                logging.error("Could not load config module '%s' -- falling back to default config: %s", config, self.defaultConfig)
+                usedConfig = self.defaultConfig
+                module = self.registry.get(self.defaultConfig)
+
+            if module is None:
+                logging.error("Failed to load default config '%s'", self.defaultConfig)
+                return
+
+            logging.info("Starting config %s", usedConfig)
+            if connection.trace.enabled:
+                connection.trace.name = usedConfig
+            # The profiling mode can be set for a session by the "profile" JSON config parameter
+            profiler = None
+            mode = mrdhelper.get_json_config_param(configAdditional, 'profile', default=self.profile)
+            if mode and (mode != 'none'):
+                try:
+                    profiler = profiling.SessionProfiler(mode, self.profileInterval/1000)
+                except ValueError as e:
+                    logging.error("Not profiling: %s", e)
+
+            # Memory usage can be reported for a session by the "memoryReport" JSON config parameter
+            mode = mrdhelper.get_json_config_param(configAdditional, 'memoryReport', default=self.memoryReport)
+            if (mode and (mode != 'none')) or (self.memoryLimit > 0):
                 try:
-                    connection.dset.close()
+                    connection.memory = memoryusage.SessionMemory(mode if mode != 'none' else None, self.memoryTopSites, self.memoryLimit*memoryusage.MB)
+                except ValueError as e:
+                    logging.error("Not reporting memory usage: %s", e)
+                    connection.memory = memoryusage.SessionMemory(None, limit=self.memoryLimit*memoryusage.MB)
+
+            try:
+                with tracing.activate(connection.trace), mrdhelper.stage_session(connection.stageTimes, connection.memory), connection.trace.span('process', 'process', {'config': usedConfig}):
+                    if profiler is None:
+                        module.process(connection, configAdditional, metadata)
+                    else:
+                        try:
+                            profiler.run(module.process, connection, configAdditional, metadata)
+                        finally:
+                            self.write_profile(profiler, usedConfig)
+            finally:
+                if connection.memory is not None:
+                    connection.memory.finish()
+
+    def finalize_save_file(self, connection):
+        # Dataset may not be closed properly if a close message is not received
+        if connection.savedata is True:
+            try:
+                Connection.close_dataset(connection.dset, connection.savedataLayout)
+            except:
+                pass
+
+            if (connection.savedataFile == ""):
+                try:
+                    # Ensure ismrmrd package has a context manager
+                    if not (hasattr(ismrmrd.Dataset, '__enter__') and hasattr(ismrmrd.Dataset, '__exit__')):
+                        raise Exception("Current ismrmrd Python package does not support context manager as required by this code.  Please update to 1.14.1 or newer")
+
+                    # Rename the saved file to use the protocol name
+                    with ismrmrd.Dataset(connection.mrdFilePath, connection.savedataGroup, False) as dset:
+                        groups = dset.list()
+
+                        if ('xml' in groups):
+                            xml_header = dset.read_xml_header()
+                            xml_header = xml_header.decode("utf-8")
+                            mrdHead = ismrmrd.xsd.CreateFromDocument(xml_header)
+
+                    if (mrdHead.measurementInformation.protocolName != ""):
+                        newFilePath = connection.mrdFilePath.replace("MRD_input_", mrdHead.measurementInformation.protocolName + "_")
+                        os.rename(connection.mrdFilePath, newFilePath)
+                        connection.mrdFilePath = newFilePath
                 except:
                     pass
 
-                if (connection.savedataFile == ""):
-                    try:
-                        # Ensure ismrmrd package has a context manager
-                        if not (hasattr(ismrmrd.Dataset, '__enter__') and hasattr(ismrmrd.Dataset, '__exit__')):
-                            raise Exception("Current ismrmrd Python package does not support context manager as required by this code.  Please update to 1.14.1 or newer")
-
-                        # Rename the saved file to use the protocol name
-                        with ismrmrd.Dataset(connection.mrdFilePath, connection.savedataGroup, False) as dset:
-                            groups = dset.list()
-
-                            if ('xml' in groups):
-                                xml_header = dset.read_xml_header()
-                                xml_header = xml_header.decode("utf-8")
-                                mrdHead = ismrmrd.xsd.CreateFromDocument(xml_header)
-
-                        if (mrdHead.measurementInformation.protocolName != ""):
-                            newFilePath = connection.mrdFilePath.replace("MRD_input_", mrdHead.measurementInformation.protocolName + "_")
-                            os.rename(connection.mrdFilePath, newFilePath)
-                            connection.mrdFilePath = newFilePath
-                    except:
-                        pass
-
-                if connection.mrdFilePath is not None:
-                    logging.info("Incoming data was saved at %s", connection.mrdFilePath)
+            if connection.mrdFilePath is not None:
+                logging.info("Incoming data was saved at %s", connection.mrdFilePath)
+
+    def write_trace(self, connection):
+        if connection.trace.enabled:
+            try:
+                path = connection.trace.write(self.savedataFolder)
+                logging.info("Session trace was saved at %s", path)
+            except Exception as e:
+                logging.error("Failed to save session trace: %s", e)
+
+    def write_profile(self, profiler, name):
+        try:
+            path = profiler.write(self.savedataFolder, name)
+            logging.info("Session profile was saved at %s", path)
+        except Exception as e:
+            logging.error("Failed to save session profile: %s", e)
@@ -0,0 +1,132 @@
+# Queued logging for the server and rate-limited per-message logs, see main.py and Connection
+import atexit
+import json
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Seconds between repeated per-message log lines (e.g. for each image), see MessageLog
+messageInterval = 1.0
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {'time':    datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                 'level':   record.levelname,
+                 'process': record.process,
+                 'thread':  record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class QueuedLogging:
+    """
+    Routes the records of the root logger through a QueueHandler to a
+    QueueListener thread, which writes them to the handlers (e.g. the log file
+    and stdout), so that threads handling sessions don't wait for disk or
+    terminal I/O.
+
+    Processes forked by the server (-m, --workers) start their own listener,
+    as the thread isn't copied by fork, and stop it when they exit so that no
+    queued records are lost.
+    """
+
+    def __init__(self, handlers, level):
+        self.handlers = handlers
+        self.handler  = logging.handlers.QueueHandler(queue.SimpleQueue())
+        self.listener = None
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(level)
+
+        self.start()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.restart)
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def restart(self):
+        # Records queued by the parent before the fork were copied with the
+        # queue, and are written by the parent
+        self.handler.queue = queue.SimpleQueue()
+        self.listener      = None
+        self.start()
+
+        # Processes started by multiprocessing end with os._exit(), which
+        # doesn't run atexit functions
+        multiprocessing.util.Finalize(None, self.stop, exitpriority=100)
+
+def setup(fmt, level, logfile=None, jsonFormat=False, queued=True):
+    """Log to stdout (and logfile), through a QueueListener thread if queued"""
+    formatter = JsonFormatter() if jsonFormat else logging.Formatter(fmt)
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if logfile:
+        handlers.insert(0, logging.FileHandler(logfile))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    if queued:
+        return QueuedLogging(handlers, level)
+
+    logging.basicConfig(level=level, handlers=handlers, force=True)
+    return None
+
+class MessageLog:
+    """
+    Limits how often lines are logged for each kind of message received or
+    sent (e.g. each image).  The first message of each kind is logged, then
+    at most one every interval seconds (0 to log every message), and the
+    number of messages not logged is summarized by format_summary().
+    """
+
+    def __init__(self, interval=None):
+        self.interval = messageInterval if interval is None else interval
+        self.kinds    = {}    # kind: [time of the last logged line, logged, not logged]
+        self.lock     = threading.Lock()
+
+    def should_log(self, kind):
+        """Whether a line should be logged for this message"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.kinds.get(kind)
+            if state is None:
+                self.kinds[kind] = [now, 1, 0]
+                return True
+
+            if now - state[0] >= self.interval:
+                state[0]  = now
+                state[1] += 1
+                return True
+
+            state[2] += 1
+            return False
+
+    def format_summary(self):
+        """Summary of the messages not logged, or None if all were"""
+        with self.lock:
+            counts = [(kind, logged, skipped) for kind, (last, logged, skipped) in self.kinds.items() if skipped > 0]
+        if len(counts) == 0:
+            return None
+        return "Rate-limited logs (one per %g s): " % self.interval + ", ".join(["%s: %d of %d logged" % (kind, logged, logged+skipped) for kind, logged, skipped in counts])
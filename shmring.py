@@ -0,0 +1,126 @@
+# Shared memory ring buffer used to pass message payloads between a client and
+# server running on the same host, see Connection.enable_shared_memory()
+import logging
+import os
+import secrets
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Segment layout:
+#   Reader attached flag  (   8 bytes, uint64_t)  set by the reader once it has mapped the segment
+#   Tail position         (   8 bytes, uint64_t)  end of the last message released by the reader
+#   (padding to 128 bytes, so the data starts on its own cache line)
+#   Data                  (  capacity bytes      )
+HEADER_SIZE = 128
+ATTACHED    = 0
+TAIL        = 1
+
+class SharedMemoryRing:
+    """
+    Single producer, single consumer byte ring in a multiprocessing.shared_memory
+    segment.  The writer copies a message body into the ring and sends its
+    position and length over the socket.  Once the reader has deserialized the
+    message, it releases everything up to the end of the message by advancing
+    the tail.  Positions increase monotonically and are wrapped into the ring,
+    with each message stored contiguously.
+
+    Only the tail and the attached flag are shared.  The writer's head is kept
+    locally and the socket orders messages, so no locking is needed.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm      = shm
+        self.owner    = owner
+        self.name     = shm.name
+        self.capacity = shm.size - HEADER_SIZE
+        self.header   = np.ndarray((2,), dtype=np.uint64, buffer=shm.buf)
+        self.data     = shm.buf[HEADER_SIZE:]
+        self.head     = 0
+
+    @classmethod
+    def create(cls, size):
+        """Create a new segment with size bytes of data space"""
+        shm = shared_memory.SharedMemory(name="mrd_%d_%s" % (os.getpid(), secrets.token_hex(4)), create=True, size=size + HEADER_SIZE)
+        ring = cls(shm, True)
+        ring.header[:] = 0
+        logging.info("Created shared memory ring '%s' of %d MB", ring.name, size/1024/1024)
+        return ring
+
+    @classmethod
+    def attach(cls, name, track=False):
+        """
+        Map an existing segment created by another process.  track should be
+        True in child processes of the creator, which share its resource tracker.
+        """
+        shm = shared_memory.SharedMemory(name=name)
+
+        # The creator is responsible for removing the segment.  Without this,
+        # the resource tracker would also remove it when this process exits.
+        if not track:
+            try:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except:
+                pass
+
+        if shm.size <= HEADER_SIZE:
+            shm.close()
+            raise ValueError("Shared memory segment '%s' is too small" % name)
+
+        return cls(shm, False)
+
+    # ----- Writer ---------------------------------------------------------------
+    def is_reader_attached(self):
+        return self.header[ATTACHED] != 0
+
+    def reserve(self, nbytes):
+        # Returns the position for a contiguous message of nbytes, or None if
+        # there is not enough free space.  Space at the end of the ring that is
+        # too small for the message is skipped.
+        offset = self.head % self.capacity
+        if offset + nbytes > self.capacity:
+            position = self.head + (self.capacity - offset)
+        else:
+            position = self.head
+
+        if position + nbytes - int(self.header[TAIL]) > self.capacity:
+            return None
+        return position
+
+    def write(self, chunks, nbytes):
+        """Copy chunks into the ring, returning their position or None if the ring is full"""
+        position = self.reserve(nbytes)
+        if position is None:
+            return None
+
+        offset = position % self.capacity
+        for chunk in chunks:
+            chunk = memoryview(chunk).cast('B')
+            self.data[offset:offset+len(chunk)] = chunk
+            offset += len(chunk)
+
+        self.head = position + nbytes
+        return position
+
+    # ----- Reader ---------------------------------------------------------------
+    def set_reader_attached(self):
+        self.header[ATTACHED] = 1
+
+    def view(self, position, nbytes):
+        """Memoryview of a message, which must be released before release() is called"""
+        offset = position % self.capacity
+        if (nbytes > self.capacity) or (offset + nbytes > self.capacity) or (position < int(self.header[TAIL])):
+            raise ValueError("Invalid shared memory position %d (%d bytes)" % (position, nbytes))
+        return self.data[offset:offset+nbytes]
+
+    def release(self, position, nbytes):
+        self.header[TAIL] = position + nbytes
+
+    def close(self):
+        self.header = None
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -51,6 +51,7 @@ def process(connection, config, mrdHeader):
         connection.send_image(image)
 
 
+@mrdhelper.timed_stage
 def process_group(group, config, mrdHeader):
     if len(group) == 0:
         return []
@@ -65,81 +66,88 @@ def process_group(group, config, mrdHeader):
         logging.debug("Created folder " + debugFolder + " for debug output files")
 
     # Format data into single [cha RO PE] array
-    data = [acquisition.data for acquisition in group]
-    data = np.stack(data, axis=-1)
+    with mrdhelper.stage('sort'):
+        data = [acquisition.data for acquisition in group]
+        data = np.stack(data, axis=-1)
 
     logging.debug("Raw data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "raw.npy", data)
 
     # Fourier Transform
-    data = fft.fftshift( data, axes=(1, 2))
-    data = fft.ifft2(    data, axes=(1, 2))
-    data = fft.ifftshift(data, axes=(1, 2))
-    data *= np.prod(data.shape) # FFT scaling for consistency with ICE
+    with mrdhelper.stage('fft'):
+        data = fft.fftshift( data, axes=(1, 2))
+        data = fft.ifft2(    data, axes=(1, 2))
+        data = fft.ifftshift(data, axes=(1, 2))
+        data *= np.prod(data.shape) # FFT scaling for consistency with ICE
 
     # Sum of squares coil combination
-    data = np.abs(data)
-    data = np.square(data)
-    data = np.sum(data, axis=0)
-    data = np.sqrt(data)
+    with mrdhelper.stage('coil-combine'):
+        data = np.abs(data)
+        data = np.square(data)
+        data = np.sum(data, axis=0)
+        data = np.sqrt(data)
 
     logging.debug("Image data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "img.npy", data)
 
     # Determine max value (12 or 16 bit)
-    BitsStored = 12
-    if (mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored") is not None):
-        BitsStored = mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored")
-    maxVal = 2**BitsStored - 1
-
-    # Normalize and convert to int16
-    data *= maxVal/data.max()
-    data = np.around(data)
-    data = data.astype(np.int16)
-
-    # Remove readout oversampling
-    if mrdHeader.encoding[0].reconSpace.matrixSize.x != 0:
-        offset = int((data.shape[0] - mrdHeader.encoding[0].reconSpace.matrixSize.x)/2)
-        data = data[offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.x,:]
-
-    # Remove phase oversampling
-    if mrdHeader.encoding[0].reconSpace.matrixSize.y != 0:
-        offset = int((data.shape[1] - mrdHeader.encoding[0].reconSpace.matrixSize.y)/2)
-        data = data[:,offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.y]
-
-    logging.debug("Image without oversampling is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "imgCrop.npy", data)
+    with mrdhelper.stage('quantize'):
+        BitsStored = 12
+        if (mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored") is not None):
+            BitsStored = mrdhelper.get_userParameterLong_value(mrdHeader, "BitsStored")
+        maxVal = 2**BitsStored - 1
+
+        # Normalize and convert to int16
+        data *= maxVal/data.max()
+        data = np.around(data)
+        data = data.astype(np.int16)
+
+    # Remove readout and phase oversampling
+    with mrdhelper.stage('crop'):
+        # Remove readout oversampling
+        if mrdHeader.encoding[0].reconSpace.matrixSize.x != 0:
+            offset = int((data.shape[0] - mrdHeader.encoding[0].reconSpace.matrixSize.x)/2)
+            data = data[offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.x,:]
+
+        # Remove phase oversampling
+        if mrdHeader.encoding[0].reconSpace.matrixSize.y != 0:
+            offset = int((data.shape[1] - mrdHeader.encoding[0].reconSpace.matrixSize.y)/2)
+            data = data[:,offset:offset+mrdHeader.encoding[0].reconSpace.matrixSize.y]
+
+        logging.debug("Image without oversampling is size %s" % (data.shape,))
+        np.save(debugFolder + "/" + "imgCrop.npy", data)
 
     # Format as ISMRMRD image data
     # data has shape [RO PE], i.e. [x y].
     # from_array() should be called with 'transpose=False' to avoid warnings, and when called
     # with this option, can take input as: [cha z y x], [z y x], or [y x]
-    image = ismrmrd.Image.from_array(data.transpose(), acquisition=group[0], transpose=False)
-    image.image_index = 1
+    with mrdhelper.stage('meta'):
+        image = ismrmrd.Image.from_array(data.transpose(), acquisition=group[0], transpose=False)
+        image.image_index = 1
 
-    # Set field of view
-    image.field_of_view = (ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.x), 
-                            ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.y), 
-                            ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.z))
+        # Set field of view
+        image.field_of_view = (ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.x), 
+                                ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.y), 
+                                ctypes.c_float(mrdHeader.encoding[0].reconSpace.fieldOfView_mm.z))
 
-    # Set ISMRMRD Meta Attributes
-    meta = ismrmrd.Meta({'DataRole':               'Image',
-                         'ImageProcessingHistory': ['FIRE', 'PYTHON'],
-                         'WindowCenter':           str((maxVal+1)/2),
-                         'WindowWidth':            str((maxVal+1))})
+        # Set ISMRMRD Meta Attributes
+        meta = ismrmrd.Meta({'DataRole':               'Image',
+                             'ImageProcessingHistory': ['FIRE', 'PYTHON'],
+                             'WindowCenter':           str((maxVal+1)/2),
+                             'WindowWidth':            str((maxVal+1))})
 
-    # Add image orientation directions to MetaAttributes if not already present
-    if meta.get('ImageRowDir') is None:
-        meta['ImageRowDir'] = ["{:.18f}".format(image.getHead().read_dir[0]), "{:.18f}".format(image.getHead().read_dir[1]), "{:.18f}".format(image.getHead().read_dir[2])]
+        # Add image orientation directions to MetaAttributes if not already present
+        if meta.get('ImageRowDir') is None:
+            meta['ImageRowDir'] = ["{:.18f}".format(image.getHead().read_dir[0]), "{:.18f}".format(image.getHead().read_dir[1]), "{:.18f}".format(image.getHead().read_dir[2])]
 
-    if meta.get('ImageColumnDir') is None:
-        meta['ImageColumnDir'] = ["{:.18f}".format(image.getHead().phase_dir[0]), "{:.18f}".format(image.getHead().phase_dir[1]), "{:.18f}".format(image.getHead().phase_dir[2])]
+        if meta.get('ImageColumnDir') is None:
+            meta['ImageColumnDir'] = ["{:.18f}".format(image.getHead().phase_dir[0]), "{:.18f}".format(image.getHead().phase_dir[1]), "{:.18f}".format(image.getHead().phase_dir[2])]
 
-    xml = meta.serialize()
-    logging.debug("Image MetaAttributes: %s", xml)
-    logging.debug("Image data has %d elements", image.data.size)
+        xml = meta.serialize()
+        logging.debug("Image MetaAttributes: %s", xml)
+        logging.debug("Image data has %d elements", image.data.size)
 
-    image.attribute_string = xml
+        image.attribute_string = xml
     return image
 
 
@@ -138,6 +138,7 @@ def process(connection, config, metadata):
         connection.send_close()
  
 
+@mrdhelper.timed_stage
 def process_raw(group, connection, config, metadata):
     # Format data into a [cha RO ave lin seg] array
     nAve = int(metadata.encoding[0].encodingLimits.average.maximum                - metadata.encoding[0].encodingLimits.average.minimum)                + 1
@@ -163,26 +164,29 @@ def process_raw(group, connection, config, metadata):
         logging.warning("Overriding implusible nLin from %d to %d" % (nLin, np.max(lins)+1))
         nLin = np.max(lins)+1
 
-    data = np.zeros((group[0].data.shape[0], 
-                     nRO,
-                     nAve, 
-                     nLin, 
-                     nSeg), 
-                    group[0].data.dtype)
+    with mrdhelper.stage('sort'):
+        data = np.zeros((group[0].data.shape[0], 
+                         nRO,
+                         nAve, 
+                         nLin, 
+                         nSeg), 
+                        group[0].data.dtype)
 
-    for acq, ave, lin, seg in zip(group, aves, lins, segs):
-        data[:,:,ave,lin,seg] = acq.data[:,acq.discard_pre:(acq.data.shape[1]-acq.discard_post)]
+        for acq, ave, lin, seg in zip(group, aves, lins, segs):
+            data[:,:,ave,lin,seg] = acq.data[:,acq.discard_pre:(acq.data.shape[1]-acq.discard_post)]
 
     logging.info("Incoming raw spectroscopy data is shape %s" % (data.shape,))
 
     # Select coil with the best SNR
-    indBestCoil = np.argmax(np.mean(np.abs(data[:,:,0:9,0,0]),axis=(1,2)))
-    data = data[np.newaxis,indBestCoil,...]
+    with mrdhelper.stage('coil-select'):
+        indBestCoil = np.argmax(np.mean(np.abs(data[:,:,0:9,0,0]),axis=(1,2)))
+        data = data[np.newaxis,indBestCoil,...]
 
     # Remove readout oversampling
-    data = fft.fft(data, axis=1)
-    data = np.delete(data, np.arange(int(data.shape[1]*1/4),int(data.shape[1]*3/4)), axis=1)
-    data = fft.ifft( data, axis=1)
+    with mrdhelper.stage('crop'):
+        data = fft.fft(data, axis=1)
+        data = np.delete(data, np.arange(int(data.shape[1]*1/4),int(data.shape[1]*3/4)), axis=1)
+        data = fft.ifft( data, axis=1)
 
     # Match Siemens convention of complex conjugate representation
     data = np.conj(data)
@@ -191,10 +195,11 @@ def process_raw(group, connection, config, metadata):
     data = data * 2**25
 
     # Image recon for spectroscopic imaging
-    if (data.shape[3] > 1) and (data.shape[4] > 1):
-        data = fft.fftshift( data, axes=(3, 4))
-        data = fft.ifft2(    data, axes=(3, 4))
-        data = fft.ifftshift(data, axes=(3, 4))
+    with mrdhelper.stage('fft'):
+        if (data.shape[3] > 1) and (data.shape[4] > 1):
+            data = fft.fftshift( data, axes=(3, 4))
+            data = fft.ifft2(    data, axes=(3, 4))
+            data = fft.ifftshift(data, axes=(3, 4))
 
     # Combine averages
     data = np.mean(data, axis=2, keepdims=True)
@@ -213,49 +218,50 @@ def process_raw(group, connection, config, metadata):
     # from_array() should be called with 'transpose=False' to avoid warnings, and when called
     # with this option, can take input as: [cha z y x], [z y x], [y x], or [x]
     # For spectroscopy data, dimensions are: [z y t], i.e. [SEG LIN COL] (PAR would be 3D)
-    tmpImg = ismrmrd.Image.from_array(data, transpose=False)
+    with mrdhelper.stage('meta'):
+        tmpImg = ismrmrd.Image.from_array(data, transpose=False)
  
-    # Set the header information
-    tmpImg.setHead(mrdhelper.update_img_header_from_raw(tmpImg.getHead(), group[0].getHead()))
-
-    if data.ndim > 1:
-        # 2D spectroscopic imaging
-        tmpImg.field_of_view = (ctypes.c_float(data.shape[2]/data.shape[1]*metadata.encoding[0].reconSpace.fieldOfView_mm.y),
-                                ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.y),
-                                ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.z))
-    else:
-        # Single voxel
-        tmpImg.field_of_view = (ctypes.c_float(data.shape[0]*metadata.encoding[0].reconSpace.fieldOfView_mm.y/2),
-                                ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.y/2),
-                                ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.z))
-
-    tmpImg.image_index   = 1
-    tmpImg.image_type    = ismrmrd.IMTYPE_COMPLEX
-    tmpImg.flags         = 2**5   # IMAGE_LAST_IN_AVERAGE
+        # Set the header information
+        tmpImg.setHead(mrdhelper.update_img_header_from_raw(tmpImg.getHead(), group[0].getHead()))
+
+        if data.ndim > 1:
+            # 2D spectroscopic imaging
+            tmpImg.field_of_view = (ctypes.c_float(data.shape[2]/data.shape[1]*metadata.encoding[0].reconSpace.fieldOfView_mm.y),
+                                    ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.y),
+                                    ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.z))
+        else:
+            # Single voxel
+            tmpImg.field_of_view = (ctypes.c_float(data.shape[0]*metadata.encoding[0].reconSpace.fieldOfView_mm.y/2),
+                                    ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.y/2),
+                                    ctypes.c_float(metadata.encoding[0].reconSpace.fieldOfView_mm.z))
+
+        tmpImg.image_index   = 1
+        tmpImg.image_type    = ismrmrd.IMTYPE_COMPLEX
+        tmpImg.flags         = 2**5   # IMAGE_LAST_IN_AVERAGE
  
-    logging.info("Outgoing spectroscopy data is field_of_view %s, %s, %s" % (np.double(tmpImg.field_of_view[0]), np.double(tmpImg.field_of_view[1]), np.double(tmpImg.field_of_view[2])))
-    logging.info("Outgoing spectroscopy data is matrix_size   %s, %s, %s" % (tmpImg.getHead().matrix_size[0], tmpImg.getHead().matrix_size[1], tmpImg.getHead().matrix_size[2]))
-
-    # Set ISMRMRD Meta Attributes
-    tmpMeta = ismrmrd.Meta()
-    tmpMeta['DataRole']                            = 'Spectroscopy'
-    tmpMeta['ImageProcessingHistory']              = ['FIRE', 'SPECTRO', 'PYTHON']
-    tmpMeta['Keep_image_geometry']                 = 1
-    tmpMeta['SiemensControl_SpectroData']          = ['bool', 'true']
-    #tmpMeta['SiemensControl_Suffix4DataFileName']  = ['string', '-1_1_1_1_1_1']
-
-    # Change dwell time to account for removal of readout oversampling
-    dwellTime = mrdhelper.get_userParameterDouble_value(metadata, 'DwellTime_0')  # in ms
-
-    if dwellTime is None:
-        logging.error("Could not find DwellTime_0 in MRD header")
-    else:
-        logging.info("Found acquisition dwell time from header: " + str(dwellTime*1000))
-        tmpMeta['SiemensDicom_RealDwellTime']         = ['int', str(int(dwellTime*1000*2))]
+        logging.info("Outgoing spectroscopy data is field_of_view %s, %s, %s" % (np.double(tmpImg.field_of_view[0]), np.double(tmpImg.field_of_view[1]), np.double(tmpImg.field_of_view[2])))
+        logging.info("Outgoing spectroscopy data is matrix_size   %s, %s, %s" % (tmpImg.getHead().matrix_size[0], tmpImg.getHead().matrix_size[1], tmpImg.getHead().matrix_size[2]))
+
+        # Set ISMRMRD Meta Attributes
+        tmpMeta = ismrmrd.Meta()
+        tmpMeta['DataRole']                            = 'Spectroscopy'
+        tmpMeta['ImageProcessingHistory']              = ['FIRE', 'SPECTRO', 'PYTHON']
+        tmpMeta['Keep_image_geometry']                 = 1
+        tmpMeta['SiemensControl_SpectroData']          = ['bool', 'true']
+        #tmpMeta['SiemensControl_Suffix4DataFileName']  = ['string', '-1_1_1_1_1_1']
+
+        # Change dwell time to account for removal of readout oversampling
+        dwellTime = mrdhelper.get_userParameterDouble_value(metadata, 'DwellTime_0')  # in ms
+
+        if dwellTime is None:
+            logging.error("Could not find DwellTime_0 in MRD header")
+        else:
+            logging.info("Found acquisition dwell time from header: " + str(dwellTime*1000))
+            tmpMeta['SiemensDicom_RealDwellTime']         = ['int', str(int(dwellTime*1000*2))]
  
-    xml = tmpMeta.serialize()
-    logging.debug("Image MetaAttributes: %s", xml)
-    tmpImg.attribute_string = xml
+        xml = tmpMeta.serialize()
+        logging.debug("Image MetaAttributes: %s", xml)
+        tmpImg.attribute_string = xml
 
     images = [tmpImg]
 
@@ -266,6 +272,7 @@ def process_raw(group, connection, config, metadata):
     return images
  
 
+@mrdhelper.timed_stage
 def process_image(images, connection, config, metadata):
     # Create folder, if necessary
     if not os.path.exists(debugFolder):
@@ -278,6 +285,7 @@ def process_image(images, connection, config, metadata):
 
     return roiImg
 
+@mrdhelper.timed_stage
 def plot_spectra(img, connection, config, metadata):
     # Create folder, if necessary
     if not os.path.exists(debugFolder):
@@ -0,0 +1,119 @@
+# Per-session timelines in the Chrome trace event format, see Server.handle()
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+class SessionTrace:
+    """
+    Records spans (complete "X" events) of a session, which write() saves as a
+    JSON file that can be opened in Perfetto (https://ui.perfetto.dev) or
+    chrome://tracing.
+
+    The connection adds a span for each message received or sent and for each
+    savedata write, and the server one for the config module's process().
+    Config modules add their own with span() or the traced decorator, which
+    record to the trace of the session running in the current thread.
+    """
+
+    enabled = True
+
+    def __init__(self, name=''):
+        self.name    = name
+        self.events  = []
+        self.threads = set()
+        self.lock    = threading.Lock()
+        self.pid     = os.getpid()
+        self.origin  = time.perf_counter()
+
+    def add(self, name, category, start, end, args=None):
+        """Add a span from start to end, in time.perf_counter() seconds"""
+        tid = threading.get_ident()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': tid,
+                 'ts': (start - self.origin)*1e6, 'dur': (end - start)*1e6}
+        if args:
+            event['args'] = args
+
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': threading.current_thread().name}})
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category='recon', args=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter(), args)
+
+    def wrap(self, func, name, category):
+        """func, recording a span each time it is called"""
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            with self.span(name, category):
+                return func(*args, **kwargs)
+        return call
+
+    def write(self, folder):
+        """Save the trace as trace_<time>_<name>.json in folder and return its path"""
+        if (folder) and (not os.path.exists(folder)):
+            os.makedirs(folder)
+
+        path = os.path.join(folder, "trace_" + datetime.now().strftime("%Y-%m-%d-%H%M%S_%f") + ("_" + self.name if self.name else "") + ".json")
+        with self.lock:
+            events = list(self.events)
+        events.insert(0, {'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': 'Session %s' % self.name}})
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+class NullTrace:
+    """Stand-in for SessionTrace when tracing is disabled"""
+
+    enabled = False
+
+    def add(self, name, category, start, end, args=None):
+        pass
+
+    def span(self, name, category='recon', args=None):
+        return contextlib.nullcontext()
+
+    def wrap(self, func, name, category):
+        return func
+
+NULL_TRACE = NullTrace()
+
+# Trace of the session handled by the current thread
+local = threading.local()
+
+def current():
+    return getattr(local, 'trace', NULL_TRACE)
+
+@contextlib.contextmanager
+def activate(trace):
+    """Make trace the current trace of this thread"""
+    previous = current()
+    local.trace = trace
+    try:
+        yield
+    finally:
+        local.trace = previous
+
+def span(name, category='recon', args=None):
+    """Context manager recording a span in the current session's trace"""
+    return current().span(name, category, args)
+
+def traced(func):
+    """Decorator recording a span for each call of func in the current session's trace"""
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        with current().span(func.__name__):
+            return func(*args, **kwargs)
+    return call
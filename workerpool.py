@@ -0,0 +1,129 @@
+# Pool of pre-started processes that handle server sessions, see Server.serve()
+import collections
+import logging
+import multiprocessing
+import multiprocessing.connection
+import socket
+from multiprocessing import reduction
+
+class WorkerPool:
+    """
+    Starts size worker processes up front, so that a session doesn't pay for
+    creating a process (and with the spawn start method, importing numpy and
+    the config modules) when the connection is accepted.
+
+    Accepted sockets are passed to idle workers over a pipe (fd passing on
+    Unix, handle duplication on Windows).  If all workers are busy, sockets are
+    queued until one finishes its session.  A worker exits after maxSessions
+    sessions (0 for no limit) and is replaced right away, which bounds the
+    effect of memory leaks or fragmentation in config modules.
+
+    If given, initializer(slot) is called when a worker starts, where slot is
+    the worker's index (kept by the worker that replaces it).
+    """
+
+    def __init__(self, handler, size, maxSessions=0, initializer=None):
+        self.handler     = handler
+        self.size        = size
+        self.maxSessions = maxSessions
+        self.initializer = initializer
+        self.workers     = []
+        self.pending     = collections.deque()
+
+        for i in range(size):
+            self.start_worker(i)
+
+    def start_worker(self, slot):
+        parentConn, childConn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=WorkerPool.worker_loop, args=(self.handler, childConn, self.maxSessions, self.initializer, slot))
+        process.daemon = True
+        process.start()
+        childConn.close()
+
+        self.workers.append({'process': process, 'conn': parentConn, 'busy': False, 'sessions': 0, 'slot': slot})
+        logging.debug("Started worker process %d", process.pid)
+
+    @staticmethod
+    def worker_loop(handler, conn, maxSessions, initializer=None, slot=0):
+        if initializer is not None:
+            initializer(slot)
+
+        sessions = 0
+        while (maxSessions <= 0) or (sessions < maxSessions):
+            try:
+                fd = reduction.recv_handle(conn)
+            except (EOFError, OSError):
+                return
+
+            sock = socket.socket(fileno=fd)
+            try:
+                handler(sock)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                sock.close()
+
+            sessions += 1
+            conn.send(sessions)
+
+        logging.debug("Worker process finished %d sessions and is exiting", sessions)
+
+    def dispatch(self, sock):
+        """Hand an accepted socket to an idle worker, or queue it until one is idle"""
+        self.pending.append(sock)
+        self.update()
+        self.assign()
+
+        if len(self.pending) > 0:
+            logging.info("All %d worker processes are busy -- %d connection(s) waiting", self.size, len(self.pending))
+
+    def wait(self, sock):
+        """Wait until sock is readable, handing queued sockets to workers as they become idle"""
+        while True:
+            objects = [sock] + [worker['conn'] for worker in self.workers] + [worker['process'].sentinel for worker in self.workers]
+            ready = multiprocessing.connection.wait(objects)
+
+            self.update()
+            self.assign()
+            if sock in ready:
+                return
+
+    def update(self):
+        # Mark workers that finished a session as idle and replace workers that
+        # have exited or are exiting
+        for worker in list(self.workers):
+            try:
+                while worker['conn'].poll():
+                    worker['sessions'] = worker['conn'].recv()
+                    worker['busy']     = False
+            except (EOFError, OSError):
+                worker['busy'] = True
+
+            retiring = (self.maxSessions > 0) and (worker['sessions'] >= self.maxSessions)
+            if retiring or not worker['process'].is_alive():
+                if not retiring:
+                    logging.warning("Worker process %d exited with code %s", worker['process'].pid, worker['process'].exitcode)
+                else:
+                    logging.debug("Recycling worker process %d after %d sessions", worker['process'].pid, worker['sessions'])
+
+                self.workers.remove(worker)
+                worker['conn'].close()
+                self.start_worker(worker['slot'])
+
+    def assign(self):
+        for worker in self.workers:
+            if len(self.pending) == 0:
+                return
+            if worker['busy']:
+                continue
+
+            sock = self.pending.popleft()
+            try:
+                reduction.send_handle(worker['conn'], sock.fileno(), worker['process'].pid)
+                worker['busy'] = True
+                logging.debug("Passed connection to worker process %d", worker['process'].pid)
+            except OSError as e:
+                logging.error("Failed to pass connection to worker process %d: %s", worker['process'].pid, e)
+            finally:
+                # The worker has its own copy of the socket
+                sock.close()